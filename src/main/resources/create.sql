@@ -5,10 +5,15 @@ CREATE TABLE Caregivers (
     PRIMARY KEY (Username)
 );
 
+-- A caregiver's free time on a day, as disjoint intervals [StartMinute, EndMinute) in minutes after
+-- midnight; the key orders one caregiver's intervals on a day by start (db/SlotIndex.py).
 CREATE TABLE Availabilities (
     Time date,
     Username varchar(255) REFERENCES Caregivers,
-    PRIMARY KEY (Time, Username)
+    SiteID varchar(255),
+    StartMinute int,
+    EndMinute int,
+    PRIMARY KEY (Time, Username, StartMinute)
 );
 
 CREATE TABLE Vaccines (
@@ -16,6 +21,37 @@ CREATE TABLE Vaccines (
     Doses int,
     PRIMARY KEY (Name)
 );
+
+-- Multi-dose regimens; vaccines without a row here take a single dose.
+CREATE TABLE Regimens (
+    Vname varchar(255) REFERENCES Vaccines(Name),
+    DoseCount int,
+    MinIntervalDays int,
+    MaxIntervalDays int,
+    PRIMARY KEY (Vname)
+);
+
+-- Clinic sites; availabilities and vaccine lots may name the site they belong to.
+CREATE TABLE Sites (
+    SiteID varchar(255),
+    Latitude float,
+    Longitude float,
+    PRIMARY KEY (SiteID)
+);
+
+-- Doses per lot; Vaccines.Doses is kept equal to the sum of a vaccine's lots.
+CREATE TABLE VaccineLots (
+    LotID varchar(255),
+    Vname varchar(255) REFERENCES Vaccines(Name),
+    Quantity int,
+    Expiry date,
+    SiteID varchar(255) REFERENCES Sites(SiteID),
+    PRIMARY KEY (LotID)
+);
+
+-- Serves first-expired-first-out allocation: the first valid lot of a site (or of the
+-- central stock, SiteID NULL) is an index seek.
+CREATE INDEX IX_VaccineLots_FEFO ON VaccineLots (Vname, SiteID, Expiry, Quantity);
     
 CREATE TABLE Patients (
     Username varchar(255),  
@@ -30,5 +66,111 @@ CREATE TABLE Appointments (
     Cname varchar(255) REFERENCES Caregivers(Username),
     Pname varchar(255) REFERENCES Patients(Username),
     Vname varchar(255) REFERENCES Vaccines(Name),
+    LotID varchar(255),
+    SeriesID int,
+    DoseNumber int,
+    SiteID varchar(255),
+    StartMinute int,
+    EndMinute int,
     PRIMARY KEY (AppointID)
-);
\ No newline at end of file
+);
+
+CREATE INDEX IX_Appointments_Time ON Appointments (Time);
+-- Serves the overlap check when a caregiver offers more time on a day.
+CREATE INDEX IX_Appointments_Cname_Time ON Appointments (Cname, Time, StartMinute);
+CREATE INDEX IX_Appointments_SeriesID ON Appointments (SeriesID);
+-- Serves the daily booking counts behind the dose-exhaustion warning in reserve.
+CREATE INDEX IX_Appointments_Vname_Time ON Appointments (Vname, Time);
+
+-- Cancelled appointments, kept for reporting cancellation rates (db/Snapshot.py).
+CREATE TABLE Cancellations (
+    AppointID int,
+    Time date,
+    Cname varchar(255),
+    Pname varchar(255),
+    Vname varchar(255),
+    CancelledAt datetime,
+    PRIMARY KEY (AppointID)
+);
+
+-- Sharded deployments (db/ShardRouter.py) run this script on every shard. Caregivers,
+-- Availabilities and Appointments are partitioned by caregiver; Patients, Vaccines,
+-- Regimens, Sites and VaccineLots are only populated on the home shard, so on the other shards
+-- the Appointments references to Patients and Vaccines must be left out.
+
+-- Archive tables for past-date rows moved out of the hot tables by db/Archive.py.
+-- They carry no foreign keys because OUTPUT ... INTO cannot target a table that
+-- participates in a FOREIGN KEY constraint.
+CREATE TABLE AvailabilitiesArchive (
+    Time date,
+    Username varchar(255),
+    SiteID varchar(255),
+    StartMinute int,
+    EndMinute int,
+    PRIMARY KEY (Time, Username, StartMinute)
+);
+
+CREATE TABLE AppointmentsArchive (
+    AppointID int,
+    Time date,
+    Cname varchar(255),
+    Pname varchar(255),
+    Vname varchar(255),
+    LotID varchar(255),
+    SeriesID int,
+    DoseNumber int,
+    SiteID varchar(255),
+    StartMinute int,
+    EndMinute int,
+    PRIMARY KEY (AppointID)
+);
+
+CREATE INDEX IX_AppointmentsArchive_Cname ON AppointmentsArchive (Cname);
+CREATE INDEX IX_AppointmentsArchive_Pname ON AppointmentsArchive (Pname);
+CREATE INDEX IX_AppointmentsArchive_Vname_Time ON AppointmentsArchive (Vname, Time);
+-- Serves the recent daily booking counts of forecast.
+CREATE INDEX IX_AppointmentsArchive_Time ON AppointmentsArchive (Time);
+
+-- Reminders queued by db/Reminders.py on the appointment's shard, for a delivery process to send.
+-- The key lets any number of scheduler processes queue the same reminder without duplicates;
+-- no foreign key so that archiving an appointment leaves its reminders in place.
+CREATE TABLE ReminderOutbox (
+    AppointID int,
+    Kind varchar(16),
+    DueAt datetime,
+    Time date,
+    Cname varchar(255),
+    Pname varchar(255),
+    Vname varchar(255),
+    QueuedAt datetime,
+    SentAt datetime,
+    PRIMARY KEY (AppointID, Kind)
+);
+
+CREATE INDEX IX_ReminderOutbox_Time ON ReminderOutbox (Time);
+
+-- Shared admission slots of db/Admission.py (AdmissionControl=shared), used on the home shard only:
+-- one row per command holding a slot across processes. Times are seconds since 1970 on the database's
+-- clock, so the clocks of the scheduler processes do not matter; a row past ExpiresAt no longer counts.
+CREATE TABLE AdmissionSlots (
+    Claim varchar(32),
+    Command varchar(64),
+    ExpiresAt float,
+    PRIMARY KEY (Claim)
+);
+
+CREATE INDEX IX_AdmissionSlots_Command ON AdmissionSlots (Command, ExpiresAt);
+
+-- Results of commands run with an idempotency key (db/Idempotency.py), on the home shard. A row is
+-- claimed with a NULL Result before the command runs and holds the command's transcript afterwards;
+-- it is purged once past ExpiresAt.
+CREATE TABLE IdempotencyKeys (
+    Owner varchar(255),
+    IdemKey varchar(64),
+    Request varchar(255),
+    Result varchar(8000),
+    ExpiresAt datetime,
+    PRIMARY KEY (Owner, IdemKey)
+);
+
+CREATE INDEX IX_IdempotencyKeys_ExpiresAt ON IdempotencyKeys (ExpiresAt);
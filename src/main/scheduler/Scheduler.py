@@ -12,14 +12,68 @@ from model.Vaccine import Vaccine
 from model.Caregiver import Caregiver
 from model.Patient import Patient
 from util.Util import Util
-from db.ConnectionManager import ConnectionManager
-import pymssql
+from util import Cache
+from util import Trace
+from util import Forecast
+from util import Output
+from db.ConnectionManager import ConnectionManager, DBError, DBIntegrityError
+from db import UsernameIndex
+from db.ShardRouter import ShardRouter
+from db import Queries
+from db.Archive import Archiver
+from db import Snapshot
+from db import SiteIndex
+from db import Reminders
+from db import SlotIndex
+from db import Admission
+from db import GroupCommit
+from db import Idempotency
+from collections import defaultdict
+import argparse
 import datetime
 import math
+import threading
 
 
-current_patient = None
-current_caregiver = None
+class Session(threading.local):
+    '''
+    The user logged in to a session. Every thread has its own, so one process can run several sessions.
+    '''
+    patient = None
+    caregiver = None
+
+
+session = Session()
+
+# search_caregiver_schedule --near lists at most NEAREST_SITES sites; without --radius it starts at
+# 25 km and doubles the radius up to MAX_SEARCH_DOUBLINGS times (the last one spans the globe)
+NEAREST_SITES = 5
+MAX_SEARCH_DOUBLINGS = 11
+
+
+def pop_option(tokens, name):
+    '''
+    This function removes an optional "<name> <value>" pair from the tokens.
+    It returns the remaining tokens and the value, which is None when the option is absent
+    and "" when the option is given without a value.
+    '''
+    if name not in tokens:
+        return tokens, None
+    i = tokens.index(name)
+    value = tokens[i + 1] if i + 1 < len(tokens) else ""
+    return tokens[:i] + tokens[i + 2:], value
+
+
+def site_exists(site_id):
+    '''
+    Returns whether the site is registered, or None when that cannot be checked.
+    '''
+    try:
+        return SiteIndex.sites.contains(site_id)
+    except DBError as e:
+        print("Error occurred when checking site")
+        print("Db-Error:", e)
+        return None
 
 
 def create_patient(tokens):
@@ -50,10 +104,15 @@ def create_patient(tokens):
     # save patient information to the database
     try:
         patient.save_to_db()
-    except pymssql.Error as e:
+    except DBIntegrityError:
+        # the username was taken by an account the index has not seen yet
+        UsernameIndex.patients.add(username)
+        print("Username taken, try again!")
+        return
+    except DBError as e:
         print("Create patient failed, Cannot save")
         print("Db-Error:", e)
-        quit()
+        return
     except Exception as e:
         print("Error:", e)
         return
@@ -87,10 +146,15 @@ def create_caregiver(tokens):
     # save caregiver information to the database
     try:
         caregiver.save_to_db()
-    except pymssql.Error as e:
+    except DBIntegrityError:
+        # the username was taken by an account the index has not seen yet
+        UsernameIndex.caregivers.add(username)
+        print("Username taken, try again!")
+        return
+    except DBError as e:
         print("Create caregiver failed, Cannot save")
         print("Db-Error:", e)
-        quit()
+        return
     except Exception as e:
         print("Error:", e)
         return
@@ -98,46 +162,34 @@ def create_caregiver(tokens):
 
 
 def username_exists_caregiver(username):
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-
-    select_username = "SELECT * FROM Caregivers WHERE Username = %s"
+    '''
+    Answers from the in-memory username index without a database round trip.
+    A name created elsewhere may be missing; create_caregiver then relies on the primary key.
+    '''
     try:
-        cursor = conn.cursor(as_dict=True)
-        cursor.execute(select_username, username)
-        
-        for row in cursor:
-            return row['Username'] is not None
-    except pymssql.Error as e:
+        return UsernameIndex.caregivers.contains(username)
+    except DBError as e:
         print("Error occurred when checking username")
         print("Db-Error:", e)
-        quit()
+        return
     except Exception as e:
         print("Error:", e)
-    finally:
-        cm.close_connection()
     return False
 
 
 def username_exists_patient(username):
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-
-    select_username = "SELECT * FROM Patients WHERE Username = %s"
+    '''
+    Answers from the in-memory username index without a database round trip.
+    A name created elsewhere may be missing; create_patient then relies on the primary key.
+    '''
     try:
-        cursor = conn.cursor(as_dict=True)
-        cursor.execute(select_username, username)
-        
-        for row in cursor:
-            return row['Username'] is not None
-    except pymssql.Error as e:
+        return UsernameIndex.patients.contains(username)
+    except DBError as e:
         print("Error occurred when checking username")
         print("Db-Error:", e)
-        quit()
+        return
     except Exception as e:
         print("Error:", e)
-    finally:
-        cm.close_connection()
     return False
 
 
@@ -150,8 +202,7 @@ def login_patient(tokens):
     # check 1: if someone's already logged-in, the person needs to log out first since the
     # system allows only one user to log in at a time.
     
-    global current_patient
-    if current_caregiver is not None or current_patient is not None:
+    if session.caregiver is not None or session.patient is not None:
         print("Already logged-in!")
         return
 
@@ -166,10 +217,10 @@ def login_patient(tokens):
     patient = None
     try:
         patient = Patient(username, password=password).get()
-    except pymssql.Error as e:
+    except DBError as e:
         print("Login patient failed")
         print("Db-Error:", e)
-        quit()
+        return
     except Exception as e:
         print("Error occurred when logging in. Please try again!")
         print("Error:", e)
@@ -180,7 +231,7 @@ def login_patient(tokens):
         print("Error occurred when logging in. Please try again!")
     else:
         print("Patient logged in as: " + username)
-        current_patient = patient
+        session.patient = patient
    
 
 def login_caregiver(tokens):
@@ -191,8 +242,7 @@ def login_caregiver(tokens):
     
     # check 1: if someone's already logged-in, the person needs to log out first since the
     # system allows only one user to log in at a time.
-    global current_caregiver
-    if current_caregiver is not None or current_patient is not None:
+    if session.caregiver is not None or session.patient is not None:
         print("Already logged-in!")
         return
 
@@ -207,10 +257,10 @@ def login_caregiver(tokens):
     caregiver = None
     try:
         caregiver = Caregiver(username, password=password).get()
-    except pymssql.Error as e:
+    except DBError as e:
         print("Login caregiver failed")
         print("Db-Error:", e)
-        quit()
+        return
     except Exception as e:
         print("Error occurred when logging in. Please try again!")
         print("Error:", e)
@@ -221,30 +271,35 @@ def login_caregiver(tokens):
         print("Error occurred when logging in. Please try again!")
     else:
         print("Caregiver logged in as: " + username)
-        current_caregiver = caregiver
+        session.caregiver = caregiver
 
 
 def search_caregiver_schedule(tokens):
     """
-    This function outputs the usernames of the caregivers who are available on the specified date,
-    along with the number of available doses left for each vaccine. 
+    This function outputs the usernames of the caregivers who are available on the specified date and the
+    hours they are free (in which an appointment still fits), along with the number of available doses left for each vaccine. 
+    With --near, it instead outputs the nearest clinic sites that have both an available caregiver
+    and vaccine stock valid on that date, searching within --radius km when given.
     Both patients and caregivers can perform this operation.
-    search_caregiver_schedule <date>
+    search_caregiver_schedule <date> [--near <lat,lon> [--radius <km>]]
     
     """
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-
-    global current_caregiver
-    global current_patient
     
     # check 1: Make sure that either a caregiver or a patient is logged in.
-    if current_patient is None and current_caregiver is None:
+    if session.patient is None and session.caregiver is None:
        print("Please login first")
        return
 
+    tokens, near = pop_option(tokens, "--near")
+    tokens, radius = pop_option(tokens, "--radius")
+    try:
+        location = None if near is None else tuple(float(x) for x in near.split(","))
+        radius = None if radius is None else float(radius)
+    except ValueError:
+        location = ()
+
     # check 2: the length for tokens need to be exactly 2 to include all information (with the operation name)
-    if len(tokens) != 2:
+    if len(tokens) != 2 or (location is not None and len(location) != 2) or (radius is not None and location is None):
         print("Please try again!")
         return
 
@@ -272,32 +327,39 @@ def search_caregiver_schedule(tokens):
     day = int(date_tokens[1])
     year = int(date_tokens[2])
 
-    select_time = "SELECT Username FROM Availabilities WHERE Time = %s"
- 
     try:
-        cursor = conn.cursor(as_dict=True)
-        schedule = datetime.datetime(year, month, day).strftime("%m-%d-%Y")
-        cursor.execute(select_time, schedule)
-        available = []
+        schedule = datetime.date(year, month, day)
+        # (caregiver, site, start, end) of the free intervals on the date that an appointment fits into
+        generation = Cache.caregivers_by_date.generation()
+        available = Cache.caregivers_by_date.get(schedule)
+        if available is None:
+            # availability is partitioned by caregiver, so every shard is searched in parallel and merged
+            shards = ShardRouter().fan_out(
+                lambda shard_cm: [(row['Username'], row['SiteID'], row['StartMinute'], row['EndMinute']) for row in
+                                  shard_cm.execute("availability.by_date", (schedule, SlotIndex.APPOINTMENT_MINUTES), as_dict=True)])
+            available = sorted(pair for pairs in shards for pair in pairs)
+            Cache.caregivers_by_date.put(schedule, available, generation)
+
+        if location is not None:
+            search_nearest_sites(schedule, available, location, radius)
+            return
         
-        for row in cursor:
-            print('Available Caregiver:', row['Username'])
-            available.append(row)
+        for username, site_id, start, end in available:
+            Output.record("caregiver", Output.line('Available Caregiver:', username, SlotIndex.format_hours(start, end)),
+                          username=username, site_id=site_id, start=SlotIndex.format_time(start), end=SlotIndex.format_time(end))
               
         if available:              
-            cursor.execute("SELECT Name, Doses FROM Vaccines")
-            for row in cursor:
-                print('Available Vaccine:', row['Name'], '& Available Doses: ', row['Doses'])
+            for name, doses in get_vaccine_stock():
+                Output.record("vaccine", Output.line('Available Vaccine:', name, '& Available Doses: ', doses), name=name, doses=doses)
                 
         else:
             print('No Caregiver is available on the specified date. Please try another date.')
-        cursor.close()
              
         
-    except pymssql.Error as e:
+    except DBError as e:
         print("Search failed")
         print("Db-Error:", e)
-        quit()
+        return
     except ValueError:
         print("Please enter a valid date in the format of 'MM-DD-YYYY'.")
         return
@@ -305,7 +367,74 @@ def search_caregiver_schedule(tokens):
         print("Error occurred when searching for caregiver's availability")
         print("Error:", e)
         return
-    cm.close_connection()
+
+
+def search_nearest_sites(schedule, available, location, radius=None):
+    '''
+    This function outputs the sites nearest to location that have an available caregiver and vaccine
+    stock valid on the given date. Without a radius, the search radius doubles until a site is found.
+    A site's stock includes the central stock (lots without a site), which reserve falls back to.
+    '''
+    caregivers = defaultdict(list)
+    for username, site_id, _, _ in available:
+        if site_id is not None and username not in caregivers[site_id]:
+            caregivers[site_id].append(username)
+
+    # lots live on the home shard
+    cm = ShardRouter().home()
+    cm.create_connection()
+    stock = defaultdict(lambda: defaultdict(int))
+    central = defaultdict(int)
+    try:
+        for row in cm.execute("lot.stock_by_site", schedule, as_dict=True):
+            if row['SiteID'] is None:
+                central[row['Vname']] += row['Doses']
+            else:
+                stock[row['SiteID']][row['Vname']] += row['Doses']
+    finally:
+        cm.close_connection()
+    for site_id in caregivers:
+        for name, doses in central.items():
+            stock[site_id][name] += doses
+
+    radii = [radius] if radius is not None else [25 * 2 ** k for k in range(MAX_SEARCH_DOUBLINGS)]
+    for r in radii:
+        sites = [(d, site_id) for d, site_id in SiteIndex.sites.within(location[0], location[1], r)
+                 if site_id in caregivers and stock[site_id]]
+        if sites:
+            break
+
+    if not sites:
+        print('No site with an available caregiver and vaccine stock was found near the given location.')
+        return
+    for d, site_id in sites[:NEAREST_SITES]:
+        Output.record("site", f'Site: {site_id} ({d:.1f} km away)', site_id=site_id, distance_km=round(d, 3))
+        for username in caregivers[site_id]:
+            Output.record("caregiver", Output.line('Available Caregiver:', username), username=username, site_id=site_id)
+        for name, doses in sorted(stock[site_id].items()):
+            Output.record("vaccine", Output.line('Available Vaccine:', name, '& Available Doses: ', doses),
+                          name=name, doses=doses, site_id=site_id)
+
+
+def get_vaccine_stock():
+    '''
+    This function returns (vaccine name, available doses) pairs for every vaccine.
+    They are served from the stock cache and only read from the database when an entry is missing.
+    '''
+    generation = Cache.vaccine_stock.generation()
+    names = Cache.vaccine_stock.get(Cache.VACCINE_NAMES)
+    stock = None if names is None else [(name, Cache.vaccine_stock.get(name)) for name in names]
+    if stock is None or any(doses is None for _, doses in stock):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        try:
+            stock = [(row['Name'], row['Doses']) for row in cm.execute("vaccine.all", as_dict=True)]
+        finally:
+            cm.close_connection()
+        for name, doses in stock:
+            Cache.vaccine_stock.put(name, doses, generation)
+        Cache.vaccine_stock.put(Cache.VACCINE_NAMES, [name for name, _ in stock], generation)
+    return stock
     
 
 def get_vaccine_info():
@@ -315,80 +444,113 @@ def get_vaccine_info():
     
     cm = ConnectionManager()
     conn = cm.create_connection()
-    cursor = conn.cursor(as_dict=True)
     v_info = {"v_name": "v_dose"}
 
-    get_all_vaccines = "SELECT Name, Doses FROM Vaccines"
     try:
-        cursor.execute(get_all_vaccines)
+        cursor = cm.execute("vaccine.all", as_dict=True)
         for row in cursor:
             v_info[str(row["Name"]).lower()] = row["Doses"]             
         return v_info
     
-    except pymssql.Error:     
+    except DBError:     
             print("Error occurred while obtaining vaccine information.")
-            
-    return
-    cm.close_connection()
+            raise
+    finally:
+        cm.close_connection()
 
 
-def get_appoint_id():
+def get_appoint_id(cm):
     '''
-    This function generates the appointment ID.
-    It finds the maximum ID number present in the database and assigns the next bigger integer.
+    This function generates the appointment ID on the shard of the open connection cm.
+    It finds the maximum ID number present in the shard and assigns the next bigger integer owned by that shard.
+    Archived and cancelled appointments are included so that IDs are never reused after an archival run or a cancellation.
+    Call it inside the transaction that inserts the appointments, once that transaction has written to the shard:
+    on SQLite its write lock then keeps concurrent reservations from reading the same maximum.
     '''
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-    
-    select_maxid = "SELECT MAX(AppointID) AS max_id FROM Appointments"
-
     try:
-        cursor = conn.cursor()
-        cursor.execute(select_maxid)
-        maxid = cursor.fetchall()[0][0]
-               
-        if maxid is None:
-            return 1
-        
-        else:
-            maxid = int(maxid)
-            return maxid + 1
+        maxid = cm.first("appointment.max_id")[0]
+        return ShardRouter().next_appoint_id(maxid, cm.shard)
 
-    except pymssql.Error as e:
+    except DBError as e:
         print("Creating an appointment ID failed")
         print("Db-Error:", e)
-        quit()
+        raise
     except:
         print("Failed to create Appointment ID")
         return
 
-    
+
+def plan_series(cm, first_date, regimen, first_start=None, site_id=None):
+    '''
+    This function picks an available caregiver and time slot for every dose of a regimen on one shard.
+    The first dose is on first_date, at first_start (minutes after midnight) when given and otherwise in the
+    earliest free slot of the day; each later dose takes the earliest free slot within
+    [previous + minimum interval, previous + maximum interval]. With a site_id every dose is placed at that site.
+    Returns a list of (date, caregiver, site, start), or None when some dose cannot be placed.
+    '''
+    dose_count, min_interval, max_interval = regimen
+    length = SlotIndex.APPOINTMENT_MINUTES
+    at_site = "" if site_id is None else "_at_site"
+    site = () if site_id is None else (site_id,)
+    if first_start is None:
+        row = cm.first("availability.first_fit" + at_site, (first_date, length) + site, as_dict=True)
+    else:
+        row = cm.first("availability.covering" + at_site, (first_date, first_start, first_start + length) + site,
+                       as_dict=True)
+    if row is None:
+        return None
+    plan = [(first_date, row["Username"], row["SiteID"], row["StartMinute"] if first_start is None else first_start)]
+    for _ in range(1, dose_count):
+        previous = plan[-1][0]
+        row = cm.first("availability.first_between" + at_site,
+                       (previous + datetime.timedelta(days=min_interval), previous + datetime.timedelta(days=max_interval), length)
+                       + site, as_dict=True)
+        if row is None:
+            return None
+        plan.append((row["Time"], row["Username"], row["SiteID"], row["StartMinute"]))
+    return plan
+
 
 def reserve(tokens):
     """
     Patients perform this operation to make an appointment.
     Once appointment is confirmed, an available caregiver will be randomly assigned.
-    This function outputs the assigned caregiver and the appointment ID for the reservation.
-    reserve <date> <vaccine>
+    For multi-dose vaccines every dose of the regimen is booked at once, the first on the given date.
+    The first appointment takes the earliest free time slot of the day, or the slot starting at --at.
+    With --site every dose is booked at that site, e.g. one found by search_caregiver_schedule --near.
+    This function outputs the assigned caregiver, the time and the appointment ID for the reservation.
+    reserve <date> <vaccine> [--at <HH:MM>] [--site <site_id>]
 
     """
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-    cursor = conn.cursor(as_dict=True)
-
     # check 1: check if the current logged-in user is a patient
-    global current_patient
-    if current_patient is None:
+    if session.patient is None:
         print("Please login as a patient first!")
         return
 
-    pname= current_patient.username
+    pname= session.patient.username
+    tokens, at = pop_option(tokens, "--at")
+    tokens, site_id = pop_option(tokens, "--site")
     
     # check 2: the length for tokens need to be exactly 3 to include all information (with the operation name)
-    if len(tokens) != 3:
+    if len(tokens) != 3 or at == "" or site_id == "":
         print("Please try again! For Johnson & Johnson vaccine, please type 'Johnson'")
         return
 
+    if at is not None:
+        try:
+            at = SlotIndex.parse_time(at)
+        except ValueError:
+            print("Please enter a valid time in the format of 'HH:MM'.")
+            return
+
+    if site_id is not None:
+        exists = site_exists(site_id)
+        if exists is None:
+            return Idempotency.RETRY
+        if not exists:
+            print("No such site exists. Please choose a site listed by search_caregiver_schedule --near.")
+            return
+
     date = tokens[1]
     vaccine_name = tokens[2]
 
@@ -409,7 +571,11 @@ def reserve(tokens):
     
     
     # check 4: Check if the correct vaccine name is input and it is available in stock.
-    v_info = get_vaccine_info()
+    try:
+        v_info = get_vaccine_info()
+    except DBError as e:
+        print("Db-Error:", e)
+        return Idempotency.RETRY
      
     if vaccine_name not in v_info:
         print('No such vaccine exists. Please corretly type the vaccine name.\nFor Johnson & Johnson vaccine, please type Johnson')
@@ -426,86 +592,178 @@ def reserve(tokens):
 
         
         
-        # Make sure that a caregiver is available on the specified date. 
-        select_caregiver = "SELECT Username FROM Availabilities WHERE Time = %s"
-                      
+        # Multi-dose vaccines are booked as a whole series: one caregiver slot and one dose per dose.
+        vaccine = Vaccine(vaccine_name, v_info.get(vaccine_name))
+        try:
+            regimen = vaccine.get_regimen()
+        except DBError as e:
+            print("Making an appointment failed")
+            print("Db-Error:", e)
+            return Idempotency.RETRY
+
+        # Make sure that caregivers are available on the specified date and, for follow-up doses,
+        # within each interval window. Shards are probed one at a time from a date-dependent start,
+        # and the booking itself only touches the shard that owns the assigned caregivers.
+        router = ShardRouter()
         try:
             try:
-                reservation = datetime.datetime(year, month, day).strftime("%m-%d-%Y")
-                cursor.execute(select_caregiver, reservation)
-                row = cursor.fetchone()
-                assigned_caregiver = row["Username"]
-                
-                # Generate appointment ID's.
-                appoint_id = get_appoint_id()
-                print("Appointment confirmed! Assigned caregiver is:", assigned_caregiver,
-                      "\nPlease print your appointment ID below and bring it with you. \n", appoint_id)
+                reservation = datetime.date(year, month, day)
+                # past dates are moved to the archive, so appointments can only be made from today on
+                if reservation < datetime.date.today():
+                    print("Please enter a date no earlier than today.")
+                    return
+                start = router.shard_for_date(reservation)
+                for i in range(router.shard_count):
+                    cm = router.for_shard((start + i) % router.shard_count)
+                    conn = cm.create_connection()
+                    plan = plan_series(cm, reservation, regimen, at, site_id)
+                    if plan is not None:
+                        break
+                    cm.close_connection()
+                assigned_caregiver = plan[0][1]
 
-            except pymssql.Error as e:
+            except DBError as e:
                 print("Making an appointment failed")
                 print("Db-Error:", e)
-                quit()
+                cm.close_connection()
+                return Idempotency.RETRY
             except ValueError:
                 print("Please enter a valid date in the format of 'MM-DD-YYYY'.")
                 return                        
             except:
-                print('No caregiver is available on the specified date.')
+                where = "" if site_id is None else " at the specified site"
+                if regimen[0] > 1:
+                    print(f'No caregiver is available{where} on the specified date or within the follow-up dose windows.')
+                elif at is not None:
+                    print(f'No caregiver is available{where} at the specified time.')
+                else:
+                    print(f'No caregiver is available{where} on the specified date.')
                 return
      
             
-            # After appointment has been confirmed, update the vaccine dose.  
-            try:
-                vaccine = Vaccine(vaccine_name, v_info.get(vaccine_name)).get()
-                vaccine.decrease_available_doses(1)
-            except:
-                print("Error occursed while updating vaccine doses.")
+            # Take each dose from the earliest-expiring lot at its appointment's site (or else from the central
+            # stock) that is still valid on its appointment date. The vaccines live on the home shard: when
+            # the caregivers do too, the doses are taken in the booking transaction below, otherwise
+            # beforehand in a transaction of their own.
+            doses = [(d, site_id) for d, _, site_id, _ in plan]
+            doses_in_booking = cm.shard == ShardRouter.HOME
+            lot_ids = None
+            if not doses_in_booking:
+                try:
+                    lot_ids = vaccine.allocate_doses(doses)
+                    Cache.vaccine_stock.invalidate(vaccine_name)
+                except ValueError as e:
+                    print(e, 'Please choose another vaccine.')
+                    cm.close_connection()
+                    return
+                except DBError:
+                    print("Error occursed while updating vaccine doses.")
+                    cm.close_connection()
+                    return Idempotency.RETRY
+
+            # Take the time slots out of the caregivers' availability and add the appointments in one transaction.
+            # A concurrent booking may have taken a slot since it was planned; book() raises LookupError then.
+            length = SlotIndex.APPOINTMENT_MINUTES
+
+            def book_plan(cm):
+                slots = SlotIndex.SlotIndex(cm)
+                for d, caregiver, _, start in plan:
+                    slots.book(d, caregiver, start, start + length)
+                lots = vaccine.take_doses(cm, doses) if doses_in_booking else lot_ids
+
+                # Generate appointment ID's. Every dose keeps the shard's ID residue.
+                appoint_id = get_appoint_id(cm)
+                appoint_ids = [appoint_id + k * router.shard_count for k in range(len(plan))]
+                for k, ((d, caregiver, site_id, start), lot_id) in enumerate(zip(plan, lots)):
+                    cm.execute("appointment.insert", (appoint_ids[k], d, caregiver, pname, vaccine_name, lot_id, appoint_id, k + 1, site_id,
+                                                      start, start + length))
+                return appoint_ids
 
-            # Add appointment information to the database.
-            add_appointment = "INSERT INTO Appointments VALUES (%d, %s, %s, %s, %s)"
             try:
-                cursor.execute(add_appointment, (appoint_id, reservation, assigned_caregiver, current_patient.username, vaccine_name))
-                conn.commit()
-            except pymssql.Error:
-                print("Error occured while updating appointment information")
+                if GroupCommit.enabled():
+                    # the booking joins the next commit group of the caregivers' shard
+                    appoint_ids = GroupCommit.for_shard(cm.shard).run(book_plan)
+                else:
+                    appoint_ids = book_plan(cm)
+                    conn.commit()
+            except ValueError as e:
+                # only taking the doses in the booking transaction raises this
+                print(e, 'Please choose another vaccine.')
                 conn.rollback()
                 cm.close_connection()
                 return
-
-            # Update caregiver's availability in the database.
-            try:
-                remove_availability = "DELETE FROM Availabilities WHERE Username = %s AND Time = %s"
-                cursor.execute(remove_availability, (assigned_caregiver, reservation))
-                conn.commit()
-            except pymssql.Error:
-                print("Error occured while updating caregiver availabilities")
+            except DBError + (LookupError,) as e:
+                print("Error occured while updating appointment information")
+                print("Error:", e)
                 conn.rollback()
                 cm.close_connection()
-                return
+                if not doses_in_booking:
+                    vaccine.return_doses(lot_ids)
+                    Cache.vaccine_stock.invalidate(vaccine_name)
+                # nothing of the booking is left, so a retry may book again
+                return Idempotency.RETRY
+            if doses_in_booking:
+                Cache.vaccine_stock.invalidate(vaccine_name)
+            appoint_id = appoint_ids[0]
+            for d, _, _, _ in plan:
+                Cache.caregivers_by_date.invalidate(d)
+            Reminders.reminders.add([(appoint_ids[k], d, start) for k, (d, _, _, start) in enumerate(plan)])
+
+            for k, (d, caregiver, site_id, start) in enumerate(plan):
+                if k == 0:
+                    text = Output.line("Appointment confirmed! Assigned caregiver is:", caregiver, "at", SlotIndex.format_time(start),
+                                       "\nPlease print your appointment ID below and bring it with you. \n", appoint_id)
+                else:
+                    text = (f"Dose {k + 1} confirmed on {d.strftime('%m-%d-%Y')} at {SlotIndex.format_time(start)} "
+                            f"with caregiver {caregiver}, appointment ID {appoint_ids[k]}")
+                Output.record("appointment", text, appoint_id=appoint_ids[k], date=d, time=SlotIndex.format_time(start), caregiver=caregiver,
+                              vaccine=vaccine_name, dose=k + 1, series_id=appoint_id, site_id=site_id)
+            warning = Forecast.exhaustion_warning(vaccine_name, v_info.get(vaccine_name) - len(plan))
+            if warning is not None:
+                print(warning)
                 
-        except pymssql.Error:
+        except DBError:
             print("Error occurred while making an appointment")
             conn.rollback()
             return
-    cm.close_connection()    
+        cm.close_connection()    
    
 
 def upload_availability(tokens):
     '''
-    This function lets caregivers to upload their availability to the database.
-    upload_availability <date>
+    This function lets caregivers to upload their availability to the database, optionally at a clinic site.
+    Without --hours the whole workday is offered; the hours are split into appointment slots as patients book them.
+    upload_availability <date> [--hours <HH:MM-HH:MM>] [--site <site_id>]
     '''
     
     #  check 1: check if the current logged-in user is a caregiver
-    global current_caregiver
-    if current_caregiver is None:
+    if session.caregiver is None:
         print("Please login as a caregiver first!")
         return
 
+    tokens, site_id = pop_option(tokens, "--site")
+    tokens, hours = pop_option(tokens, "--hours")
+
     # check 2: the length for tokens need to be exactly 2 to include all information (with the operation name)
-    if len(tokens) != 2:
+    if len(tokens) != 2 or site_id == "" or hours == "":
         print("Please try again!")
         return
 
+    try:
+        hours = SlotIndex.WORKDAY if hours is None else SlotIndex.parse_hours(hours)
+    except ValueError:
+        print("Please enter valid hours in the format of 'HH:MM-HH:MM'.")
+        return
+
+    # check 3: the site has to be registered first
+    if site_id is not None:
+        exists = site_exists(site_id)
+        if exists is None:
+            return
+        if not exists:
+            print("No such site exists. Please add it with add_site first.")
+            return
+
     date = tokens[1]
     # assume input is hyphenated in the format mm-dd-yyyy
     date_tokens = date.split("-")
@@ -513,12 +771,19 @@ def upload_availability(tokens):
     day = int(date_tokens[1])
     year = int(date_tokens[2])
     try:
-        d = datetime.datetime(year, month, day)
-        current_caregiver.upload_availability(d)
-    except pymssql.Error as e:
+        d = datetime.date(year, month, day)
+        # check 4: past dates are moved to the archive, so time can only be offered from today on
+        if d < datetime.date.today():
+            print("Please enter a date no earlier than today.")
+            return
+        session.caregiver.upload_availability(d, site_id, hours)
+    except DBError as e:
         print("Upload Availability Failed")
         print("Db-Error:", e)
-        quit()
+        return
+    except LookupError:
+        print("These hours overlap your availability or appointments on that date.")
+        return
     except ValueError:
         print("Please enter a valid date!")
         return
@@ -526,6 +791,7 @@ def upload_availability(tokens):
         print("Error occurred when uploading availability")
         print("Error:", e)
         return
+    Cache.caregivers_by_date.invalidate(d)
     print("Availability uploaded!")
 
 
@@ -535,21 +801,17 @@ def cancel(tokens):
     Both caregivers and patients are able to cancel the appointment using this function. 
     Both of the patient’s and caregiver’s schedules should reflect the change made when the appointment is canceled.
     The patients and caregivers can only cancel their own appointments.
-    cancel <appointment_id>
+    With --series, a patient releases every dose of the multi-dose series the appointment belongs to.
+    cancel <appointment_id> [--series]
     """
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-    
-
-    global current_caregiver
-    global current_patient
     
-    # Check 1: check if the token length is exactly 2. 
-    if len(tokens) != 2:
+    # Check 1: check if the token length is 2, or 3 with the series flag.
+    if len(tokens) not in (2, 3) or (len(tokens) == 3 and tokens[2] != "--series"):
         print("Please try again!")
         return
 
     appoint_id = tokens[1]
+    series = len(tokens) == 3
     
     # Check 2: Ensure that the specified appointment ID is the right type (integer).
     try:
@@ -559,29 +821,39 @@ def cancel(tokens):
         return
 
     # Check 3: Check if either a caregiver or patient is logged in.
-    if current_caregiver is None and current_patient is None:
+    if session.caregiver is None and session.patient is None:
         print("Please login first.")
         return
     
     # Identify the current user and set the requirement for cancelling appointment.  
-    elif current_caregiver:
-        req = f"Cname='{current_caregiver.username}'"
+    elif session.caregiver:
+        if series:
+            print("Only patients can cancel a whole series.")
+            return
+        appoint_details = ("appointment.get_for_caregiver", session.caregiver.username)
     else:
-        req = f"Pname='{current_patient.username}'"
-        
+        appoint_details = ("appointment.get_for_patient", session.patient.username)
+
+    # appointment IDs encode their shard, so the cancellation touches exactly one shard
+    cm = ShardRouter().for_appointment(appoint_id)
+    conn = cm.create_connection()
 
-    appoint_details = f"""SELECT AppointID, Time, Cname, Pname, Vname FROM Appointments
-                        WHERE AppointID = %d AND {req}"""
     try:
         try:
-            cursor = conn.cursor(as_dict=True)
-            cursor.execute(appoint_details, int(appoint_id))
-            details = cursor.fetchone()
-            date = details["Time"]
+            details = cm.first(appoint_details[0], (int(appoint_id), appoint_details[1]), as_dict=True)
             cname = details["Cname"]
             pname = details["Pname"]
             vname = details["Vname"]
+            appointments = [details]
+            # every dose of a series lives on the same shard as its first dose
+            if series and details["SeriesID"] is not None:
+                appointments = cm.execute("appointment.by_series", details["SeriesID"], as_dict=True).fetchall()
                       
+        except DBError as e:
+            print("Error occurred while looking up the appointment")
+            print("Db-Error:", e)
+            cm.close_connection()
+            return Idempotency.RETRY
         except:
             print("You do not have appointment scheduled with the specified appointment ID.")
             return
@@ -591,71 +863,199 @@ def cancel(tokens):
             print("You do not have appointment scheduled with the specified appointment ID.")   
         
         else:
-            # Cancel appointment and update the database.
-            delete_appoint = "DELETE FROM Appointments WHERE AppointID = %d"
+            # Cancel the appointments and give the caregivers their slots back in one transaction. The vaccines
+            # live on the home shard: when the appointments do too, their doses go back in that transaction,
+            # otherwise afterwards in a transaction of their own.
+            vaccine = Vaccine(vname, None)
+            lot_ids = [appointment["LotID"] for appointment in appointments]
+            doses_in_cancel = cm.shard == ShardRouter.HOME
             try:
-                cursor = conn.cursor(as_dict=True)
-                cursor.execute(delete_appoint, appoint_id)
-                # Update caregiver's availability
+                cancelled_at = datetime.datetime.now()
+                for appointment in appointments:
+                    cm.execute("appointment.delete", appointment["AppointID"])
+                    # kept for the cancellation rates in report
+                    cm.execute("cancellation.insert", (appointment["AppointID"], appointment["Time"], appointment["Cname"],
+                                                       appointment["Pname"], appointment["Vname"], cancelled_at))
+                # Give the caregivers their time slots back
                 try:
-                    add_avail = "INSERT INTO Availabilities VALUES (%s, %s)"
-                    cursor = conn.cursor(as_dict=True)
-                    cursor.execute(add_avail, (date.strftime("%Y-%m-%d"), cname))
-                    conn.commit()
+                    slots = SlotIndex.SlotIndex(cm)
+                    for appointment in appointments:
+                        slots.release(appointment["Time"], appointment["Cname"], appointment["StartMinute"], appointment["EndMinute"],
+                                      appointment["SiteID"])
                 except:
                     print('Attempt to update availability of caregiver failed.')
                     conn.rollback()
                     cm.close_connection()
-                    return
-            except pymssql.Error as e:
+                    return Idempotency.RETRY
+                # each dose goes back to the lot it was allocated from
+                if doses_in_cancel:
+                    try:
+                        vaccine.put_back_doses(cm, lot_ids)
+                    except DBError as e:
+                        print("Updating vaccine doses failed.")
+                        print("Db-Error:", e)
+                        conn.rollback()
+                        cm.close_connection()
+                        return Idempotency.RETRY
+                conn.commit()
+                for appointment in appointments:
+                    Cache.caregivers_by_date.invalidate(appointment["Time"])
+                Reminders.reminders.remove([appointment["AppointID"] for appointment in appointments])
+            except DBError as e:
                 print("Updating Availability Failed")
-
-            # Update vaccine information
-            try:
-                v_info = get_vaccine_info()
-                vaccine = Vaccine(vname, v_info.get(vname)).get()
-                vaccine.increase_available_doses(1)
-
-            except:
-                print("Updating vaccine doses failed.")
+                print("Db-Error:", e)
                 conn.rollback()
                 cm.close_connection()
-                return
-    except pymssql.Error:
+                return Idempotency.RETRY
+
+            if not doses_in_cancel:
+                try:
+                    vaccine.return_doses(lot_ids)
+                except DBError:
+                    print("Updating vaccine doses failed.")
+                    cm.close_connection()
+                    return
+            Cache.vaccine_stock.invalidate(vname)
+    except DBError:
         print("Error occurred while cancelling appointment")
         cm.close_connection()
         return
 
-    print("You have successfully cancelled your appointment.")
+    if len(appointments) > 1:
+        print(f"You have successfully cancelled all {len(appointments)} appointments of the series.")
+    else:
+        print("You have successfully cancelled your appointment.")
     cm.close_connection()    
 
 
+def reassign_caregiver(tokens):
+    '''
+    This function lets caregivers move every appointment a caregiver has on the given date, or between the
+    two dates, to other caregivers free at the same time on the same day at the same site. The caregiver's
+    remaining availability in that period is withdrawn. Appointments keep their ID, date, time, site and vaccine
+    dose; those that cannot be moved are listed.
+    reassign_caregiver <username> <date> [<to_date>]
+    '''
+
+    #  check 1: check if the current logged-in user is a caregiver
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    #  check 2: the length for tokens need to be 3, or 4 with the end of the range
+    if len(tokens) not in (3, 4):
+        print("Please try again!")
+        return
+
+    username = tokens[1]
+    try:
+        # assume input is hyphenated in the format mm-dd-yyyy
+        first, last = [datetime.date(int(t[2]), int(t[0]), int(t[1])) for t in (tokens[2].split("-"), tokens[-1].split("-"))]
+    except (ValueError, IndexError):
+        print("Please enter valid dates in the format of 'MM-DD-YYYY'.")
+        return
+    if last < first:
+        print("The end date must not be before the start date.")
+        return
+
+    # Appointment IDs encode their shard, so appointments are only handed to caregivers on the same shard.
+    cm = ShardRouter().for_caregiver(username)
+    conn = cm.create_connection()
+    reassigned = []
+    unassigned = []
+    try:
+        # match every appointment at once, then apply the matches in one transaction
+        slots = SlotIndex.SlotIndex(cm)
+        matches = cm.execute("appointment.reassign_matches", (username, first, last, username), as_dict=True).fetchall()
+        for match in matches:
+            d, start, end = match["Time"], match["StartMinute"], match["EndMinute"]
+            if match["Username"] is None:
+                unassigned.append(match)
+                continue
+            try:
+                slots.book(d, match["Username"], start, end)
+            except LookupError:
+                # a concurrent booking may have taken the slot since it was matched
+                unassigned.append(match)
+                continue
+            # a concurrent cancellation may have removed the appointment; its slot is given back
+            if cm.execute("appointment.reassign", (match["Username"], match["AppointID"], username)).rowcount != 1:
+                slots.release(d, match["Username"], start, end, match["SiteID"])
+            else:
+                reassigned.append(match)
+        cm.execute("availability.delete_between", (username, first, last))
+        conn.commit()
+    except DBError as e:
+        print("Reassigning appointments failed")
+        print("Db-Error:", e)
+        conn.rollback()
+        cm.close_connection()
+        return
+    cm.close_connection()
+    # the caregiver's availability is gone from every day of the range
+    for k in range(last.toordinal() - first.toordinal() + 1):
+        Cache.caregivers_by_date.invalidate(first + datetime.timedelta(days=k))
+
+    for match, moved in [(match, True) for match in reassigned] + [(match, False) for match in unassigned]:
+        when = f"{match['Time'].strftime('%m-%d-%Y')} at {SlotIndex.format_time(match['StartMinute'])}"
+        if moved:
+            text = f"Appointment {match['AppointID']} on {when} is now with caregiver {match['Username']}"
+        else:
+            text = f"Appointment {match['AppointID']} on {when} could not be reassigned; no other caregiver is available at its site."
+        Output.record("reassignment", text, appoint_id=match['AppointID'], date=match['Time'], time=SlotIndex.format_time(match['StartMinute']),
+                      caregiver=match['Username'], reassigned=moved)
+    print(f"Reassigned {len(reassigned)} of {len(reassigned) + len(unassigned)} appointments.")
+
+
 def add_doses(tokens):
     '''
     This function allows caregivers to increase the number of vaccine doses.
-    add_doses <vaccine> <number>    
+    The doses belong to the given lot, which expires on the given date; without a lot they never expire.
+    A new lot can be stocked at a clinic site.
+    add_doses <vaccine> <number> [<lot_id> <expiry_date>] [--site <site_id>]
     '''
 
     #  check 1: check if the current logged-in user is a caregiver
-    global current_caregiver
-    if current_caregiver is None:
+    if session.caregiver is None:
         print("Please login as a caregiver first!")
         return
 
-    #  check 2: the length for tokens need to be exactly 3 to include all information (with the operation name)
-    if len(tokens) != 3:
+    tokens, site_id = pop_option(tokens, "--site")
+
+    #  check 2: the length for tokens need to be 3, or 5 with the lot and its expiry date
+    if len(tokens) not in (3, 5) or site_id == "":
         print("Please try again!")
         return
 
+    #  check 3: the site has to be registered first
+    if site_id is not None:
+        exists = site_exists(site_id)
+        if exists is None:
+            return
+        if not exists:
+            print("No such site exists. Please add it with add_site first.")
+            return
+
     vaccine_name = tokens[1]
     doses = int(tokens[2])
+    lot_id = None
+    expiry = None
+    if len(tokens) == 5:
+        lot_id = tokens[3]
+        try:
+            # assume input is hyphenated in the format mm-dd-yyyy
+            date_tokens = tokens[4].split("-")
+            expiry = datetime.date(int(date_tokens[2]), int(date_tokens[0]), int(date_tokens[1]))
+        except (ValueError, IndexError):
+            print("Please enter a valid expiry date in the format of 'MM-DD-YYYY'.")
+            return
     vaccine = None
     try:
         vaccine = Vaccine(vaccine_name, doses).get()
-    except pymssql.Error as e:
+    except DBError as e:
         print("Failed to get Vaccine information")
         print("Db-Error:", e)
-        quit()
+        return Idempotency.RETRY
     except Exception as e:
         print("Failed to get Vaccine information")
         print("Error:", e)
@@ -666,11 +1066,11 @@ def add_doses(tokens):
     if vaccine is None:
         vaccine = Vaccine(vaccine_name, doses)
         try:
-            vaccine.save_to_db()
-        except pymssql.Error as e:
+            vaccine.save_to_db(lot_id, expiry, site_id)
+        except DBError as e:
             print("Failed to add new Vaccine to database")
             print("Db-Error:", e)
-            quit()
+            return Idempotency.RETRY
         except Exception as e:
             print("Failed to add new Vaccine to database")
             print("Error:", e)
@@ -678,79 +1078,188 @@ def add_doses(tokens):
     else:
         # if the vaccine is not null, meaning that the vaccine already exists in our table
         try:
-            vaccine.increase_available_doses(doses)
-        except pymssql.Error as e:
+            vaccine.increase_available_doses(doses, lot_id, expiry, site_id)
+        except DBError as e:
             print("Failed to increase available doses for Vaccine")
             print("Db-Error:", e)
-            quit()
+            return Idempotency.RETRY
         except Exception as e:
             print("Failed to increase available doses for Vaccine")
             print("Error:", e)
             return
+    # a new vaccine also changes the list of vaccine names
+    Cache.vaccine_stock.invalidate(vaccine_name)
+    Cache.vaccine_stock.invalidate(Cache.VACCINE_NAMES)
     print("Doses updated!")
 
 
+def add_site(tokens):
+    '''
+    This function allows caregivers to register a clinic site by its coordinates in degrees.
+    Availabilities and vaccine lots can then be placed at the site with --site.
+    add_site <site_id> <latitude> <longitude>
+    '''
+
+    #  check 1: check if the current logged-in user is a caregiver
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    #  check 2: the length for tokens need to be exactly 4 to include all information (with the operation name)
+    if len(tokens) != 4:
+        print("Please try again!")
+        return
+
+    site_id = tokens[1]
+    try:
+        latitude = float(tokens[2])
+        longitude = float(tokens[3])
+    except ValueError:
+        latitude = longitude = math.nan
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        print("Please enter a latitude between -90 and 90 and a longitude between -180 and 180.")
+        return
+
+    exists = site_exists(site_id)
+    if exists is None:
+        return
+    if exists:
+        print("Site already exists, try again!")
+        return
+
+    cm = ShardRouter().home()
+    conn = cm.create_connection()
+    try:
+        cm.execute("site.insert", (site_id, latitude, longitude))
+        conn.commit()
+    except DBIntegrityError:
+        print("Site already exists, try again!")
+        return
+    except DBError as e:
+        print("Failed to add site")
+        print("Db-Error:", e)
+        return
+    finally:
+        cm.close_connection()
+    SiteIndex.sites.add(site_id, latitude, longitude)
+    print("Site added!")
+
+
+def set_regimen(tokens):
+    '''
+    This function allows caregivers to set how many doses a vaccine takes and the allowed
+    number of days between consecutive doses. reserve then books the whole series at once.
+    set_regimen <vaccine> <doses> <min_interval_days> <max_interval_days>
+    '''
+
+    #  check 1: check if the current logged-in user is a caregiver
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    #  check 2: the length for tokens need to be exactly 5 to include all information (with the operation name)
+    if len(tokens) != 5:
+        print("Please try again!")
+        return
+
+    vaccine_name = tokens[1]
+    try:
+        vaccine = Vaccine(vaccine_name, None).get()
+        if vaccine is None:
+            print("No such vaccine exists. Please add doses for it first.")
+            return
+        vaccine.set_regimen(int(tokens[2]), int(tokens[3]), int(tokens[4]))
+    except DBError as e:
+        print("Failed to update vaccine regimen")
+        print("Db-Error:", e)
+        return
+    except ValueError as e:
+        print("Please enter a positive number of doses and intervals in days.")
+        return
+    except Exception as e:
+        print("Failed to update vaccine regimen")
+        print("Error:", e)
+        return
+    print("Regimen updated!")
+
+
 def show_appointments(tokens):
     '''
     This function outputs the scheduled appointment information for the current user (either a patient or a caregivers). 
-    For caregivers, the appointment ID, vaccine name, date, and patient username are printed.
-    For patients, the appointment ID, vaccine name, date, and caregiver username are printed.
-    show_appointments
+    For caregivers, the appointment ID, vaccine name, date, time, and patient username are printed.
+    For patients, the appointment ID, vaccine name, date, time, and caregiver username are printed.
+    With --history, archived past appointments are included as well.
+    show_appointments [--history]
     '''
-    global current_caregiver
-    global current_patient
     
     # Check 1: Check if either a caregiver or a patient is logged in. 
-    if current_caregiver is None and current_patient is None:
+    if session.caregiver is None and session.patient is None:
         print("Please log-in first")
         return
 
-    # Check 2: the length for tokens need to be exactly 1.
-    if len(tokens) != 1:
+    # Check 2: the length for tokens need to be 1, or 2 when the history flag is given.
+    if len(tokens) > 2 or (len(tokens) == 2 and tokens[1] != "--history"):
         print("Please try again!")
         return
-
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-    cursor = conn.cursor(as_dict=True)
+    history = len(tokens) == 2
    
     # For caregivers, appointment ID, vaccine name, date, patient name should be printed.
-    if current_caregiver:
+    if session.caregiver:
+        cm = ShardRouter().for_caregiver(session.caregiver.username)
+        conn = cm.create_connection()
         try:
-           c_appoint = "SELECT * FROM Appointments WHERE Cname = %s"
-           cursor.execute(c_appoint, current_caregiver.username)
-           if cursor.rowcount == 0:
+           if history:
+               cursor = cm.execute("appointment.history_by_caregiver", (session.caregiver.username, session.caregiver.username), as_dict=True)
+           else:
+               cursor = cm.execute("appointment.by_caregiver", session.caregiver.username, as_dict=True)
+           rows = cursor.fetchall()
+           if len(rows) == 0:
               print('No appointment has been scheduled.')                               
            else:
-                for row in cursor:
-                    print('Appointment ID:', row['AppointID'], '\nVaccine Name:', row['Vname'], '\nAppointment Date:', row['Time'],
-                          '\nPatient Name:', row['Pname'], '\n')
+                for row in rows:
+                    time = SlotIndex.format_time(row['StartMinute'])
+                    Output.record("appointment", Output.line('Appointment ID:', row['AppointID'], '\nVaccine Name:', row['Vname'],
+                                                             '\nAppointment Date:', row['Time'], '\nAppointment Time:', time,
+                                                             '\nPatient Name:', row['Pname'], '\n'),
+                                  appoint_id=row['AppointID'], date=row['Time'], time=time, vaccine=row['Vname'], patient=row['Pname'])
               
-        except pymssql.Error as e:
+        except DBError as e:
             print("Appointment Confirmation Failed")
             print("Db-Error:", e)
-            quit()
+            return
         except Exception as e:
             print("Failed to retrieve appointment information.")
             return
+        finally:
+            cm.close_connection()
 
     # For patients, appointment ID, vaccine name, date, caregiver name should be printed.
-    elif current_patient:
+    # A patient's appointments may be spread over every shard, so they are gathered in parallel.
+    elif session.patient:
+        username = session.patient.username
         try:
-            p_appoint = "SELECT * FROM Appointments WHERE Pname = %s"
-            cursor.execute(p_appoint, current_patient.username)
-            if cursor.rowcount == 0:
+            if history:
+                shards = ShardRouter().fan_out(
+                    lambda shard_cm: shard_cm.execute("appointment.history_by_patient", (username, username), as_dict=True).fetchall())
+            else:
+                shards = ShardRouter().fan_out(
+                    lambda shard_cm: shard_cm.execute("appointment.by_patient", username, as_dict=True).fetchall())
+            rows = sorted((row for rows in shards for row in rows), key=lambda row: (row['Time'], row['StartMinute'], row['AppointID']))
+            if len(rows) == 0:
                 print('No appointment has been scheduled.')
                 return
             else:
-                for row in cursor:
-                    print('Appointment ID:', row['AppointID'], '\nVaccine Name:', row['Vname'], '\nAppointment Date:', row['Time'],
-                          '\nCaregiver Name:', row['Cname'], '\n')
-
-        except pymssql.Error as e:
+                for row in rows:
+                    time = SlotIndex.format_time(row['StartMinute'])
+                    Output.record("appointment", Output.line('Appointment ID:', row['AppointID'], '\nVaccine Name:', row['Vname'],
+                                                             '\nAppointment Date:', row['Time'], '\nAppointment Time:', time,
+                                                             '\nCaregiver Name:', row['Cname'], '\n'),
+                                  appoint_id=row['AppointID'], date=row['Time'], time=time, vaccine=row['Vname'], caregiver=row['Cname'])
+
+        except DBError as e:
             print("Appointment Confirmation Failed")
             print("Db-Error:", e)
-            quit()
+            return
         except Exception as e:
             print("Failed to retrieve appointment information.")
             return
@@ -758,49 +1267,256 @@ def show_appointments(tokens):
     else:
         print("Error occurred when confirming appointment. Please try again.")
         return
+
+
+def archive(tokens):
+    '''
+    This function lets caregivers move availabilities and appointments dated before the given date
+    into the archive tables. Rows are moved in batches so the hot tables are only briefly locked.
+    The date may not be after today.
+    archive <date> [batch_size]
+    '''
+
+    #  check 1: check if the current logged-in user is a caregiver
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    #  check 2: the length for tokens need to be 2 or 3 (with the optional batch size)
+    if len(tokens) not in (2, 3):
+        print("Please try again!")
+        return
+
+    try:
+        # assume input is hyphenated in the format mm-dd-yyyy
+        date_tokens = tokens[1].split("-")
+        month = int(date_tokens[0])
+        day = int(date_tokens[1])
+        year = int(date_tokens[2])
+        cutoff = datetime.date(year, month, day)
+        # check 3: only past rows can be archived
+        if cutoff > datetime.date.today():
+            print("Please enter a date no later than today; future appointments and availabilities are still active.")
+            return
+        batch_size = int(tokens[2]) if len(tokens) == 3 else 1000
+        moved = Archiver(cutoff, batch_size).run()
+        Cache.caregivers_by_date.clear()
+    except DBError as e:
+        print("Archiving failed")
+        print("Db-Error:", e)
+        return
+    except (ValueError, IndexError):
+        print("Please enter a valid date in the format of 'MM-DD-YYYY' and a positive batch size.")
+        return
+    except Exception as e:
+        print("Error occurred when archiving")
+        print("Error:", e)
+        return
+    print("Archived", moved["availabilities"], "availabilities and", moved["appointments"], "appointments.")
           
 
 
+def report(tokens):
+    '''
+    This function lets caregivers see, for appointments dated between the two dates, each caregiver's
+    utilization (booked out of offered slots), the doses administered per vaccine per day and the
+    cancellation rate per vaccine. With --refresh, a saved snapshot is rebuilt from the database.
+    report <from_date> <to_date> [--refresh]
+    '''
+
+    #  check 1: check if the current logged-in user is a caregiver
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    #  check 2: the length for tokens need to be 3, or 4 with the refresh flag
+    if len(tokens) not in (3, 4) or (len(tokens) == 4 and tokens[3] != "--refresh"):
+        print("Please try again!")
+        return
+
+    if not Snapshot.available():
+        print("The report command requires NumPy. Please install numpy first.")
+        return
+
+    try:
+        # assume input is hyphenated in the format mm-dd-yyyy
+        first, last = [datetime.date(int(t[2]), int(t[0]), int(t[1])) for t in (tokens[1].split("-"), tokens[2].split("-"))]
+    except (ValueError, IndexError):
+        print("Please enter valid dates in the format of 'MM-DD-YYYY'.")
+        return
+    if last < first:
+        print("The end date must not be before the start date.")
+        return
+
+    try:
+        snapshot = Snapshot.current(refresh=len(tokens) == 4)
+    except DBError as e:
+        print("Failed to load report data")
+        print("Db-Error:", e)
+        return
+    except OSError as e:
+        print("Failed to save the report snapshot")
+        print("Error:", e)
+        return
+
+    Output.heading("Caregiver utilization:")
+    for caregiver, booked, offered in snapshot.utilization(first, last):
+        Output.record("utilization", f"{caregiver}: {booked} of {offered} slots booked ({booked / offered:.1%})",
+                      caregiver=caregiver, booked=booked, offered=offered)
+    Output.heading("Doses administered:")
+    for d, vaccine, doses in snapshot.doses_per_day(first, last):
+        Output.record("doses", Output.line(d.strftime("%m-%d-%Y"), vaccine, doses), date=d, vaccine=vaccine, doses=doses)
+    Output.heading("Cancellation rates:")
+    for vaccine, cancelled, booked in snapshot.cancellation_rates(first, last):
+        Output.record("cancellations", f"{vaccine}: {cancelled} of {booked} appointments cancelled ({cancelled / booked:.1%})",
+                      vaccine=vaccine, cancelled=cancelled, booked=booked)
+
+
+def forecast(tokens):
+    '''
+    This function lets caregivers see, for every vaccine, the recent booking rates and the projected
+    number of days until its available doses run out.
+    forecast
+    '''
+
+    #  check 1: check if the current logged-in user is a caregiver
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    #  check 2: the length for tokens need to be exactly 1
+    if len(tokens) != 1:
+        print("Please try again!")
+        return
+
+    try:
+        rows = Forecast.forecast(get_vaccine_stock())
+    except DBError as e:
+        print("Failed to load forecast data")
+        print("Db-Error:", e)
+        return
+
+    if len(rows) == 0:
+        print("No vaccine has been added yet.")
+    for name, doses, rates, ahead, left in rows:
+        rate_text = ", ".join(f"{w}-day rate {rates[w]:.1f}/day" for w in sorted(rates))
+        if math.isinf(left):
+            outlook = "no recent bookings"
+        else:
+            runs_out = datetime.date.today() + datetime.timedelta(days=math.floor(left))
+            outlook = f"runs out in about {left:.1f} days ({runs_out.strftime('%m-%d-%Y')})"
+        Output.record("forecast", f"{name}: {doses} doses left, {rate_text}, {ahead} booked ahead, {outlook}",
+                      vaccine=name, doses=doses, **{f"rate_{w}d": round(rates[w], 3) for w in sorted(rates)},
+                      booked_ahead=ahead, days_left=None if math.isinf(left) else round(left, 1))
+
+
+def show_stats(tokens):
+    '''
+    This function outputs the schedule search cache counters, the reminder worker's counters, the
+    admission counters and queues, the group commit counters and the per-query execution statistics
+    collected by this process.
+    show_stats
+    '''
+    if len(tokens) != 1:
+        print("Please try again!")
+        return
+
+    for name, cache in (("Caregiver cache", Cache.caregivers_by_date), ("Vaccine stock cache", Cache.vaccine_stock)):
+        stats = cache.stats()
+        Output.record("cache", f"{name}: {stats['hits']} hits, {stats['misses']} misses, {stats['size']} entries, "
+                               f"{stats['dropped_fills']} stale fills dropped",
+                      name=name, hits=stats['hits'], misses=stats['misses'], size=stats['size'],
+                      dropped_fills=stats['dropped_fills'])
+    if Reminders.enabled():
+        stats = Reminders.reminders.stats()
+        Output.record("reminders", f"Reminders: {stats['pending']} pending, {stats['queued']} queued to the outbox",
+                      pending=stats['pending'], queued=stats['queued'])
+    if Admission.enabled():
+        for command, stats in sorted(Admission.admission.stats().items()):
+            Output.record("admission", f"Admission {command}: {stats['admitted']} admitted, {stats['shed']} shed, "
+                                       f"avg wait {stats['avg_wait_seconds'] * 1000:.2f} ms, "
+                                       f"max wait {stats['max_wait_seconds'] * 1000:.2f} ms",
+                          command=command, admitted=stats['admitted'], shed=stats['shed'],
+                          avg_wait_ms=round(stats['avg_wait_seconds'] * 1000, 3),
+                          max_wait_ms=round(stats['max_wait_seconds'] * 1000, 3))
+        try:
+            queues = Admission.admission.queue()
+        except DBError as e:
+            print("Failed to read the admission queues")
+            print("Db-Error:", e)
+            queues = {}
+        for command, (waiting, running, oldest) in sorted(queues.items()):
+            Output.record("admission_queue", f"Admission queue {command}: {waiting} waiting, {running} running, "
+                                             f"oldest waiting {oldest:.2f} s",
+                          command=command, waiting=waiting, running=running, oldest_wait_s=round(oldest, 3))
+    for shard, stats in sorted(GroupCommit.stats().items()):
+        Output.record("group_commit", f"Group commit shard {shard}: {stats['operations']} operations in {stats['groups']} commits, "
+                                      f"largest group {stats['largest']}",
+                      shard=shard, operations=stats['operations'], commits=stats['groups'], largest=stats['largest'])
+    for name, stats in sorted(Queries.stats().items()):
+        Output.record("query", f"Query {name}: {stats['count']} runs, {stats['errors']} errors, "
+                               f"avg {stats['avg_seconds'] * 1000:.2f} ms, max {stats['max_seconds'] * 1000:.2f} ms",
+                      name=name, count=stats['count'], errors=stats['errors'],
+                      avg_ms=round(stats['avg_seconds'] * 1000, 3), max_ms=round(stats['max_seconds'] * 1000, 3))
+
+
 def logout(tokens):
     """
     This function allows the current user to log out.
     """
-    global current_caregiver
-    global current_patient
 
     # If caregiver is logged in:
-    if current_caregiver is not None:
-        current_caregiver = None
+    if session.caregiver is not None:
+        session.caregiver = None
         print("You have been successfully logged out!")
         return
 
     # If patient is logged in:
-    if current_patient is not None:
-        current_patient = None
+    if session.patient is not None:
+        session.patient = None
         print("You have been successfully logged out!!")
         return
 
 
 def start():
+    # commands are recorded to a trace file when TraceFile is set
+    recorder = Trace.from_env()
+    # reminders are queued in the background when ReminderWorker is set
+    if Reminders.enabled():
+        try:
+            Reminders.reminders.start()
+        except DBError as e:
+            # the scheduler still works, only without reminders from this process
+            print("Failed to load appointment reminders")
+            print("Db-Error:", e)
     stop = False
     while not stop:
-        print()
-        print(" *** Please enter one of the following commands *** ")
-        print("> create_patient <username> <password>")  
-        print("> create_caregiver <username> <password>")
-        print("> login_patient <username> <password>")  
-        print("> login_caregiver <username> <password>")
-        print("> search_caregiver_schedule <date>")  
-        print("> reserve <date> <vaccine>") 
-        print("> upload_availability <date>")
-        print("> cancel <appointment_id>") 
-        print("> add_doses <vaccine> <number>")
-        print("> show_appointments")  
-        print("> logout") 
-        print("> Quit")
-        print()
-        response = ""
-        print("> Enter: ", end='')
+        # scripts reading json or tsv get no menu or prompt
+        if Output.human():
+            print()
+            print(" *** Please enter one of the following commands *** ")
+            print("> create_patient <username> <password>")  
+            print("> create_caregiver <username> <password>")
+            print("> login_patient <username> <password>")  
+            print("> login_caregiver <username> <password>")
+            print("> search_caregiver_schedule <date> [--near <lat,lon> [--radius <km>]]")  
+            print("> reserve <date> <vaccine> [--at <HH:MM>] [--site <site_id>] [--key <key>]")
+            print("> upload_availability <date> [--hours <HH:MM-HH:MM>] [--site <site_id>]")
+            print("> cancel <appointment_id> [--series] [--key <key>]")
+            print("> reassign_caregiver <username> <date> [<to_date>]")
+            print("> add_doses <vaccine> <number> [<lot_id> <expiry_date>] [--site <site_id>] [--key <key>]")
+            print("> add_site <site_id> <latitude> <longitude>")
+            print("> set_regimen <vaccine> <doses> <min_interval_days> <max_interval_days>")
+            print("> show_appointments [--history]")
+            print("> archive <date> [batch_size]")
+            print("> report <from_date> <to_date> [--refresh]")
+            print("> forecast")
+            print("> show_stats")
+            print("> logout") 
+            print("> Quit")
+            print()
+            response = ""
+            print("> Enter: ", end='')
 
         try:
             response = str(input())
@@ -814,39 +1530,158 @@ def start():
             ValueError("Try Again")
             continue
         operation = tokens[0]
-        if operation == "create_patient":
-            create_patient(tokens)
-        elif operation == "create_caregiver":
-            create_caregiver(tokens)
-        elif operation == "login_patient":
-            login_patient(tokens)
-        elif operation == "login_caregiver":
-            login_caregiver(tokens)
-        elif operation == "search_caregiver_schedule":
-            search_caregiver_schedule(tokens)
-        elif operation == "reserve":
-            reserve(tokens)
-        elif operation == "upload_availability":
-            upload_availability(tokens)
-        elif operation == "cancel":
-            cancel(tokens)
-        elif operation == "add_doses":
-            add_doses(tokens)
-        elif operation == "show_appointments":
-            show_appointments(tokens)
-        elif operation == "logout":
-            logout(tokens)
-        elif operation == "quit":
-            print("Thank you for using the scheduler, Goodbye!")
-            stop = True
+        if recorder is None:
+            stop = not Output.current().run(run_safely, operation, tokens)
         else:
-            print("Invalid Argument")
+            stop = not recorder.run(lambda op, t: Output.current().run(run_safely, op, t), operation, tokens)
+    if recorder is not None:
+        recorder.close()
+    if Reminders.enabled():
+        Reminders.reminders.stop()
+    if Admission.enabled():
+        Admission.admission.close()
+
+
+def run_idempotent(command, tokens):
+    '''
+    This function runs a command that changes bookings or stock, which may carry an idempotency key.
+    The first run with a key stores what the command reported; running it again with the same key
+    reports that again instead of repeating the change. Only a command that returns Idempotency.RETRY,
+    having failed before committing anything, gives its key up.
+    <command> ... [--key <key>]
+    '''
+    tokens, key = pop_option(tokens, "--key")
+    user = session.patient or session.caregiver
+    # without a key, or without a user to keep keys for (which the command reports), it just runs
+    if key is None or user is None:
+        command(tokens)
+        return
+
+    if key == "" or len(key) > Idempotency.MAX_KEY_LENGTH:
+        print(f"Please enter an idempotency key of at most {Idempotency.MAX_KEY_LENGTH} characters.")
+        return
+
+    owner = ("caregiver:" if session.caregiver else "patient:") + user.username
+    request = " ".join(tokens)
+    try:
+        stored = Idempotency.claim(owner, key, request)
+    except DBError as e:
+        print("Error occurred when checking the idempotency key")
+        print("Db-Error:", e)
+        return
+
+    if stored is not None:
+        if stored.request != request:
+            print("This idempotency key was already used for a different request.")
+        elif stored.result is None:
+            print("A request with this idempotency key is still in progress. Please retry later.")
+        else:
+            Output.Transcript.from_json(stored.result).replay()
+        return
+
+    # an error escaping the command leaves the key claimed: the command may have committed, so a
+    # retry only runs again once the claim has expired
+    with Output.transcript() as transcript:
+        status = command(tokens)
+
+    # a run that failed before committing anything changed nothing, so a retry may run it again
+    if status == Idempotency.RETRY:
+        try:
+            Idempotency.forget(owner, key)
+        except DBError as e:
+            print("Error occurred when releasing the idempotency key")
+            print("Db-Error:", e)
+        return
+
+    # any other run keeps its key, even when its result is too long to keep
+    result = transcript.to_json()
+    if len(result) > Idempotency.MAX_RESULT_LENGTH:
+        result = Output.Transcript([["message", "This request was completed, but its result is too long to report again."]]).to_json()
+    try:
+        Idempotency.complete(owner, key, result)
+    except DBError as e:
+        print("Error occurred when saving the result of the request. Please do not retry it with this key.")
+        print("Db-Error:", e)
+
+
+def run_safely(operation, tokens):
+    '''
+    This function runs one command like run_command, but a database error that the command does not
+    handle itself ends that command instead of the session. With AdmissionControl set, the command
+    first waits for admission and may be turned away with a time to retry after.
+    '''
+    try:
+        if not Admission.enabled():
+            return run_command(operation, tokens)
+        with Admission.admission.admit(operation):
+            return run_command(operation, tokens)
+    except Admission.Overloaded as e:
+        Output.record("busy", f"The scheduler is busy, please retry after {e.retry_after} seconds.",
+                      command=e.command, retry_after=e.retry_after)
+        return True
+    except DBError as e:
+        print("Db-Error:", e)
+        return True
+
+
+def run_command(operation, tokens):
+    '''
+    This function dispatches one command. It returns False once the user quits.
+    '''
+    if operation == "create_patient":
+        create_patient(tokens)
+    elif operation == "create_caregiver":
+        create_caregiver(tokens)
+    elif operation == "login_patient":
+        login_patient(tokens)
+    elif operation == "login_caregiver":
+        login_caregiver(tokens)
+    elif operation == "search_caregiver_schedule":
+        search_caregiver_schedule(tokens)
+    elif operation == "reserve":
+        run_idempotent(reserve, tokens)
+    elif operation == "upload_availability":
+        upload_availability(tokens)
+    elif operation == "cancel":
+        run_idempotent(cancel, tokens)
+    elif operation == "reassign_caregiver":
+        reassign_caregiver(tokens)
+    elif operation == "add_doses":
+        run_idempotent(add_doses, tokens)
+    elif operation == "add_site":
+        add_site(tokens)
+    elif operation == "set_regimen":
+        set_regimen(tokens)
+    elif operation == "show_appointments":
+        show_appointments(tokens)
+    elif operation == "archive":
+        archive(tokens)
+    elif operation == "report":
+        report(tokens)
+    elif operation == "forecast":
+        forecast(tokens)
+    elif operation == "show_stats":
+        show_stats(tokens)
+    elif operation == "logout":
+        logout(tokens)
+    elif operation == "quit":
+        print("Thank you for using the scheduler, Goodbye!")
+        return False
+    else:
+        print("Invalid Argument")
+    return True
 
 
 if __name__ == "__main__":
-    
+    parser = argparse.ArgumentParser(description="Vaccine scheduling command line.")
+    parser.add_argument("--format", choices=Output.FORMATS, default="human",
+                        help="human-readable output, or one json object / tsv block per command for scripts")
+    args = parser.parse_args()
+    Output.configure(args.format)
+
     # start command line
-    print()
-    print("Welcome to the COVID-19 Vaccine Reservation Scheduling Application!")
+    if Output.human():
+        print()
+        print("Welcome to the COVID-19 Vaccine Reservation Scheduling Application!")
 
     start()
@@ -0,0 +1,315 @@
+'''
+Admission control in front of command execution, for bursts such as registration opening for a new
+age group, when every client sends reserve at once.
+The sessions of a process are threads (see Session in Scheduler.py), so they queue in the process
+itself: a priority heap of waiting tickets under one condition, with a count of running commands per
+command type. A command takes a ticket, waits until it is admitted and gives its slot back when it
+has finished:
+
+    slots     each command type runs at most AdmissionLimits of its own at a time (e.g.
+              "reserve=8,search_caregiver_schedule=16"), and at most AdmissionTotal commands run in all
+    priority  when slots free up, caregiver operations go first, then bookings, then searches and
+              listings, then reports; within a priority tickets are admitted in arrival order, and a
+              ticket whose command has no free slot does not hold up those behind it
+    shedding  a command is turned away with a "retry after" answer at once when the queue ahead of it
+              has been waiting for a quarter of AdmissionMaxWait seconds; a queued command gives up after
+              that quarter too unless it is next in line for one of its command's slots, and in any
+              case once its own wait reaches AdmissionMaxWait
+
+Waiting costs the database nothing. With AdmissionControl=shared the slots of each command type are
+also capped across processes, in the AdmissionSlots table on the home shard: an admitted command
+claims a row with a single conditional insert and deletes it when it has finished, and a command that
+finds no shared slot free is turned away at once instead of polling. A claimed row expires after
+AdmissionLease seconds, so the slots of a crashed process come back by themselves. Commands that do
+not touch the schedule, such as login, logout and show_stats, are never queued.
+'''
+
+from db.ConnectionManager import ConnectionManager, DBError
+from db.ShardRouter import ShardRouter
+import os
+import math
+import time
+import uuid
+import heapq
+import itertools
+import threading
+import contextlib
+
+# lower runs first
+PRIORITIES = {
+    "upload_availability": 0, "reassign_caregiver": 0, "add_doses": 0, "add_site": 0, "set_regimen": 0,
+    "reserve": 1, "cancel": 1,
+    "search_caregiver_schedule": 2, "show_appointments": 2,
+    "report": 3, "forecast": 3, "archive": 3,
+}
+DEFAULT_SLOTS = {"reserve": 8, "cancel": 4, "search_caregiver_schedule": 16, "show_appointments": 8,
+                 "report": 2, "forecast": 2, "archive": 1}
+OTHER_SLOTS = 4
+# a queue that has not moved for this fraction of the maximum wait is taken as overloaded
+SHED_FRACTION = 0.25
+
+
+def parse_limits(text):
+    '''
+    Returns {command: slots} for limits given as command=slots,command=slots.
+    '''
+    limits = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        command, sep, slots = item.partition("=")
+        if not sep or not slots.strip().isdigit() or int(slots) <= 0:
+            raise ValueError(f"Invalid admission limit '{item}', expected command=slots")
+        limits[command.strip().lower()] = int(slots)
+    return limits
+
+
+class Overloaded(Exception):
+    '''
+    A command was turned away by admission control; retry_after is the suggested wait in seconds.
+    '''
+    def __init__(self, command, retry_after):
+        super().__init__(command, retry_after)
+        self.command = command
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return f"{self.command} was not admitted, retry after {self.retry_after} s"
+
+
+class AdmissionStats:
+    def __init__(self):
+        self.admitted = 0
+        self.shed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self):
+        return {
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "avg_wait_seconds": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_wait_seconds": self.max_wait,
+        }
+
+
+class Ticket:
+    def __init__(self, command, priority, arrival):
+        self.command = command
+        self.priority = priority
+        self.arrival = arrival
+        self.enqueued = time.monotonic()
+        self.admitted = False
+        # a shed ticket stays in the heap until it is popped
+        self.shed = False
+        # the ticket's row in AdmissionSlots, with AdmissionControl=shared
+        self.claim = None
+
+    def __lt__(self, other):
+        return (self.priority, self.arrival) < (other.priority, other.arrival)
+
+
+class Admission:
+    def __init__(self, limits=None, total=32, max_wait=5.0, lease=60.0, shared=False):
+        if total <= 0 or max_wait <= 0 or lease <= 0:
+            raise ValueError("Admission total, wait and lease must be positive!")
+        self.limits = dict(DEFAULT_SLOTS, **(limits or {}))
+        self.total = total
+        self.max_wait = max_wait
+        self.shed_after = max_wait * SHED_FRACTION
+        self.lease = lease
+        self.shared = shared
+        # the queue: waiting tickets by priority and arrival, and the running commands per type
+        self.cond = threading.Condition()
+        self.heap = []
+        self.waiting = set()
+        self.running = {}
+        self.arrivals = itertools.count()
+        # with AdmissionControl=shared every session thread keeps a connection to the home shard
+        self.local = threading.local()
+        self.counters = {}
+
+    def _connection(self):
+        cm = getattr(self.local, "cm", None)
+        if cm is None:
+            cm = ConnectionManager(ShardRouter.HOME)
+            cm.create_connection()
+            self.local.cm = cm
+        return cm
+
+    def _drop_connection(self):
+        cm = getattr(self.local, "cm", None)
+        if cm is not None:
+            cm.close_connection()
+            self.local.cm = None
+
+    def _count(self, command, wait=None):
+        # called with the condition held
+        stats = self.counters.setdefault(command, AdmissionStats())
+        if wait is None:
+            stats.shed += 1
+        else:
+            stats.admitted += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+
+    def slots(self, command):
+        return self.limits.get(command, OTHER_SLOTS)
+
+    def _dispatch(self):
+        '''
+        Admits waiting tickets in priority and arrival order while slots are free; called with the
+        condition held. Tickets whose command has no free slot are skipped and stay queued.
+        '''
+        skipped = []
+        admitted = False
+        while self.heap and sum(self.running.values()) < self.total:
+            ticket = heapq.heappop(self.heap)
+            if ticket.shed:
+                continue
+            if self.running.get(ticket.command, 0) >= self.slots(ticket.command):
+                skipped.append(ticket)
+                continue
+            ticket.admitted = admitted = True
+            self.waiting.discard(ticket)
+            self.running[ticket.command] = self.running.get(ticket.command, 0) + 1
+        for ticket in skipped:
+            heapq.heappush(self.heap, ticket)
+        if admitted:
+            self.cond.notify_all()
+
+    def _shed(self, ticket, waited):
+        # called with the condition held
+        ticket.shed = True
+        self.waiting.discard(ticket)
+        self._count(ticket.command)
+        raise Overloaded(ticket.command, max(1, math.ceil(waited)))
+
+    def enter(self, command):
+        '''
+        Waits until the command is admitted and returns its ticket, or None for commands that are
+        never queued. Raises Overloaded when the command is shed.
+        '''
+        priority = PRIORITIES.get(command)
+        if priority is None:
+            return None
+        now = time.monotonic()
+        with self.cond:
+            ticket = Ticket(command, priority, next(self.arrivals))
+            # check 1: shed before queueing when those ahead have already waited too long
+            oldest = min((t.enqueued for t in self.waiting if t.priority <= priority), default=now)
+            if now - oldest > self.shed_after:
+                self._shed(ticket, now - oldest)
+
+            heapq.heappush(self.heap, ticket)
+            self.waiting.add(ticket)
+            self._dispatch()
+            checked_ahead = False
+            while not ticket.admitted:
+                waited = time.monotonic() - ticket.enqueued
+                # check 2: shed once this ticket has waited too long itself
+                if waited >= self.max_wait:
+                    self._shed(ticket, waited)
+                # check 3: shed sooner when a full round of the command's slots is still queued ahead of it;
+                # later arrivals queue behind it, so the count ahead only shrinks and is checked once
+                if waited >= self.shed_after and not checked_ahead:
+                    checked_ahead = True
+                    ahead = sum(1 for t in self.waiting if t.command == command and t.arrival < ticket.arrival)
+                    if ahead >= self.slots(command):
+                        self._shed(ticket, waited)
+                deadline = self.shed_after if not checked_ahead else self.max_wait
+                self.cond.wait(max(deadline - waited, 0.0))
+            self._count(command, time.monotonic() - ticket.enqueued)
+
+        if self.shared:
+            self._claim(ticket)
+        return ticket
+
+    def _claim(self, ticket):
+        # one conditional insert; without a free shared slot the command is turned away at once
+        claim = uuid.uuid4().hex
+        try:
+            cm = self._connection()
+            claimed = cm.execute("admission.claim", (claim, ticket.command, self.lease, self.slots(ticket.command))).rowcount == 1
+            cm.conn.commit()
+        except DBError:
+            self._drop_connection()
+            self.leave(ticket)
+            raise
+        if not claimed:
+            self.leave(ticket)
+            with self.cond:
+                self.counters[ticket.command].admitted -= 1
+                self._count(ticket.command)
+            raise Overloaded(ticket.command, max(1, math.ceil(self.shed_after)))
+        ticket.claim = claim
+
+    def leave(self, ticket):
+        '''
+        Gives the ticket's slot back and admits whoever is next.
+        '''
+        if ticket is None:
+            return
+        with self.cond:
+            self.running[ticket.command] -= 1
+            self._dispatch()
+        if ticket.claim is not None:
+            try:
+                cm = self._connection()
+                # also removes expired claims on the way
+                cm.execute("admission.release", ticket.claim)
+                cm.conn.commit()
+            except DBError:
+                # the shared slot comes back once its lease expires
+                self._drop_connection()
+
+    def close(self):
+        self._drop_connection()
+
+    @contextlib.contextmanager
+    def admit(self, command):
+        ticket = self.enter(command)
+        try:
+            yield ticket
+        finally:
+            self.leave(ticket)
+
+    def stats(self):
+        '''
+        Returns this process's admission counters, keyed by command.
+        '''
+        with self.cond:
+            return {command: s.as_dict() for command, s in self.counters.items()}
+
+    def queue(self):
+        '''
+        Returns {command: (waiting, running, oldest wait in seconds)} in this process; with
+        AdmissionControl=shared the running commands are counted across all processes.
+        '''
+        now = time.monotonic()
+        with self.cond:
+            commands = set(self.running) | {t.command for t in self.waiting}
+            queues = {command: [sum(1 for t in self.waiting if t.command == command), self.running.get(command, 0),
+                                max((now - t.enqueued for t in self.waiting if t.command == command), default=0.0)]
+                      for command in commands}
+        if self.shared:
+            try:
+                cm = self._connection()
+                rows = cm.execute("admission.running", as_dict=True).fetchall()
+                cm.conn.commit()
+            except DBError:
+                self._drop_connection()
+                raise
+            for command in queues:
+                queues[command][1] = 0
+            for row in rows:
+                queues.setdefault(row["Command"], [0, 0, 0.0])[1] = int(row["Running"])
+        return {command: tuple(q) for command, q in queues.items()}
+
+
+def enabled():
+    # commands are queued in the process when AdmissionControl is set, and capped across processes too with "shared"
+    return os.getenv("AdmissionControl", "") not in ("", "0")
+
+
+admission = Admission(parse_limits(os.getenv("AdmissionLimits", "")), int(os.getenv("AdmissionTotal", "32")),
+                      float(os.getenv("AdmissionMaxWait", "5")), float(os.getenv("AdmissionLease", "60")),
+                      os.getenv("AdmissionControl", "") == "shared")
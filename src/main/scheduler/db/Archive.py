@@ -0,0 +1,63 @@
+import sys
+from db.ConnectionManager import DBError
+from db.ShardRouter import ShardRouter
+import datetime
+
+
+class Archiver:
+    '''
+    Moves Availabilities and Appointments rows dated before a cutoff into the archive tables.
+    Rows are moved in bounded batches, each in its own short transaction, so the hot tables
+    are never locked for longer than it takes to move one batch. The cutoff may not be after today.
+    '''
+
+    def __init__(self, cutoff, batch_size=1000):
+        if batch_size <= 0:
+            raise ValueError("Batch size must be positive!")
+        # rows dated today or later are still active
+        if cutoff > datetime.date.today():
+            raise ValueError("Archive cutoff cannot be after today!")
+        self.cutoff = cutoff
+        self.batch_size = batch_size
+
+    def run(self):
+        '''
+        Archives both tables on every shard and returns the number of rows moved from each table.
+        '''
+        moved = ShardRouter().fan_out(self._archive_shard)
+        return {
+            "availabilities": sum(m["availabilities"] for m in moved),
+            "appointments": sum(m["appointments"] for m in moved),
+        }
+
+    def _archive_shard(self, cm):
+        return {
+            "availabilities": self._move(cm, "archive.move_availabilities"),
+            "appointments": self._move(cm, "archive.move_appointments"),
+        }
+
+    def _move(self, cm, query):
+        moved = 0
+        try:
+            while True:
+                cursor = cm.execute(query, (self.batch_size, self.cutoff))
+                batch = cursor.rowcount
+                cm.conn.commit()
+                moved += batch
+                # a short batch means nothing older than the cutoff is left
+                if batch < self.batch_size:
+                    break
+        except DBError:
+            print("Error occurred while archiving past-date rows")
+            cm.conn.rollback()
+            raise
+        return moved
+
+
+if __name__ == "__main__":
+    # archival job: python -m db.Archive [days_to_keep] [batch_size]
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    cutoff = datetime.date.today() - datetime.timedelta(days=days)
+    moved = Archiver(cutoff, batch_size).run()
+    print("Archived", moved["availabilities"], "availabilities and", moved["appointments"], "appointments before", cutoff)
@@ -0,0 +1,64 @@
+'''
+Per-database circuit breaker.
+After threshold consecutive failures to reach a database the circuit opens, and for the next
+cooldown seconds every attempt fails fast instead of waiting on timeouts. Once the cooldown has
+passed, a single attempt is let through: its success closes the circuit, its failure opens it again.
+Breakers are shared by every ConnectionManager in the process, one per database.
+'''
+
+import os
+import time
+import threading
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Returns 0 when an attempt may go ahead, otherwise the seconds left until the next trial.
+        '''
+        with self.lock:
+            if self.state == self.CLOSED:
+                return 0
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                # let exactly one trial through
+                self.state = self.HALF_OPEN
+                return 0
+            return max(remaining, 0.001)
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def for_database(name):
+    with breakers_lock:
+        breaker = breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(int(os.getenv("BreakerThreshold", "5")), float(os.getenv("BreakerCooldown", "30")))
+            breakers[name] = breaker
+        return breaker
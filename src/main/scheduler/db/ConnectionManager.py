@@ -1,29 +1,208 @@
-import pymssql
 import os
+import time
+import random
+import sqlite3
+import datetime
+from db import Queries
+from db import CircuitBreaker
+
+# pymssql is only needed for the Azure SQL backend; the SQLite backend runs on the standard library.
+try:
+    import pymssql
+except ImportError:
+    pymssql = None
+
+
+class DBUnavailableError(Exception):
+    '''
+    The database could not be reached within the connect timeout, or its circuit breaker is open.
+    retry_after is the number of seconds until the next attempt will be let through, if known.
+    '''
+    def __init__(self, database, reason, retry_after=None):
+        super().__init__(database, reason, retry_after)
+        self.database = database
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def __str__(self):
+        text = f"database {self.database} is unavailable: {self.reason}"
+        if self.retry_after is not None:
+            text += f" (retry in {self.retry_after:.1f} s)"
+        return text
+
+
+class DBTimeoutError(Exception):
+    '''
+    A query did not finish within the query timeout.
+    '''
+    def __init__(self, database, query, timeout):
+        super().__init__(database, query, timeout)
+        self.database = database
+        self.query = query
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"query {self.query} on database {self.database} timed out after {self.timeout:g} s"
+
+
+# Errors raised by either backend; callers catch this instead of a driver-specific error class.
+DBError = ((pymssql.Error, sqlite3.Error) if pymssql is not None else (sqlite3.Error,)) + (DBUnavailableError, DBTimeoutError)
+# Constraint violations, such as inserting a duplicate primary key.
+DBIntegrityError = (pymssql.IntegrityError, sqlite3.IntegrityError) if pymssql is not None else (sqlite3.IntegrityError,)
+
+# Store dates and datetimes as ISO text in SQLite and read columns declared as date or datetime
+# back as datetime.date and datetime.datetime.
+sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda d: d.isoformat(" "))
+sqlite3.register_converter("date", lambda b: datetime.date.fromisoformat(b.decode()[:10]))
+sqlite3.register_converter("datetime", lambda b: datetime.datetime.fromisoformat(b.decode()))
+
+
+def timeout_setting(name, default):
+    # seconds; 0 disables the timeout
+    return float(os.getenv(name, default))
+
+
+def is_timeout(e):
+    # pymssql reports timeouts as OperationalError; SQLite reports an interrupted statement
+    return "timed out" in str(e).lower() or (isinstance(e, sqlite3.OperationalError) and "interrupted" in str(e))
+
+
+def is_unavailable(e):
+    '''
+    Returns True for errors that mean the database cannot serve requests, which count towards its circuit breaker.
+    '''
+    if is_timeout(e):
+        return True
+    if pymssql is not None and isinstance(e, (pymssql.OperationalError, pymssql.InterfaceError)):
+        return True
+    return isinstance(e, sqlite3.OperationalError) and "unable to open" in str(e)
+
+
+def backend_name():
+    return os.getenv("Backend", "mssql").lower()
+
+
+def shard_databases():
+    '''
+    Returns the database of every shard: DBName (Azure SQL) or SQLitePath (SQLite),
+    as a comma-separated list. Shard 0 is the home shard for unpartitioned tables.
+    '''
+    if backend_name() == "sqlite":
+        databases = os.getenv("SQLitePath", "scheduler.db")
+    else:
+        databases = os.getenv("DBName") or ""
+    return [db.strip() for db in databases.split(",")]
 
 
 class ConnectionManager:
 
-    def __init__(self):
+    def __init__(self, shard=0):
         self.server_name = os.getenv("Server")
-        self.db_name = os.getenv("DBName")
         self.user = os.getenv("UserID")
         self.password = os.getenv("Password")
+        self.backend = backend_name()
+        self.shard = shard
+        self.db_name = shard_databases()[shard]
         self.conn = None
+        # resolved statements, cached per connection by query name
+        self.statements = {}
+        # ConnectTimeout bounds all connection attempts together, LoginTimeout each single one
+        self.connect_timeout = timeout_setting("ConnectTimeout", "30")
+        self.login_timeout = timeout_setting("LoginTimeout", "10")
+        self.query_timeout = timeout_setting("QueryTimeout", "30")
+        self.retries = int(os.getenv("ConnectRetries", "3"))
+        self.breaker = CircuitBreaker.for_database(self.db_name)
+        self.deadline = None
+
+    def _connect(self):
+        if self.backend == "sqlite":
+            # SQLite waits up to the query timeout for a lock held by another connection
+            conn = sqlite3.connect(self.db_name, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False,
+                                   timeout=self.query_timeout or 5.0)
+            # rows can then be read both by column name and by position
+            conn.row_factory = sqlite3.Row
+            if self.query_timeout:
+                # abort a statement that runs past the deadline set by execute()
+                conn.set_progress_handler(self._past_deadline, 1000)
+            return conn
+        return pymssql.connect(server=self.server_name, user=self.user, password=self.password, database=self.db_name,
+                               login_timeout=int(self.login_timeout), timeout=int(self.query_timeout))
+
+    def _past_deadline(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
 
     def create_connection(self):
+        '''
+        Opens a connection, retrying with exponential backoff and jitter until ConnectRetries attempts
+        or ConnectTimeout seconds are used up. Raises DBUnavailableError when that fails, and at once
+        while the database's circuit breaker is open.
+        '''
+        retry_after = self.breaker.allow()
+        if retry_after:
+            raise DBUnavailableError(self.db_name, "circuit breaker open", retry_after)
+
+        give_up = time.monotonic() + self.connect_timeout if self.connect_timeout else None
+        delay = 0.1
+        for attempt in range(self.retries + 1):
+            try:
+                self.conn = self._connect()
+                self.statements = {}
+                self.breaker.record_success()
+                return self.conn
+            except DBError as db_err:
+                error = db_err
+            delay = min(delay * 2, 5.0)
+            sleep = random.uniform(0, delay)
+            if attempt == self.retries or (give_up is not None and time.monotonic() + sleep > give_up):
+                break
+            time.sleep(sleep)
+        self.breaker.record_failure()
+        raise DBUnavailableError(self.db_name, f"{error} after {attempt + 1} attempts") from error
+
+    # Execute a registered query by name with bound parameters and return its cursor
+    def execute(self, name, args=(), as_dict=False):
+        statement = self.statements.get(name)
+        if statement is None:
+            statement = Queries.Statement(Queries.get(name), self.backend)
+            self.statements[name] = statement
+        params = statement.bind(args)
+
+        cursor = self.conn.cursor() if self.backend == "sqlite" else self.conn.cursor(as_dict=as_dict)
+        start = time.perf_counter()
+        if self.query_timeout:
+            self.deadline = time.monotonic() + self.query_timeout
         try:
-            self.conn = pymssql.connect(server=self.server_name, user=self.user, password=self.password, database=self.db_name)
-        except pymssql.Error as db_err:
-            print("Database Programming Error in SQL connection processing! ")
-            print(db_err)
-            quit()
-        return self.conn
+            for sql in statement.sql:
+                cursor.execute(sql, params)
+        except DBError as db_err:
+            Queries.record(name, time.perf_counter() - start, failed=True)
+            if is_unavailable(db_err):
+                self.breaker.record_failure()
+            if is_timeout(db_err):
+                raise DBTimeoutError(self.db_name, name, self.query_timeout) from db_err
+            raise
+        finally:
+            self.deadline = None
+        Queries.record(name, time.perf_counter() - start)
+        if self.breaker.failures:
+            self.breaker.record_success()
+        return cursor
+
+    # Execute a registered query and return its first row, or None when the result is empty.
+    # The whole result is read: on SQLite a SELECT that is not read to the end keeps its read lock,
+    # and another connection of this process could then not commit to the same database.
+    def first(self, name, args=(), as_dict=False):
+        rows = self.execute(name, args, as_dict).fetchall()
+        return rows[0] if rows else None
 
     def close_connection(self):
+        if self.conn is None:
+            return
         try:
             self.conn.close()
-        except pymssql.Error as db_err:
+        except DBError as db_err:
+            # the connection is unusable either way; there is nothing left to clean up
             print("Database Programming Error in SQL connection processing! ")
             print(db_err)
-            quit()
+        self.conn = None
@@ -0,0 +1,151 @@
+'''
+Group commit for booking transactions, for processes that run several sessions at once.
+Instead of committing on its own connection, a session hands its transaction to the coordinator of
+the shard as an operation, a function of a ConnectionManager, and waits on a future. The coordinator
+collects the operations that arrive within GroupCommitWindow milliseconds of the first one, at most
+GroupCommitSize of them, and runs them one after another in a single transaction on its own
+connection, so the whole group costs one commit (and one log flush) instead of one each:
+
+    an operation that raises is rolled back to the savepoint taken before it, and only its caller
+    gets the error; the others of the group are unaffected
+    once the group has committed, every other caller gets its operation's return value
+    when the commit itself fails, every caller of the group gets that error
+
+A longer window collects larger groups, at the cost of that much latency for the first operation of
+each group. Without a window (the default) callers keep committing on their own.
+'''
+
+from db.ConnectionManager import ConnectionManager, DBError
+from concurrent.futures import Future
+import os
+import time
+import threading
+
+
+class GroupCommit:
+    def __init__(self, shard, window=0.005, size=32):
+        if window <= 0 or size <= 0:
+            raise ValueError("Group commit window and size must be positive!")
+        self.shard = shard
+        self.window = window
+        self.size = size
+        # (operation, future) in arrival order
+        self.queue = []
+        self.cond = threading.Condition()
+        self.thread = None
+        self.cm = None
+        self.groups = 0
+        self.operations = 0
+        self.largest = 0
+
+    def submit(self, operation):
+        '''
+        Queues operation(cm) for the next group and returns a future of its result.
+        '''
+        future = Future()
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=f"group-commit-{self.shard}", daemon=True)
+                self.thread.start()
+            self.queue.append((operation, future))
+            self.cond.notify()
+        return future
+
+    def run(self, operation):
+        '''
+        Runs operation(cm) in the next group and returns its result once the group has committed,
+        or raises its error.
+        '''
+        return self.submit(operation).result()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                # the first operation opens the window; a full group closes it early
+                closes = time.monotonic() + self.window
+                while len(self.queue) < self.size:
+                    remaining = closes - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                group, self.queue = self.queue[:self.size], self.queue[self.size:]
+            self._commit(group)
+
+    def _connection(self):
+        if self.cm is None:
+            cm = ConnectionManager(self.shard)
+            cm.create_connection()
+            self.cm = cm
+        return self.cm
+
+    def _commit(self, group):
+        done = []
+        try:
+            cm = self._connection()
+            cm.execute("transaction.begin")
+            for operation, future in group:
+                cm.execute("transaction.savepoint")
+                try:
+                    result = operation(cm)
+                except Exception as e:
+                    cm.execute("transaction.rollback_to")
+                    future.set_exception(e)
+                    continue
+                cm.execute("transaction.release")
+                done.append((future, result))
+            cm.conn.commit()
+        except DBError as e:
+            # the group is lost as a whole; the next one starts on a new connection
+            if self.cm is not None:
+                try:
+                    self.cm.conn.rollback()
+                except DBError:
+                    pass
+                self.cm.close_connection()
+                self.cm = None
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        with self.cond:
+            self.groups += 1
+            self.operations += len(group)
+            self.largest = max(self.largest, len(group))
+        for future, result in done:
+            future.set_result(result)
+
+    def stats(self):
+        with self.cond:
+            return {"groups": self.groups, "operations": self.operations, "largest": self.largest}
+
+
+coordinators = {}
+coordinators_lock = threading.Lock()
+
+
+def window_seconds():
+    # milliseconds in the environment; 0 turns group commit off
+    return float(os.getenv("GroupCommitWindow", "0")) / 1000
+
+
+def enabled():
+    return window_seconds() > 0
+
+
+def for_shard(shard):
+    with coordinators_lock:
+        coordinator = coordinators.get(shard)
+        if coordinator is None:
+            coordinator = GroupCommit(shard, window_seconds(), int(os.getenv("GroupCommitSize", "32")))
+            coordinators[shard] = coordinator
+        return coordinator
+
+
+def stats():
+    '''
+    Returns the counters of every coordinator, keyed by shard.
+    '''
+    with coordinators_lock:
+        return {shard: coordinator.stats() for shard, coordinator in coordinators.items()}
@@ -0,0 +1,132 @@
+'''
+Idempotency keys for the commands that change bookings and stock (reserve, cancel, add_doses).
+A client that timed out can send the same command with the same --key again: instead of booking a
+second appointment or adding the doses twice, the retry reports the result of the first run, read
+with one lookup from the IdempotencyKeys table on the home shard. Keys belong to the logged-in user.
+
+    claim     before the first run, the key is inserted without a result; a concurrent retry then
+              finds the claim and is told that the request is still in progress
+    complete  after the run, the command's transcript is stored and kept for IdempotencyTTL seconds
+              (default one day); a run that committed never gives its key up, so storing it is retried
+    forget    a run whose command returned RETRY, having failed before committing anything, gives its
+              key up, so that a retry runs again
+
+Expired keys are purged in batches every PURGE_EVERY claims, and the table is trimmed to the newest
+IdempotencyMaxKeys keys; a claim whose process died before completing it expires after
+CLAIM_SECONDS.
+'''
+
+from db.ConnectionManager import ConnectionManager, DBError, DBIntegrityError
+import os
+import time
+import random
+import datetime
+import itertools
+import threading
+
+MAX_KEY_LENGTH = 64
+# the stored transcript has to fit the Result column
+MAX_RESULT_LENGTH = 8000
+CLAIM_SECONDS = 600
+COMPLETE_ATTEMPTS = 4
+PURGE_EVERY = 100
+PURGE_BATCH = 500
+TTL_SECONDS = float(os.getenv("IdempotencyTTL", "86400"))
+MAX_KEYS = int(os.getenv("IdempotencyMaxKeys", "100000"))
+
+# returned by a command that failed before committing anything, so that its key is given up
+RETRY = "retry"
+
+claims = itertools.count(1)
+claims_lock = threading.Lock()
+
+
+class Stored:
+    '''
+    What an earlier run with the key left: its request, and its transcript as JSON (None while it runs).
+    '''
+    def __init__(self, request, result):
+        self.request = request
+        self.result = result
+
+
+def _now():
+    return datetime.datetime.now()
+
+
+def claim(owner, key, request):
+    '''
+    Returns None when the key is now claimed for this request, which the caller then runs, or the
+    Stored run that holds the key already.
+    '''
+    cm = ConnectionManager()
+    conn = cm.create_connection()
+    try:
+        now = _now()
+        rows = cm.execute("idempotency.get", (owner, key, now)).fetchall()
+        if rows:
+            conn.commit()
+            return Stored(rows[0][0], rows[0][1])
+        # an expired key may be claimed again
+        cm.execute("idempotency.forget_expired", (owner, key, now))
+        try:
+            cm.execute("idempotency.claim", (owner, key, request, now + datetime.timedelta(seconds=CLAIM_SECONDS)))
+            conn.commit()
+        except DBIntegrityError:
+            # a concurrent run claimed it first
+            conn.rollback()
+            return Stored(request, None)
+        with claims_lock:
+            count = next(claims)
+        if count % PURGE_EVERY == 0:
+            try:
+                purge(cm)
+            except DBError:
+                # housekeeping only; a later purge catches up
+                conn.rollback()
+        return None
+    finally:
+        cm.close_connection()
+
+
+def complete(owner, key, result):
+    '''
+    Stores the result of the claimed run, retrying with exponential backoff and jitter: the run has
+    committed, so a key left claimed would let a retry repeat it once the claim expires. Raises the last
+    DBError after COMPLETE_ATTEMPTS attempts.
+    '''
+    delay = 0.1
+    for attempt in range(COMPLETE_ATTEMPTS):
+        try:
+            cm = ConnectionManager()
+            conn = cm.create_connection()
+            try:
+                cm.execute("idempotency.complete", (result, _now() + datetime.timedelta(seconds=TTL_SECONDS), owner, key))
+                conn.commit()
+                return
+            finally:
+                cm.close_connection()
+        except DBError:
+            if attempt == COMPLETE_ATTEMPTS - 1:
+                raise
+        delay = min(delay * 2, 5.0)
+        time.sleep(random.uniform(0, delay))
+
+
+def forget(owner, key):
+    cm = ConnectionManager()
+    conn = cm.create_connection()
+    try:
+        cm.execute("idempotency.forget", (owner, key))
+        conn.commit()
+    finally:
+        cm.close_connection()
+
+
+def purge(cm):
+    '''
+    Deletes a batch of expired keys and the oldest keys beyond MAX_KEYS on the open connection.
+    '''
+    cm.execute("idempotency.purge", (PURGE_BATCH, _now()))
+    cm.execute("idempotency.trim", MAX_KEYS)
+    cm.conn.commit()
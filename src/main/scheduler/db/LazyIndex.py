@@ -0,0 +1,39 @@
+'''
+Base class of the in-memory indexes that a process loads from the database on first use and then
+keeps up to date with its own writes (usernames, sites, pending reminders).
+Until the index is loaded there is nothing to keep up to date: the load reads every committed
+write anyway, so updates made before it are dropped.
+'''
+
+import threading
+
+
+class LazyIndex:
+    def __init__(self, lock=None):
+        # a subclass may share its own lock or condition with the index
+        self.lock = lock if lock is not None else threading.Lock()
+        self.loaded = False
+
+    def _load(self):
+        '''
+        Fills the index from the database; called with the lock held.
+        '''
+        raise NotImplementedError
+
+    def read(self, lookup):
+        '''
+        Returns lookup() under the lock, loading the index first if needed.
+        '''
+        with self.lock:
+            if not self.loaded:
+                self._load()
+                self.loaded = True
+            return lookup()
+
+    def update(self, change):
+        '''
+        Applies change() under the lock once the index is loaded.
+        '''
+        with self.lock:
+            if self.loaded:
+                change()
@@ -0,0 +1,433 @@
+'''
+Central registry of every SQL statement issued by the scheduler.
+Each query has a name, a parameter signature and its SQL text per database backend.
+SQLite text defaults to the Azure SQL text with its placeholders rewritten to '?'.
+Statements are executed through ConnectionManager.execute(), which keeps the resolved,
+parameterized statement cached per connection and records per-query timings here.
+'''
+
+import re
+import threading
+
+
+class Query:
+    def __init__(self, name, params, sql):
+        self.name = name
+        self.params = params
+        self.sql = sql
+
+    def text(self, backend):
+        if backend not in self.sql:
+            raise KeyError(f"Query '{self.name}' has no SQL text for backend '{backend}'")
+        return self.sql[backend]
+
+    def bind(self, args):
+        # a single scalar parameter may be passed without wrapping it in a tuple
+        if not isinstance(args, (tuple, list)):
+            args = (args,)
+        if len(args) != len(self.params):
+            raise ValueError(f"Query '{self.name}' expects parameters {self.params}, got {len(args)} values")
+        return tuple(args)
+
+
+class Statement:
+    '''
+    A query resolved for one connection's backend, ready to be executed with bound parameters.
+    A backend may need several statements for one query; they run in order on the same cursor.
+    '''
+    def __init__(self, query, backend):
+        self.query = query
+        text = query.text(backend)
+        self.sql = (text,) if isinstance(text, str) else tuple(text)
+
+    def bind(self, args):
+        return self.query.bind(args)
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_seconds": self.total_seconds,
+            "avg_seconds": self.total_seconds / self.count if self.count else 0.0,
+            "max_seconds": self.max_seconds,
+        }
+
+
+_registry = {}
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def register(name, params, **sql):
+    if name in _registry:
+        raise ValueError(f"Query '{name}' is already registered")
+    if "sqlite" not in sql:
+        sql["sqlite"] = re.sub(r"%[sd]", "?", sql["mssql"])
+    _registry[name] = Query(name, tuple(params), sql)
+    return _registry[name]
+
+
+def get(name):
+    return _registry[name]
+
+
+def names():
+    return sorted(_registry)
+
+
+def record(name, elapsed, failed=False):
+    with _stats_lock:
+        stats = _stats.setdefault(name, QueryStats())
+        stats.count += 1
+        stats.total_seconds += elapsed
+        stats.max_seconds = max(stats.max_seconds, elapsed)
+        if failed:
+            stats.errors += 1
+
+
+def stats():
+    '''
+    Returns a snapshot of the per-query execution statistics, keyed by query name.
+    '''
+    with _stats_lock:
+        return {name: s.as_dict() for name, s in _stats.items()}
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+# Caregivers
+register("caregiver.get", ("username",),
+         mssql="SELECT Salt, Hash FROM Caregivers WHERE Username = %s")
+register("caregiver.usernames", (),
+         mssql="SELECT Username FROM Caregivers")
+register("caregiver.insert", ("username", "salt", "hash"),
+         mssql="INSERT INTO Caregivers VALUES (%s, %s, %s)")
+
+# Patients
+register("patient.get", ("username",),
+         mssql="SELECT Salt, Hash FROM Patients WHERE Username = %s")
+register("patient.usernames", (),
+         mssql="SELECT Username FROM Patients")
+register("patient.insert", ("username", "salt", "hash"),
+         mssql="INSERT INTO Patients VALUES (%s, %s, %s)")
+
+# Vaccines
+register("vaccine.get", ("name",),
+         mssql="SELECT Name, Doses FROM Vaccines WHERE Name = %s")
+register("vaccine.all", (),
+         mssql="SELECT Name, Doses FROM Vaccines")
+register("vaccine.insert", ("name", "doses"),
+         mssql="INSERT INTO Vaccines VALUES (%s, %d)")
+register("vaccine.change_doses", ("delta", "name"),
+         mssql="UPDATE Vaccines SET Doses = Doses + %d WHERE Name = %s")
+
+# Sites
+register("site.all", (),
+         mssql="SELECT SiteID, Latitude, Longitude FROM Sites")
+register("site.insert", ("site_id", "latitude", "longitude"),
+         mssql="INSERT INTO Sites VALUES (%s, %s, %s)")
+
+# Regimens (multi-dose vaccines)
+register("regimen.get", ("vname",),
+         mssql="SELECT DoseCount, MinIntervalDays, MaxIntervalDays FROM Regimens WHERE Vname = %s")
+register("regimen.insert", ("vname", "dose_count", "min_interval", "max_interval"),
+         mssql="INSERT INTO Regimens VALUES (%s, %d, %d, %d)")
+register("regimen.update", ("dose_count", "min_interval", "max_interval", "vname"),
+         mssql="UPDATE Regimens SET DoseCount = %d, MinIntervalDays = %d, MaxIntervalDays = %d WHERE Vname = %s")
+
+# Vaccine lots (first-expired-first-out allocation)
+register("lot.insert", ("lot_id", "vname", "quantity", "expiry", "site_id"),
+         mssql="INSERT INTO VaccineLots (LotID, Vname, Quantity, Expiry, SiteID) VALUES (%s, %s, %d, %s, %s)")
+register("lot.stock_by_site", ("time",),
+         mssql="""SELECT SiteID, Vname, SUM(Quantity) AS Doses FROM VaccineLots
+                  WHERE Expiry >= %s AND Quantity > 0 GROUP BY SiteID, Vname""")
+register("lot.expiry", ("lot_id", "vname"),
+         mssql="SELECT Expiry FROM VaccineLots WHERE LotID = %s AND Vname = %s")
+register("lot.add_doses", ("quantity", "lot_id", "vname"),
+         mssql="UPDATE VaccineLots SET Quantity = Quantity + %d WHERE LotID = %s AND Vname = %s")
+register("lot.first_valid_at_site", ("vname", "site_id", "time"),
+         mssql="""SELECT TOP 1 LotID FROM VaccineLots
+                  WHERE Vname = %s AND SiteID = %s AND Expiry >= %s AND Quantity > 0
+                  ORDER BY Expiry, LotID""",
+         sqlite="""SELECT LotID FROM VaccineLots
+                   WHERE Vname = ? AND SiteID = ? AND Expiry >= ? AND Quantity > 0
+                   ORDER BY Expiry, LotID LIMIT 1""")
+# lots stocked without a site are the central stock
+register("lot.first_valid_unsited", ("vname", "time"),
+         mssql="""SELECT TOP 1 LotID FROM VaccineLots
+                  WHERE Vname = %s AND SiteID IS NULL AND Expiry >= %s AND Quantity > 0
+                  ORDER BY Expiry, LotID""",
+         sqlite="""SELECT LotID FROM VaccineLots
+                   WHERE Vname = ? AND SiteID IS NULL AND Expiry >= ? AND Quantity > 0
+                   ORDER BY Expiry, LotID LIMIT 1""")
+register("lot.take_dose", ("lot_id",),
+         mssql="UPDATE VaccineLots SET Quantity = Quantity - 1 WHERE LotID = %s AND Quantity > 0")
+
+# Availabilities (free intervals [StartMinute, EndMinute) per caregiver and day; see db/SlotIndex.py)
+register("availability.insert", ("time", "username", "site_id", "start", "end"),
+         mssql="INSERT INTO Availabilities (Time, Username, SiteID, StartMinute, EndMinute) VALUES (%s, %s, %s, %d, %d)")
+register("availability.delete", ("time", "username", "start", "end"),
+         mssql="DELETE FROM Availabilities WHERE Time = %s AND Username = %s AND StartMinute = %d AND EndMinute = %d")
+register("availability.before", ("time", "username", "minute"),
+         mssql="""SELECT TOP 1 SiteID, StartMinute, EndMinute FROM Availabilities
+                  WHERE Time = %s AND Username = %s AND StartMinute < %d ORDER BY StartMinute DESC""",
+         sqlite="""SELECT SiteID, StartMinute, EndMinute FROM Availabilities
+                   WHERE Time = ? AND Username = ? AND StartMinute < ? ORDER BY StartMinute DESC LIMIT 1""")
+register("availability.from", ("time", "username", "minute"),
+         mssql="""SELECT TOP 1 SiteID, StartMinute, EndMinute FROM Availabilities
+                  WHERE Time = %s AND Username = %s AND StartMinute >= %d ORDER BY StartMinute""",
+         sqlite="""SELECT SiteID, StartMinute, EndMinute FROM Availabilities
+                   WHERE Time = ? AND Username = ? AND StartMinute >= ? ORDER BY StartMinute LIMIT 1""")
+register("availability.by_date", ("time", "length"),
+         mssql="""SELECT Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                  WHERE Time = %s AND EndMinute - StartMinute >= %d""")
+register("availability.first_fit", ("time", "length"),
+         mssql="""SELECT TOP 1 Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                  WHERE Time = %s AND EndMinute - StartMinute >= %d ORDER BY StartMinute, Username""",
+         sqlite="""SELECT Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                   WHERE Time = ? AND EndMinute - StartMinute >= ? ORDER BY StartMinute, Username LIMIT 1""")
+register("availability.covering", ("time", "start", "end"),
+         mssql="""SELECT TOP 1 Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                  WHERE Time = %s AND StartMinute <= %d AND EndMinute >= %d ORDER BY Username""",
+         sqlite="""SELECT Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                   WHERE Time = ? AND StartMinute <= ? AND EndMinute >= ? ORDER BY Username LIMIT 1""")
+register("availability.first_between", ("start", "end", "length"),
+         mssql="""SELECT TOP 1 Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                  WHERE Time >= %s AND Time <= %s AND EndMinute - StartMinute >= %d ORDER BY Time, StartMinute""",
+         sqlite="""SELECT Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                   WHERE Time >= ? AND Time <= ? AND EndMinute - StartMinute >= ? ORDER BY Time, StartMinute LIMIT 1""")
+# the same searches limited to one site, for reserve --site
+register("availability.first_fit_at_site", ("time", "length", "site_id"),
+         mssql="""SELECT TOP 1 Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                  WHERE Time = %s AND EndMinute - StartMinute >= %d AND SiteID = %s ORDER BY StartMinute, Username""",
+         sqlite="""SELECT Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                   WHERE Time = ? AND EndMinute - StartMinute >= ? AND SiteID = ? ORDER BY StartMinute, Username LIMIT 1""")
+register("availability.covering_at_site", ("time", "start", "end", "site_id"),
+         mssql="""SELECT TOP 1 Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                  WHERE Time = %s AND StartMinute <= %d AND EndMinute >= %d AND SiteID = %s ORDER BY Username""",
+         sqlite="""SELECT Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                   WHERE Time = ? AND StartMinute <= ? AND EndMinute >= ? AND SiteID = ? ORDER BY Username LIMIT 1""")
+register("availability.first_between_at_site", ("start", "end", "length", "site_id"),
+         mssql="""SELECT TOP 1 Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                  WHERE Time >= %s AND Time <= %s AND EndMinute - StartMinute >= %d AND SiteID = %s
+                  ORDER BY Time, StartMinute""",
+         sqlite="""SELECT Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                   WHERE Time >= ? AND Time <= ? AND EndMinute - StartMinute >= ? AND SiteID = ?
+                   ORDER BY Time, StartMinute LIMIT 1""")
+register("availability.delete_between", ("username", "start", "end"),
+         mssql="DELETE FROM Availabilities WHERE Username = %s AND Time >= %s AND Time <= %s")
+
+# Appointments
+register("appointment.max_id", (),
+         mssql="""SELECT MAX(AppointID) AS max_id FROM
+                  (SELECT MAX(AppointID) AS AppointID FROM Appointments
+                   UNION ALL
+                   SELECT MAX(AppointID) AS AppointID FROM AppointmentsArchive
+                   UNION ALL
+                   SELECT MAX(AppointID) AS AppointID FROM Cancellations) AS ids""")
+register("appointment.insert", ("appoint_id", "time", "cname", "pname", "vname", "lot_id", "series_id", "dose_number", "site_id",
+                               "start", "end"),
+         mssql="""INSERT INTO Appointments (AppointID, Time, Cname, Pname, Vname, LotID, SeriesID, DoseNumber, SiteID,
+                                             StartMinute, EndMinute)
+                  VALUES (%d, %s, %s, %s, %s, %s, %d, %d, %s, %d, %d)""")
+register("appointment.overlapping", ("cname", "time", "end", "start"),
+         mssql="""SELECT COUNT(*) FROM Appointments
+                  WHERE Cname = %s AND Time = %s AND StartMinute < %d AND EndMinute > %d""")
+register("appointment.get_for_caregiver", ("appoint_id", "cname"),
+         mssql="""SELECT AppointID, Time, Cname, Pname, Vname, LotID, SeriesID, SiteID, StartMinute, EndMinute FROM Appointments
+                  WHERE AppointID = %d AND Cname = %s""")
+register("appointment.get_for_patient", ("appoint_id", "pname"),
+         mssql="""SELECT AppointID, Time, Cname, Pname, Vname, LotID, SeriesID, SiteID, StartMinute, EndMinute FROM Appointments
+                  WHERE AppointID = %d AND Pname = %s""")
+register("appointment.by_series", ("series_id",),
+         mssql="""SELECT AppointID, Time, Cname, Pname, Vname, LotID, SeriesID, SiteID, StartMinute, EndMinute FROM Appointments
+                  WHERE SeriesID = %d ORDER BY DoseNumber""")
+# every appointment of the caregiver in the range, with the first other caregiver (by username) whose free
+# interval at the same site covers its slot, or NULLs; a caregiver's appointments never overlap, so one free
+# interval can take several of them
+register("appointment.reassign_matches", ("cname", "start", "end", "cname"),
+         mssql="""WITH Affected AS (
+                      SELECT AppointID, Time, StartMinute, EndMinute, SiteID
+                      FROM Appointments WHERE Cname = %s AND Time >= %s AND Time <= %s),
+                  Candidates AS (
+                      SELECT a.AppointID, v.Username,
+                             ROW_NUMBER() OVER (PARTITION BY a.AppointID ORDER BY v.Username) AS Pick
+                      FROM Affected a JOIN Availabilities v
+                           ON v.Time = a.Time AND v.StartMinute <= a.StartMinute AND v.EndMinute >= a.EndMinute
+                              AND (v.SiteID = a.SiteID OR (v.SiteID IS NULL AND a.SiteID IS NULL))
+                      WHERE v.Username <> %s)
+                  SELECT a.AppointID, a.Time, a.StartMinute, a.EndMinute, a.SiteID, c.Username
+                  FROM Affected a LEFT JOIN Candidates c ON c.AppointID = a.AppointID AND c.Pick = 1
+                  ORDER BY a.Time, a.StartMinute""")
+register("appointment.reassign", ("cname", "appoint_id", "old_cname"),
+         mssql="UPDATE Appointments SET Cname = %s WHERE AppointID = %d AND Cname = %s")
+register("appointment.delete", ("appoint_id",),
+         mssql="DELETE FROM Appointments WHERE AppointID = %d")
+register("appointment.by_caregiver", ("cname",),
+         mssql="SELECT AppointID, Time, StartMinute, Cname, Pname, Vname FROM Appointments WHERE Cname = %s")
+register("appointment.by_patient", ("pname",),
+         mssql="SELECT AppointID, Time, StartMinute, Cname, Pname, Vname FROM Appointments WHERE Pname = %s")
+register("appointment.history_by_caregiver", ("cname", "cname"),
+         mssql="""SELECT AppointID, Time, StartMinute, Cname, Pname, Vname FROM Appointments WHERE Cname = %s
+                  UNION ALL
+                  SELECT AppointID, Time, StartMinute, Cname, Pname, Vname FROM AppointmentsArchive WHERE Cname = %s
+                  ORDER BY Time, StartMinute""")
+register("appointment.history_by_patient", ("pname", "pname"),
+         mssql="""SELECT AppointID, Time, StartMinute, Cname, Pname, Vname FROM Appointments WHERE Pname = %s
+                  UNION ALL
+                  SELECT AppointID, Time, StartMinute, Cname, Pname, Vname FROM AppointmentsArchive WHERE Pname = %s
+                  ORDER BY Time, StartMinute""")
+
+# Cancellations
+register("cancellation.insert", ("appoint_id", "time", "cname", "pname", "vname", "cancelled_at"),
+         mssql="INSERT INTO Cancellations VALUES (%d, %s, %s, %s, %s, %s)")
+
+# Reporting snapshot (columns are read in bulk; dates come back as proleptic day ordinals so that
+# they load straight into integer arrays, matching datetime.date.toordinal())
+register("report.appointments", (),
+         mssql="""SELECT DATEDIFF(day, CAST('0001-01-01' AS date), Time) + 1 AS Day, Cname, Vname FROM Appointments
+                  UNION ALL
+                  SELECT DATEDIFF(day, CAST('0001-01-01' AS date), Time) + 1 AS Day, Cname, Vname FROM AppointmentsArchive""",
+         sqlite="""SELECT CAST(julianday(Time) - 1721424.5 AS integer) AS Day, Cname, Vname FROM Appointments
+                   UNION ALL
+                   SELECT CAST(julianday(Time) - 1721424.5 AS integer) AS Day, Cname, Vname FROM AppointmentsArchive""")
+register("report.availabilities", (),
+         mssql="""SELECT DATEDIFF(day, CAST('0001-01-01' AS date), Time) + 1 AS Day, Username, EndMinute - StartMinute AS Minutes
+                  FROM Availabilities
+                  UNION ALL
+                  SELECT DATEDIFF(day, CAST('0001-01-01' AS date), Time) + 1 AS Day, Username, EndMinute - StartMinute AS Minutes
+                  FROM AvailabilitiesArchive""",
+         sqlite="""SELECT CAST(julianday(Time) - 1721424.5 AS integer) AS Day, Username, EndMinute - StartMinute AS Minutes
+                   FROM Availabilities
+                   UNION ALL
+                   SELECT CAST(julianday(Time) - 1721424.5 AS integer) AS Day, Username, EndMinute - StartMinute AS Minutes
+                   FROM AvailabilitiesArchive""")
+register("report.cancellations", (),
+         mssql="SELECT DATEDIFF(day, CAST('0001-01-01' AS date), Time) + 1 AS Day, Cname, Vname FROM Cancellations",
+         sqlite="SELECT CAST(julianday(Time) - 1721424.5 AS integer) AS Day, Cname, Vname FROM Cancellations")
+
+# Forecast: every vaccine's bookings per day over a short window, archives included, each a range
+# seek on Time, and the bookings from a day on (archives only hold past days)
+register("forecast.all_daily_bookings", ("start", "end"),
+         mssql="SELECT Vname, Time, COUNT(*) AS Doses FROM Appointments WHERE Time >= %s AND Time < %s GROUP BY Vname, Time")
+register("forecast.all_daily_bookings_archived", ("start", "end"),
+         mssql="SELECT Vname, Time, COUNT(*) AS Doses FROM AppointmentsArchive WHERE Time >= %s AND Time < %s GROUP BY Vname, Time")
+register("forecast.booked_ahead", ("time",),
+         mssql="SELECT Vname, COUNT(*) AS Doses FROM Appointments WHERE Time >= %s GROUP BY Vname")
+
+# Forecast warning in reserve: one vaccine's bookings per day over a short window, archives included,
+# each an index seek on (Vname, Time)
+register("forecast.daily_bookings", ("vname", "start", "end"),
+         mssql="SELECT Time, COUNT(*) AS Doses FROM Appointments WHERE Vname = %s AND Time >= %s AND Time < %s GROUP BY Time")
+register("forecast.daily_bookings_archived", ("vname", "start", "end"),
+         mssql="SELECT Time, COUNT(*) AS Doses FROM AppointmentsArchive WHERE Vname = %s AND Time >= %s AND Time < %s GROUP BY Time")
+
+# Reminders (the outbox row is built from the appointment itself, so a reminder for an appointment
+# that has been cancelled meanwhile, or one already queued by another process, inserts nothing)
+register("reminder.upcoming", ("time",),
+         mssql="SELECT AppointID, Time, StartMinute FROM Appointments WHERE Time >= %s")
+register("reminder.new", ("after_id",),
+         mssql="SELECT AppointID, Time, StartMinute FROM Appointments WHERE AppointID > %d")
+register("reminder.queued", ("time",),
+         mssql="SELECT AppointID, Kind FROM ReminderOutbox WHERE Time >= %s")
+register("reminder.queue", ("kind", "due_at", "queued_at", "appoint_id"),
+         mssql="""INSERT INTO ReminderOutbox (AppointID, Kind, DueAt, Time, Cname, Pname, Vname, QueuedAt)
+                  SELECT a.AppointID, r.Kind, r.DueAt, a.Time, a.Cname, a.Pname, a.Vname, r.QueuedAt
+                  FROM Appointments a CROSS JOIN (SELECT %s AS Kind, %s AS DueAt, %s AS QueuedAt) AS r
+                  WHERE a.AppointID = %d AND NOT EXISTS
+                        (SELECT 1 FROM ReminderOutbox o WHERE o.AppointID = a.AppointID AND o.Kind = r.Kind)""")
+
+# Archival (DELETE ... OUTPUT INTO moves a batch atomically in a single statement;
+# SQLite copies then deletes the same rowids inside the batch's transaction)
+register("archive.move_availabilities", ("batch_size", "cutoff"),
+         mssql="""DELETE TOP (%d) FROM Availabilities
+                  OUTPUT DELETED.Time, DELETED.Username, DELETED.SiteID, DELETED.StartMinute, DELETED.EndMinute
+                  INTO AvailabilitiesArchive
+                  WHERE Time < %s""",
+         sqlite=("""INSERT INTO AvailabilitiesArchive
+                    SELECT Time, Username, SiteID, StartMinute, EndMinute FROM Availabilities
+                    WHERE Time < ?2 ORDER BY rowid LIMIT ?1""",
+                 """DELETE FROM Availabilities WHERE rowid IN
+                    (SELECT rowid FROM Availabilities WHERE Time < ?2 ORDER BY rowid LIMIT ?1)"""))
+register("archive.move_appointments", ("batch_size", "cutoff"),
+         mssql="""DELETE TOP (%d) FROM Appointments
+                  OUTPUT DELETED.AppointID, DELETED.Time, DELETED.Cname, DELETED.Pname, DELETED.Vname, DELETED.LotID,
+                         DELETED.SeriesID, DELETED.DoseNumber, DELETED.SiteID, DELETED.StartMinute, DELETED.EndMinute
+                  INTO AppointmentsArchive
+                  WHERE Time < %s""",
+         sqlite=("""INSERT INTO AppointmentsArchive
+                    SELECT AppointID, Time, Cname, Pname, Vname, LotID, SeriesID, DoseNumber, SiteID, StartMinute, EndMinute
+                    FROM Appointments
+                    WHERE Time < ?2 ORDER BY rowid LIMIT ?1""",
+                 """DELETE FROM Appointments WHERE rowid IN
+                    (SELECT rowid FROM Appointments WHERE Time < ?2 ORDER BY rowid LIMIT ?1)"""))
+
+# Admission with AdmissionControl=shared (db/Admission.py). Times are read from the database's clock
+# as seconds since 1970. A claim is inserted only while the command's live claims are below its slot
+# count; Azure SQL holds a key-range lock on the command's claims for that statement, and SQLite's
+# single writer serializes it anyway.
+_MSSQL_NOW = "DATEDIFF_BIG(millisecond, '19700101', SYSUTCDATETIME()) / 1000.0"
+_SQLITE_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+register("admission.claim", ("claim", "command", "lease", "slots"),
+         mssql=f"""DECLARE @claim varchar(32) = %s, @command varchar(64) = %s, @lease float = %s, @slots int = %d;
+                   INSERT INTO AdmissionSlots (Claim, Command, ExpiresAt)
+                   SELECT @claim, @command, {_MSSQL_NOW} + @lease
+                   WHERE (SELECT COUNT(*) FROM AdmissionSlots WITH (UPDLOCK, HOLDLOCK)
+                          WHERE Command = @command AND ExpiresAt > {_MSSQL_NOW}) < @slots""",
+         sqlite=f"""INSERT INTO AdmissionSlots (Claim, Command, ExpiresAt)
+                    SELECT ?1, ?2, {_SQLITE_NOW} + ?3
+                    WHERE (SELECT COUNT(*) FROM AdmissionSlots WHERE Command = ?2 AND ExpiresAt > {_SQLITE_NOW}) < ?4""")
+register("admission.release", ("claim",),
+         mssql=f"DELETE FROM AdmissionSlots WHERE Claim = %s OR ExpiresAt < {_MSSQL_NOW}",
+         sqlite=f"DELETE FROM AdmissionSlots WHERE Claim = ? OR ExpiresAt < {_SQLITE_NOW}")
+register("admission.running", (),
+         mssql=f"SELECT Command, COUNT(*) AS Running FROM AdmissionSlots WHERE ExpiresAt > {_MSSQL_NOW} GROUP BY Command",
+         sqlite=f"SELECT Command, COUNT(*) AS Running FROM AdmissionSlots WHERE ExpiresAt > {_SQLITE_NOW} GROUP BY Command")
+
+# Group commit (db/GroupCommit.py): one transaction per group and a savepoint per operation.
+# pymssql always has a transaction open, so Azure SQL needs no BEGIN and never releases savepoints;
+# SQLite's ROLLBACK TO leaves the savepoint in place, so it is released afterwards.
+register("transaction.begin", (),
+         mssql=(),
+         sqlite="BEGIN IMMEDIATE")
+register("transaction.savepoint", (),
+         mssql="SAVE TRANSACTION group_operation",
+         sqlite="SAVEPOINT group_operation")
+register("transaction.rollback_to", (),
+         mssql="ROLLBACK TRANSACTION group_operation",
+         sqlite=("ROLLBACK TO group_operation", "RELEASE group_operation"))
+register("transaction.release", (),
+         mssql=(),
+         sqlite="RELEASE group_operation")
+
+# Idempotency keys (db/Idempotency.py)
+register("idempotency.get", ("owner", "key", "now"),
+         mssql="SELECT Request, Result FROM IdempotencyKeys WHERE Owner = %s AND IdemKey = %s AND ExpiresAt > %s")
+register("idempotency.claim", ("owner", "key", "request", "expires_at"),
+         mssql="INSERT INTO IdempotencyKeys (Owner, IdemKey, Request, Result, ExpiresAt) VALUES (%s, %s, %s, NULL, %s)")
+register("idempotency.complete", ("result", "expires_at", "owner", "key"),
+         mssql="UPDATE IdempotencyKeys SET Result = %s, ExpiresAt = %s WHERE Owner = %s AND IdemKey = %s")
+register("idempotency.forget", ("owner", "key"),
+         mssql="DELETE FROM IdempotencyKeys WHERE Owner = %s AND IdemKey = %s")
+register("idempotency.forget_expired", ("owner", "key", "now"),
+         mssql="DELETE FROM IdempotencyKeys WHERE Owner = %s AND IdemKey = %s AND ExpiresAt <= %s")
+register("idempotency.purge", ("batch_size", "now"),
+         mssql="DELETE TOP (%d) FROM IdempotencyKeys WHERE ExpiresAt <= %s",
+         sqlite="""DELETE FROM IdempotencyKeys WHERE rowid IN
+                   (SELECT rowid FROM IdempotencyKeys WHERE ExpiresAt <= ?2 LIMIT ?1)""")
+register("idempotency.trim", ("max_keys",),
+         mssql="""DELETE FROM IdempotencyKeys WHERE ExpiresAt <
+                  (SELECT MIN(ExpiresAt) FROM (SELECT TOP (%d) ExpiresAt FROM IdempotencyKeys ORDER BY ExpiresAt DESC) AS newest)""",
+         sqlite="""DELETE FROM IdempotencyKeys WHERE ExpiresAt <
+                   (SELECT MIN(ExpiresAt) FROM (SELECT ExpiresAt FROM IdempotencyKeys ORDER BY ExpiresAt DESC LIMIT ?))""")
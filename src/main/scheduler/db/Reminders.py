@@ -0,0 +1,251 @@
+'''
+Appointment reminders, queued 24 hours and 1 hour before each appointment.
+Pending reminders are kept in a heap ordered by due time. The heap is loaded once from the
+Appointments table and then kept up to date by reserve and cancel, so the worker only ever
+touches the reminders that are due instead of rescanning the table. Due reminders are written
+in batches to the ReminderOutbox table on the appointment's shard, from which a delivery
+process sends them.
+Bookings made by other processes are caught up every ReminderPollSeconds: appointment IDs are
+minted in the booking transaction, so on each shard they are committed in increasing order, and
+reading the appointments above the largest ID seen so far is a key range seek over the new rows.
+The outbox key and the existence check in "reminder.queue" keep overlaps and appointments
+cancelled by other processes out of the outbox.
+'''
+
+from db.ConnectionManager import DBError, DBIntegrityError
+from db.ShardRouter import ShardRouter
+from db.LazyIndex import LazyIndex
+from collections import defaultdict
+import os
+import time
+import heapq
+import datetime
+import threading
+
+REMINDERS = (("24h", datetime.timedelta(hours=24)), ("1h", datetime.timedelta(hours=1)))
+# upper bound on how long the worker sleeps, so a clock change is noticed eventually
+MAX_WAIT_SECONDS = 60.0
+# how often the worker reads the appointments booked by other processes
+POLL_SECONDS = float(os.getenv("ReminderPollSeconds", "30"))
+
+
+def appointment_start(d, minute):
+    # appointments start minute minutes after midnight of their date
+    return datetime.datetime.combine(d, datetime.time()) + datetime.timedelta(minutes=minute)
+
+
+class ReminderQueue(LazyIndex):
+    def __init__(self, batch_size=100):
+        if batch_size <= 0:
+            raise ValueError("Batch size must be positive!")
+        self.cond = threading.Condition()
+        super().__init__(self.cond)
+        self.batch_size = batch_size
+        # heap of (due, appoint_id, kind, start); cancelled entries are dropped when they surface
+        self.heap = []
+        # (appoint_id, kind) -> due time of every reminder that is still wanted
+        self.pending = {}
+        self.queued = 0
+        # shard -> largest appointment ID read from it
+        self.last_seen = {}
+        self.thread = None
+        self.stopping = False
+
+    def _push(self, appoint_id, d, minute, skip=()):
+        start = appointment_start(d, minute)
+        for kind, offset in REMINDERS:
+            key = (appoint_id, kind)
+            if key in skip or key in self.pending:
+                continue
+            self.pending[key] = start - offset
+            heapq.heappush(self.heap, (start - offset, appoint_id, kind, start))
+
+    def _load(self):
+        today = datetime.date.today()
+
+        def upcoming(cm):
+            # the largest ID is read first, so a booking committed meanwhile is caught up rather than missed
+            last_id = cm.first("appointment.max_id")[0] or 0
+            appointments = [(row[0], row[1], row[2]) for row in cm.execute("reminder.upcoming", today)]
+            queued = set((row[0], row[1]) for row in cm.execute("reminder.queued", today))
+            return cm.shard, last_id, appointments, queued
+
+        for shard, last_id, appointments, queued in ShardRouter().fan_out(upcoming):
+            self.last_seen[shard] = last_id
+            for appoint_id, d, minute in appointments:
+                self._push(appoint_id, d, minute, queued)
+        self.cond.notify()
+
+    def load(self):
+        '''
+        Fills the heap with the reminders of every upcoming appointment not yet in the outbox.
+        '''
+        self.read(lambda: None)
+
+    def add(self, appointments):
+        '''
+        Schedules reminders for newly booked appointments, given as (appointment ID, date, start minute).
+        '''
+        def push():
+            earliest = self.heap[0][0] if self.heap else None
+            for appoint_id, d, minute in appointments:
+                self._push(appoint_id, d, minute)
+            # wake the worker if one of them is now the first reminder due
+            if self.heap and (earliest is None or self.heap[0][0] < earliest):
+                self.cond.notify()
+
+        self.update(push)
+
+    def catch_up(self):
+        '''
+        Schedules reminders for the appointments booked on any shard since they were last read, and
+        returns how many appointments were read.
+        '''
+        with self.cond:
+            last_seen = dict(self.last_seen)
+
+        def new(cm):
+            return cm.shard, cm.execute("reminder.new", last_seen.get(cm.shard, 0)).fetchall()
+
+        results = ShardRouter().fan_out(new)
+        now = datetime.datetime.now()
+        read = 0
+        with self.cond:
+            earliest = self.heap[0][0] if self.heap else None
+            for shard, rows in results:
+                for appoint_id, d, minute in rows:
+                    self.last_seen[shard] = max(self.last_seen.get(shard, 0), appoint_id)
+                    if appointment_start(d, minute) > now:
+                        self._push(appoint_id, d, minute)
+                read += len(rows)
+            if self.heap and (earliest is None or self.heap[0][0] < earliest):
+                self.cond.notify()
+        return read
+
+    def remove(self, appoint_ids):
+        '''
+        Drops the reminders of cancelled appointments.
+        '''
+        with self.cond:
+            for appoint_id in appoint_ids:
+                for kind, _ in REMINDERS:
+                    self.pending.pop((appoint_id, kind), None)
+            # rebuild once cancelled entries make up most of the heap
+            if len(self.heap) > 2 * len(self.pending) + 64:
+                self.heap = [entry for entry in self.heap if self.pending.get((entry[1], entry[2])) == entry[0]]
+                heapq.heapify(self.heap)
+
+    def _take_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            entry = heapq.heappop(self.heap)
+            due_at, appoint_id, kind, start = entry
+            if self.pending.get((appoint_id, kind)) != due_at:
+                continue
+            del self.pending[(appoint_id, kind)]
+            # a reminder that comes due only after its appointment began is no longer useful
+            if start > now:
+                due.append(entry)
+        return due
+
+    def flush(self, now=None):
+        '''
+        Queues every reminder due by now into the outbox, one transaction per shard and batch,
+        and returns the number of outbox rows written.
+        '''
+        now = now or datetime.datetime.now()
+        written = 0
+        while True:
+            with self.cond:
+                batch = self._take_due(now)
+            if not batch:
+                return written
+            by_shard = defaultdict(list)
+            router = ShardRouter()
+            for entry in batch:
+                by_shard[router.shard_for_appointment(entry[1])].append(entry)
+            for shard, entries in by_shard.items():
+                written += self._write(router.for_shard(shard), entries, now)
+
+    def _write(self, cm, entries, now):
+        conn = cm.create_connection()
+        try:
+            written = 0
+            for due_at, appoint_id, kind, _ in entries:
+                written += cm.execute("reminder.queue", (kind, due_at, now, appoint_id)).rowcount
+            conn.commit()
+        except DBIntegrityError:
+            # another process queued one of them at the same time; the batch is retried row by row
+            conn.rollback()
+            written = 0
+            for due_at, appoint_id, kind, _ in entries:
+                try:
+                    written += cm.execute("reminder.queue", (kind, due_at, now, appoint_id)).rowcount
+                    conn.commit()
+                except DBIntegrityError:
+                    conn.rollback()
+        except DBError:
+            print("Error occurred while queueing reminders")
+            conn.rollback()
+            self._requeue(entries)
+            raise
+        finally:
+            cm.close_connection()
+        with self.cond:
+            self.queued += written
+        return written
+
+    def _requeue(self, entries):
+        with self.cond:
+            for entry in entries:
+                self.pending[(entry[1], entry[2])] = entry[0]
+                heapq.heappush(self.heap, entry)
+
+    def _run(self):
+        next_poll = time.monotonic() + POLL_SECONDS
+        while True:
+            with self.cond:
+                if self.stopping:
+                    return
+                wait = min(MAX_WAIT_SECONDS, max(0.0, next_poll - time.monotonic()))
+                if self.heap:
+                    wait = min(wait, max(0.0, (self.heap[0][0] - datetime.datetime.now()).total_seconds()))
+                self.cond.wait(wait)
+                if self.stopping:
+                    return
+            try:
+                if time.monotonic() >= next_poll:
+                    next_poll = time.monotonic() + POLL_SECONDS
+                    self.catch_up()
+                self.flush()
+            except DBError as e:
+                print("Db-Error:", e)
+                with self.cond:
+                    self.cond.wait(MAX_WAIT_SECONDS)
+
+    def start(self):
+        '''
+        Loads the pending reminders and starts the background worker.
+        '''
+        self.load()
+        self.thread = threading.Thread(target=self._run, name="reminders", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        with self.cond:
+            return {"pending": len(self.pending), "queued": self.queued}
+
+
+def enabled():
+    # the worker runs inside the scheduler process when ReminderWorker is set
+    return os.getenv("ReminderWorker", "") not in ("", "0")
+
+
+reminders = ReminderQueue(int(os.getenv("ReminderBatchSize", "100")))
@@ -0,0 +1,66 @@
+from db.ConnectionManager import ConnectionManager, shard_databases
+from concurrent.futures import ThreadPoolExecutor
+import zlib
+
+
+class ShardRouter:
+    '''
+    Routes work to the shard that owns it.
+    Caregivers, Availabilities and Appointments are partitioned by a hash of the caregiver username;
+    Patients and Vaccines are not partitioned and live on the home shard (shard 0).
+    Appointment IDs are minted so that AppointID % shard_count is the owning shard,
+    which lets cancel route by ID alone. With a single configured database every route is shard 0.
+    '''
+
+    HOME = 0
+
+    def __init__(self):
+        self.shard_count = len(shard_databases())
+
+    def shard_for_caregiver(self, username):
+        # crc32 is stable across processes, unlike the built-in hash()
+        return zlib.crc32(username.encode("utf-8")) % self.shard_count
+
+    def shard_for_appointment(self, appoint_id):
+        return int(appoint_id) % self.shard_count
+
+    def shard_for_date(self, d):
+        # starting shard when probing for any caregiver on a date, spreads reserve load evenly
+        return d.toordinal() % self.shard_count
+
+    def home(self):
+        return ConnectionManager(self.HOME)
+
+    def for_shard(self, shard):
+        return ConnectionManager(shard)
+
+    def for_caregiver(self, username):
+        return ConnectionManager(self.shard_for_caregiver(username))
+
+    def for_appointment(self, appoint_id):
+        return ConnectionManager(self.shard_for_appointment(appoint_id))
+
+    def next_appoint_id(self, local_max, shard):
+        '''
+        Returns the next appointment ID on a shard given the largest ID already stored there.
+        '''
+        local_max = 0 if local_max is None else int(local_max)
+        return (local_max // self.shard_count + 1) * self.shard_count + shard
+
+    def fan_out(self, func):
+        '''
+        Calls func(cm) on every shard in parallel, each with its own open connection,
+        and returns the results in shard order.
+        '''
+        def run(shard):
+            cm = ConnectionManager(shard)
+            cm.create_connection()
+            try:
+                return func(cm)
+            finally:
+                cm.close_connection()
+
+        if self.shard_count == 1:
+            return [run(self.HOME)]
+        with ThreadPoolExecutor(max_workers=self.shard_count) as pool:
+            return list(pool.map(run, range(self.shard_count)))
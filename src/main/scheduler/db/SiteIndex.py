@@ -0,0 +1,96 @@
+'''
+In-memory spatial index of clinic sites for nearest-site searches.
+Sites are bucketed into a fixed grid of CELL_DEGREES squares; a radius query only looks at the
+cells overlapping the radius' bounding box, so its cost depends on the sites nearby rather than
+on the total number of sites. The index is loaded once per process and extended by add_site.
+'''
+
+from db.ShardRouter import ShardRouter
+from db.LazyIndex import LazyIndex
+from collections import defaultdict
+import math
+
+CELL_DEGREES = 0.5
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    # haversine great-circle distance
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SiteIndex(LazyIndex):
+    def __init__(self):
+        super().__init__()
+        self.sites = None
+        self.grid = defaultdict(list)
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / CELL_DEGREES), math.floor(lon / CELL_DEGREES)
+
+    def _insert(self, site_id, lat, lon):
+        self.sites[site_id] = (lat, lon)
+        self.grid[self._cell(lat, lon)].append(site_id)
+
+    def _load(self):
+        cm = ShardRouter().home()
+        cm.create_connection()
+        try:
+            rows = cm.execute("site.all").fetchall()
+        finally:
+            cm.close_connection()
+        self.sites = {}
+        for row in rows:
+            self._insert(row[0], row[1], row[2])
+
+    def add(self, site_id, lat, lon):
+        def insert():
+            if site_id not in self.sites:
+                self._insert(site_id, lat, lon)
+
+        self.update(insert)
+
+    def contains(self, site_id):
+        return self.read(lambda: site_id in self.sites)
+
+    def within(self, lat, lon, radius_km):
+        '''
+        Returns (distance in km, site ID) for every site within radius_km, nearest first.
+        '''
+        return self.read(lambda: self._within(lat, lon, radius_km))
+
+    def _within(self, lat, lon, radius_km):
+        lat_span = radius_km / KM_PER_DEGREE
+        lon_span = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + lat_span, 89.9))), 1e-6))
+        lat_lo, lon_lo = self._cell(max(lat - lat_span, -90.0), lon - lon_span)
+        lat_hi, lon_hi = self._cell(min(lat + lat_span, 90.0), lon + lon_span)
+
+        found = set()
+        if lon_span >= 180 or (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) > len(self.grid):
+            # the box wraps around the globe or covers more cells than are occupied;
+            # scanning the occupied cells of the latitude band is then cheaper
+            for (cell_lat, _), site_ids in self.grid.items():
+                if lat_lo <= cell_lat <= lat_hi:
+                    found.update(site_ids)
+        else:
+            half_turn = round(180 / CELL_DEGREES)
+            for cell_lat in range(lat_lo, lat_hi + 1):
+                for cell_lon in range(lon_lo, lon_hi + 1):
+                    # wrap into [-180, 180) so boxes crossing the antimeridian still match
+                    wrapped = (cell_lon + half_turn) % (2 * half_turn) - half_turn
+                    found.update(self.grid.get((cell_lat, wrapped), ()))
+
+        nearby = []
+        for site_id in found:
+            site_lat, site_lon = self.sites[site_id]
+            d = distance_km(lat, lon, site_lat, site_lon)
+            if d <= radius_km:
+                nearby.append((d, site_id))
+        return sorted(nearby)
+
+
+sites = SiteIndex()
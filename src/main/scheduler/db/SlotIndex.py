@@ -0,0 +1,128 @@
+'''
+Time slots within a day, kept as an interval index per caregiver and day.
+A caregiver's free time on a day is stored in Availabilities as disjoint intervals
+[StartMinute, EndMinute) in minutes after midnight, keyed by (Time, Username, StartMinute).
+That key orders the intervals of one caregiver and day by start, so every operation below is a
+constant number of index seeks, O(log n), however many intervals the day holds:
+
+    find     the interval holding a slot is the last one starting at or before the slot
+    book     that interval is replaced by what is left of it on either side of the slot
+    release  the freed slot is merged with the intervals ending where it starts and starting where it ends
+
+Appointments last APPOINTMENT_MINUTES (AppointmentMinutes, default 15); availability uploaded
+without hours covers WORKDAY (WorkdayHours, default 09:00-17:00).
+An interval is only replaced while it is exactly as it was read, so two sessions booking the same
+caregiver at once cannot both take the same time.
+'''
+
+import os
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_time(text):
+    '''
+    Returns the minutes after midnight of a time given as HH:MM; 24:00 is the end of the day.
+    '''
+    hours, sep, minutes = text.partition(":")
+    if not sep or not hours.isdigit() or len(minutes) != 2 or not minutes.isdigit():
+        raise ValueError(f"Invalid time '{text}', expected HH:MM")
+    minute = int(hours) * 60 + int(minutes)
+    if int(minutes) >= 60 or minute > MINUTES_PER_DAY:
+        raise ValueError(f"Invalid time '{text}', expected HH:MM")
+    return minute
+
+
+def format_time(minute):
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def parse_hours(text):
+    '''
+    Returns (start, end) minutes of hours given as HH:MM-HH:MM.
+    '''
+    start, sep, end = text.partition("-")
+    if not sep:
+        raise ValueError(f"Invalid hours '{text}', expected HH:MM-HH:MM")
+    start, end = parse_time(start), parse_time(end)
+    if start >= end:
+        raise ValueError("The hours must end after they start!")
+    return start, end
+
+
+def format_hours(start, end):
+    return f"{format_time(start)}-{format_time(end)}"
+
+
+APPOINTMENT_MINUTES = int(os.getenv("AppointmentMinutes", "15"))
+WORKDAY = parse_hours(os.getenv("WorkdayHours", "09:00-17:00"))
+
+
+class SlotIndex:
+    '''
+    Interval operations on the shard of cm, which must have an open connection.
+    Nothing is committed here: the changes belong to the caller's transaction.
+    '''
+    def __init__(self, cm):
+        self.cm = cm
+
+    def _before(self, d, username, minute):
+        # the interval of the day starting last before minute
+        return self.cm.first("availability.before", (d, username, minute), as_dict=True)
+
+    def _from(self, d, username, minute):
+        # the interval of the day starting first at or after minute
+        return self.cm.first("availability.from", (d, username, minute), as_dict=True)
+
+    def _replace(self, d, username, row):
+        # an interval that changed since it was read counts as taken
+        if self.cm.execute("availability.delete", (d, username, row["StartMinute"], row["EndMinute"])).rowcount != 1:
+            raise LookupError(f"{username} is no longer available on {d}")
+
+    def find(self, d, username, start, end):
+        '''
+        Returns the free interval of the caregiver that holds [start, end) on the date, or None.
+        '''
+        row = self._before(d, username, start + 1)
+        return row if row is not None and row["EndMinute"] >= end else None
+
+    def book(self, d, username, start, end):
+        '''
+        Takes [start, end) out of the caregiver's free time on the date and returns the site of
+        the interval it came from. Raises LookupError when the time is not free (any more).
+        '''
+        row = self.find(d, username, start, end)
+        if row is None:
+            raise LookupError(f"{username} is no longer available on {d}")
+        self._replace(d, username, row)
+        if row["StartMinute"] < start:
+            self.cm.execute("availability.insert", (d, username, row["SiteID"], row["StartMinute"], start))
+        if end < row["EndMinute"]:
+            self.cm.execute("availability.insert", (d, username, row["SiteID"], end, row["EndMinute"]))
+        return row["SiteID"]
+
+    def release(self, d, username, start, end, site_id):
+        '''
+        Gives [start, end) back to the caregiver's free time on the date, merged with adjacent free
+        intervals at the same site. Raises LookupError when part of it is free already.
+        '''
+        before = self._before(d, username, start)
+        after = self._from(d, username, start)
+        if (before is not None and before["EndMinute"] > start) or (after is not None and after["StartMinute"] < end):
+            raise LookupError(f"{username} is already available during {format_hours(start, end)} on {d}")
+        if before is not None and before["EndMinute"] == start and before["SiteID"] == site_id:
+            self._replace(d, username, before)
+            start = before["StartMinute"]
+        if after is not None and after["StartMinute"] == end and after["SiteID"] == site_id:
+            self._replace(d, username, after)
+            end = after["EndMinute"]
+        self.cm.execute("availability.insert", (d, username, site_id, start, end))
+
+    def offer(self, d, username, start, end, site_id=None):
+        '''
+        Adds [start, end) to the caregiver's free time on the date. Raises LookupError when it
+        overlaps the caregiver's appointments or free time.
+        '''
+        if self.cm.first("appointment.overlapping", (username, d, end, start))[0]:
+            raise LookupError(f"{username} has an appointment during {format_hours(start, end)} on {d}")
+        self.release(d, username, start, end, site_id)
@@ -0,0 +1,179 @@
+'''
+Columnar snapshot of appointments, availabilities and cancellations for the report command.
+Every table is read in bulk from all shards (archives included) into NumPy arrays: dates are
+day ordinals and names are dictionary-encoded, with a dict lookup per row, into integer codes shared
+by all tables, so the aggregates are computed with bincount over whole columns instead of Python loops over rows.
+A snapshot can be saved to a directory of .npy files and reopened memory-mapped, which makes a
+reload cost no more than the pages the report actually touches.
+'''
+
+from db.ShardRouter import ShardRouter
+from db import SlotIndex
+import os
+import json
+import time
+import datetime
+import operator
+import itertools
+
+# NumPy is only needed for reporting; the rest of the scheduler runs without it.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+COLUMNS = {
+    "appointments": ("day", "cname", "vname"),
+    # minutes of free time per availability interval
+    "availabilities": ("day", "cname", "minutes"),
+    "cancellations": ("day", "cname", "vname"),
+}
+
+
+def available():
+    return np is not None
+
+
+def _field(parts, i):
+    # the i-th field of every row of every shard, iterated without a Python-level loop
+    return itertools.chain.from_iterable(map(operator.itemgetter(i), rows) for rows in parts)
+
+
+class Snapshot:
+    def __init__(self, columns, caregivers, vaccines, created):
+        # columns["appointments"]["day"] etc. are equally long arrays per table
+        self.columns = columns
+        self.caregivers = caregivers
+        self.vaccines = vaccines
+        self.created = created
+
+    @classmethod
+    def from_db(cls):
+        def read(cm):
+            return {
+                "appointments": cm.execute("report.appointments").fetchall(),
+                "availabilities": cm.execute("report.availabilities").fetchall(),
+                "cancellations": cm.execute("report.cancellations").fetchall(),
+            }
+
+        shards = ShardRouter().fan_out(read)
+        parts = {table: [shard[table] for shard in shards] for table in COLUMNS}
+
+        # caregiver and vaccine codes are assigned over all tables at once so they agree, in name order
+        names = {"cname": set(), "vname": set()}
+        for table, fields in COLUMNS.items():
+            for i, field in enumerate(fields):
+                if field in names:
+                    names[field].update(_field(parts[table], i))
+        names = {field: sorted(values) for field, values in names.items()}
+        codes = {field: {name: code for code, name in enumerate(values)} for field, values in names.items()}
+
+        # each typed column is filled straight from its field of the rows, names through a dict lookup
+        columns = {}
+        for table, fields in COLUMNS.items():
+            n = sum(len(rows) for rows in parts[table])
+            columns[table] = {}
+            for i, field in enumerate(fields):
+                values = _field(parts[table], i)
+                if field in codes:
+                    values = map(codes[field].__getitem__, values)
+                columns[table][field] = np.fromiter(values, dtype=np.int32, count=n)
+        return cls(columns, names["cname"], names["vname"], time.time())
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        meta = os.path.join(directory, "snapshot.json")
+        if os.path.exists(meta):
+            os.remove(meta)
+        for table, columns in self.columns.items():
+            for name, values in columns.items():
+                np.save(os.path.join(directory, f"{table}.{name}.npy"), values)
+        # the metadata is written last, so a snapshot without it is incomplete and never loaded
+        with open(meta, "w", encoding="utf-8") as f:
+            json.dump({"caregivers": self.caregivers, "vaccines": self.vaccines, "created": self.created}, f)
+
+    @classmethod
+    def load(cls, directory, max_age=None):
+        '''
+        Opens a saved snapshot memory-mapped, or returns None if there is none or it is older than max_age seconds.
+        '''
+        try:
+            with open(os.path.join(directory, "snapshot.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if max_age is not None and time.time() - meta["created"] > max_age:
+            return None
+        try:
+            columns = {table: {name: np.load(os.path.join(directory, f"{table}.{name}.npy"), mmap_mode="r") for name in names}
+                       for table, names in COLUMNS.items()}
+        except OSError:
+            # saved by a version with other columns
+            return None
+        return cls(columns, meta["caregivers"], meta["vaccines"], meta["created"])
+
+    def _in_range(self, table, first, last):
+        day = self.columns[table]["day"]
+        return (day >= first.toordinal()) & (day <= last.toordinal())
+
+    def utilization(self, first, last):
+        '''
+        Returns (caregiver, booked slots, offered slots) for every caregiver with slots between the dates.
+        Booked time is taken out of the availabilities, so the offered slots are the booked ones plus
+        the appointments that still fit into each free interval.
+        '''
+        booked = np.bincount(self.columns["appointments"]["cname"][self._in_range("appointments", first, last)],
+                             minlength=len(self.caregivers))
+        availabilities = self.columns["availabilities"]
+        mask = self._in_range("availabilities", first, last)
+        open_slots = np.bincount(availabilities["cname"][mask], weights=availabilities["minutes"][mask] // SlotIndex.APPOINTMENT_MINUTES,
+                                 minlength=len(self.caregivers)).astype(np.int64)
+        offered = booked + open_slots
+        return [(self.caregivers[i], int(booked[i]), int(offered[i])) for i in np.flatnonzero(offered)]
+
+    def doses_per_day(self, first, last):
+        '''
+        Returns (date, vaccine, doses) for every day between the dates on which doses were administered,
+        that is, appointments up to today.
+        '''
+        last = min(last, datetime.date.today())
+        if last < first or not self.vaccines:
+            return []
+        appointments = self.columns["appointments"]
+        mask = self._in_range("appointments", first, last)
+        days = last.toordinal() - first.toordinal() + 1
+        # one bin per (day, vaccine) pair
+        bins = (appointments["day"][mask] - first.toordinal()) * len(self.vaccines) + appointments["vname"][mask]
+        counts = np.bincount(bins, minlength=days * len(self.vaccines)).reshape(days, len(self.vaccines))
+        day_index, vaccine_index = np.nonzero(counts)
+        return [(datetime.date.fromordinal(first.toordinal() + int(d)), self.vaccines[v], int(counts[d, v]))
+                for d, v in zip(day_index, vaccine_index)]
+
+    def cancellation_rates(self, first, last):
+        '''
+        Returns (vaccine, cancelled, booked) per vaccine for appointments dated between the dates,
+        where booked counts every appointment made, cancelled or not.
+        '''
+        kept = np.bincount(self.columns["appointments"]["vname"][self._in_range("appointments", first, last)],
+                           minlength=len(self.vaccines))
+        cancelled = np.bincount(self.columns["cancellations"]["vname"][self._in_range("cancellations", first, last)],
+                                minlength=len(self.vaccines))
+        booked = kept + cancelled
+        return [(self.vaccines[i], int(cancelled[i]), int(booked[i])) for i in np.flatnonzero(booked)]
+
+
+def current(refresh=False):
+    '''
+    Returns the snapshot to report from. With ReportSnapshotDir set, a saved snapshot younger than
+    ReportSnapshotTTL seconds is reused and a fresh one is saved there for later reports.
+    '''
+    directory = os.getenv("ReportSnapshotDir")
+    max_age = float(os.getenv("ReportSnapshotTTL", "3600"))
+    if directory and not refresh:
+        snapshot = Snapshot.load(directory, max_age)
+        if snapshot is not None:
+            return snapshot
+    snapshot = Snapshot.from_db()
+    if directory:
+        snapshot.save(directory)
+    return snapshot
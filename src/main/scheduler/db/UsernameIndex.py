@@ -0,0 +1,42 @@
+'''
+In-memory username membership index per role, so signups can skip the existence query.
+The index is loaded once per process and extended on every successful insert. Accounts
+created by other processes may be missing from it, so it can only answer "taken" early;
+the primary key on insert remains the authoritative check for everything else.
+'''
+
+from db.ShardRouter import ShardRouter
+from db.LazyIndex import LazyIndex
+
+
+class UsernameIndex(LazyIndex):
+    def __init__(self, query, sharded=False):
+        super().__init__()
+        self.query = query
+        self.sharded = sharded
+        self.usernames = None
+
+    def _load(self):
+        def usernames(cm):
+            return [row[0] for row in cm.execute(self.query)]
+
+        router = ShardRouter()
+        if self.sharded:
+            self.usernames = set(username for shard in router.fan_out(usernames) for username in shard)
+            return
+        cm = router.home()
+        cm.create_connection()
+        try:
+            self.usernames = set(usernames(cm))
+        finally:
+            cm.close_connection()
+
+    def contains(self, username):
+        return self.read(lambda: username in self.usernames)
+
+    def add(self, username):
+        self.update(lambda: self.usernames.add(username))
+
+
+patients = UsernameIndex("patient.usernames")
+caregivers = UsernameIndex("caregiver.usernames", sharded=True)
@@ -2,8 +2,10 @@ import sys
 sys.path.append("../util/*")
 sys.path.append("../db/*")
 from util.Util import Util
-from db.ConnectionManager import ConnectionManager
-import pymssql
+from db import UsernameIndex
+from db import SlotIndex
+from db.ConnectionManager import DBError
+from db.ShardRouter import ShardRouter
 
 
 class Caregiver:
@@ -15,13 +17,12 @@ class Caregiver:
 
     # getters
     def get(self):
-        cm = ConnectionManager()
+        # caregiver accounts live on the shard that owns their availabilities and appointments
+        cm = ShardRouter().for_caregiver(self.username)
         conn = cm.create_connection()
-        cursor = conn.cursor(as_dict=True)
 
-        get_caregiver_details = "SELECT Salt, Hash FROM Caregivers WHERE Username = %s"
         try:
-            cursor.execute(get_caregiver_details, self.username)
+            cursor = cm.execute("caregiver.get", self.username, as_dict=True)
             for row in cursor:
                 curr_salt = row['Salt']
                 curr_hash = row['Hash']
@@ -35,7 +36,7 @@ class Caregiver:
                     self.hash = calculated_hash
                     cm.close_connection()
                     return self
-        except pymssql.Error as e:
+        except DBError as e:
             print("Error occurred when fetching current caregiver")
             raise e
         finally:
@@ -52,30 +53,28 @@ class Caregiver:
         return self.hash
 
     def save_to_db(self):
-        cm = ConnectionManager()
+        cm = ShardRouter().for_caregiver(self.username)
         conn = cm.create_connection()
-        cursor = conn.cursor()
 
-        add_caregivers = "INSERT INTO Caregivers VALUES (%s, %s, %s)"
         try:
-            cursor.execute(add_caregivers, (self.username, self.salt, self.hash))
+            cm.execute("caregiver.insert", (self.username, self.salt, self.hash))
             conn.commit()
-        except pymssql.Error:
+            UsernameIndex.caregivers.add(self.username)
+        except DBError:
             raise
         finally:
             cm.close_connection()
 
-    # Insert availability with parameter date d
-    def upload_availability(self, d):
-        cm = ConnectionManager()
+    # Offer the hours (start, end) in minutes of date d, the whole workday by default, optionally at a clinic site;
+    # raises LookupError when they overlap time already offered or booked
+    def upload_availability(self, d, site_id=None, hours=SlotIndex.WORKDAY):
+        cm = ShardRouter().for_caregiver(self.username)
         conn = cm.create_connection()
-        cursor = conn.cursor()
 
-        add_availability = "INSERT INTO Availabilities VALUES (%s , %s)"
         try:
-            cursor.execute(add_availability, (d, self.username))
+            SlotIndex.SlotIndex(cm).offer(d, self.username, hours[0], hours[1], site_id)
             conn.commit()
-        except pymssql.Error:
+        except DBError:
             print("Error occurred when updating caregiver availability")
             raise
         finally:
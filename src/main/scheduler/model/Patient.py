@@ -2,8 +2,8 @@ import sys
 sys.path.append("../util/*")
 sys.path.append("../db/*")
 from util.Util import Util
-from db.ConnectionManager import ConnectionManager
-import pymssql
+from db import UsernameIndex
+from db.ConnectionManager import ConnectionManager, DBError
 
 
 class Patient:
@@ -17,11 +17,9 @@ class Patient:
     def get(self):
         cm = ConnectionManager()
         conn = cm.create_connection()
-        cursor = conn.cursor(as_dict=True)
 
-        get_patient_details = "SELECT Salt, Hash FROM Patients WHERE Username = %s"
         try:
-            cursor.execute(get_patient_details, self.username)
+            cursor = cm.execute("patient.get", self.username, as_dict=True)
             for row in cursor:
                 curr_salt = row['Salt']
                 curr_hash = row['Hash']
@@ -35,7 +33,7 @@ class Patient:
                     self.hash = calculated_hash
                     cm.close_connection()
                     return self
-        except pymssql.Error as e:
+        except DBError as e:
             print("Error occurred when fetching current patient")
             raise e
         finally:
@@ -54,13 +52,12 @@ class Patient:
     def save_to_db(self):
         cm = ConnectionManager()
         conn = cm.create_connection()
-        cursor = conn.cursor()
 
-        add_patients = "INSERT INTO Patients VALUES (%s, %s, %s)"
         try:
-            cursor.execute(add_patients, (self.username, self.salt, self.hash))
+            cm.execute("patient.insert", (self.username, self.salt, self.hash))
             conn.commit()
-        except pymssql.Error:
+            UsernameIndex.patients.add(self.username)
+        except DBError:
             raise
         finally:
             cm.close_connection()
@@ -1,10 +1,15 @@
 import sys
 sys.path.append("../db/*")
-from db.ConnectionManager import ConnectionManager
-import pymssql
+from db.ConnectionManager import ConnectionManager, DBError
+from db import GroupCommit
+import datetime
 
 
 class Vaccine:
+    # Doses added without a lot go to a per-vaccine lot that never expires,
+    # so first-expired-first-out allocation always drains real lots first.
+    NO_EXPIRY = datetime.date(9999, 12, 31)
+
     def __init__(self, vaccine_name, available_doses):
         self.vaccine_name = vaccine_name
         self.available_doses = available_doses
@@ -13,15 +18,13 @@ class Vaccine:
     def get(self):
         cm = ConnectionManager()
         conn = cm.create_connection()
-        cursor = conn.cursor()
 
-        get_vaccine = "SELECT Name, Doses FROM Vaccines WHERE Name = %s"
         try:
-            cursor.execute(get_vaccine, self.vaccine_name)
+            cursor = cm.execute("vaccine.get", self.vaccine_name)
             for row in cursor:
                 self.available_doses = row[1]
                 return self
-        except pymssql.Error:
+        except DBError:
             print("Error occurred when getting Vaccine")
             raise
         finally:
@@ -34,63 +37,160 @@ class Vaccine:
     def get_available_doses(self):
         return self.available_doses
 
-    def save_to_db(self):
+    def default_lot(self):
+        return f"{self.vaccine_name}-unlotted"
+
+    def save_to_db(self, lot_id=None, expiry=None, site_id=None):
         if self.available_doses is None or self.available_doses <= 0:
             raise ValueError("Argument cannot be negative!")
 
         cm = ConnectionManager()
         conn = cm.create_connection()
-        cursor = conn.cursor()
 
-        add_doses = "INSERT INTO VACCINES VALUES (%s, %d)"
         try:
-            cursor.execute(add_doses, (self.vaccine_name, self.available_doses))
+            cm.execute("vaccine.insert", (self.vaccine_name, self.available_doses))
+            self._add_to_lot(cm, self.available_doses, lot_id, expiry, site_id)
             conn.commit()
-        except pymssql.Error:
+        except DBError:
             print("Error occurred when insert Vaccines")
+            conn.rollback()
             raise
         finally:
             cm.close_connection()
 
-    # Increase the number of vaccine doese available
-    def increase_available_doses(self, num):
+    # Increase the number of vaccine doese available, in the given lot (created at site_id if new)
+    def increase_available_doses(self, num, lot_id=None, expiry=None, site_id=None):
         if num <= 0:
             raise ValueError("Argument cannot be negative!")
-        self.available_doses += num
 
         cm = ConnectionManager()
         conn = cm.create_connection()
-        cursor = conn.cursor()
 
-        update_vaccine_availability = "UPDATE vaccines SET Doses = %d WHERE name = %s"
         try:
-            cursor.execute(update_vaccine_availability, (self.available_doses, self.vaccine_name))
+            cm.execute("vaccine.change_doses", (num, self.vaccine_name))
+            self._add_to_lot(cm, num, lot_id, expiry, site_id)
             conn.commit()
-        except pymssql.Error:
+            self.available_doses += num
+        except DBError:
             print("Error occurred when updating vaccine availability")
+            conn.rollback()
             raise
         finally:
             cm.close_connection()
 
-    # Decrease the number of vaccine doses available
-    def decrease_available_doses(self, num):
-        if self.available_doses - num < 0:
-            ValueError("Not enough available doses!")
-        self.available_doses -= num
-
+    # Take one dose per (date, site ID) in a single transaction and return the lot ID of each, in order
+    def allocate_doses(self, doses):
+        if GroupCommit.enabled():
+            # the allocation joins the next commit group of the home shard, which holds the vaccines
+            lot_ids = GroupCommit.for_shard(0).run(lambda cm: self.take_doses(cm, doses))
+        else:
+            cm = ConnectionManager()
+            conn = cm.create_connection()
+
+            try:
+                lot_ids = self.take_doses(cm, doses)
+                conn.commit()
+            except DBError + (ValueError,):
+                conn.rollback()
+                raise
+            finally:
+                cm.close_connection()
+        if self.available_doses is not None:
+            self.available_doses -= len(doses)
+        return lot_ids
+
+    # Take one dose per (date, site ID) within the open transaction of cm, a connection to the home shard,
+    # and return the lot ID of each; the caller commits
+    def take_doses(self, cm, doses):
+        lot_ids = [self._take_dose(cm, d, site_id) for d, site_id in doses]
+        cm.execute("vaccine.change_doses", (-len(doses), self.vaccine_name))
+        return lot_ids
+
+    # Return one dose per lot ID in the caller's transaction on the home shard; the caller commits
+    def put_back_doses(self, cm, lot_ids):
+        for lot_id in lot_ids:
+            self._add_to_lot(cm, 1, lot_id or self.default_lot(), None, None)
+        cm.execute("vaccine.change_doses", (len(lot_ids), self.vaccine_name))
+
+    # Return one dose per lot ID in a single transaction
+    def return_doses(self, lot_ids):
         cm = ConnectionManager()
         conn = cm.create_connection()
-        cursor = conn.cursor()
 
-        update_vaccine_availability = "UPDATE vaccines SET Doses = %d WHERE name = %s"
         try:
-            cursor.execute(update_vaccine_availability, (self.available_doses, self.vaccine_name))
+            self.put_back_doses(cm, lot_ids)
             conn.commit()
-        except pymssql.Error:
+            if self.available_doses is not None:
+                self.available_doses += len(lot_ids)
+        except DBError:
             print("Error occurred when updating vaccine availability")
+            conn.rollback()
+            raise
+        finally:
+            cm.close_connection()
+
+    # Returns (dose count, minimum interval days, maximum interval days); vaccines without a regimen take one dose
+    def get_regimen(self):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+
+        try:
+            row = cm.first("regimen.get", self.vaccine_name)
+            if row is None:
+                return 1, 0, 0
+            return row[0], row[1], row[2]
+        except DBError:
+            print("Error occurred when getting vaccine regimen")
             raise
         finally:
             cm.close_connection()
 
+    def set_regimen(self, dose_count, min_interval, max_interval):
+        if dose_count <= 0 or min_interval <= 0 or max_interval < min_interval:
+            raise ValueError("Dose count and intervals must be positive, with the minimum interval not above the maximum!")
+
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+
+        try:
+            if cm.execute("regimen.update", (dose_count, min_interval, max_interval, self.vaccine_name)).rowcount == 0:
+                cm.execute("regimen.insert", (self.vaccine_name, dose_count, min_interval, max_interval))
+            conn.commit()
+        except DBError:
+            print("Error occurred when updating vaccine regimen")
+            conn.rollback()
+            raise
+        finally:
+            cm.close_connection()
+
+    # A dose comes from a lot at the appointment's site, or else from the central stock of lots without a site;
+    # appointments without a site only draw on the central stock
+    def _take_dose(self, cm, d, site_id):
+        while True:
+            # served by the (Vname, SiteID, Expiry) index, so each lookup is a seek rather than a scan of all lots
+            row = None
+            if site_id is not None:
+                row = cm.first("lot.first_valid_at_site", (self.vaccine_name, site_id, d))
+            if row is None:
+                row = cm.first("lot.first_valid_unsited", (self.vaccine_name, d))
+            if row is None:
+                where = f"at site {site_id} or in central stock" if site_id is not None else "in central stock"
+                raise ValueError(f"No lot of this vaccine {where} is valid on the appointment date!")
+            # another session may have taken the lot's last dose in between; pick again if so
+            if cm.execute("lot.take_dose", row[0]).rowcount == 1:
+                return row[0]
+
+    # A lot number names one delivery with one expiry date: doses for a known lot must not bring another expiry
+    def _add_to_lot(self, cm, num, lot_id, expiry, site_id):
+        if lot_id is None:
+            lot_id = self.default_lot()
+        row = cm.first("lot.expiry", (lot_id, self.vaccine_name))
+        if row is None:
+            cm.execute("lot.insert", (lot_id, self.vaccine_name, num, expiry or self.NO_EXPIRY, site_id))
+            return
+        if expiry is not None and row[0] != expiry:
+            raise ValueError(f"Lot {lot_id} expires on {row[0]}, not on {expiry}!")
+        cm.execute("lot.add_doses", (num, lot_id, self.vaccine_name))
+
     def __str__(self):
         return f"(Vaccine Name: {self.vaccine_name}, Available Doses: {self.available_doses})"
@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    '''
+    A bounded least-recently-used cache whose entries also expire after ttl seconds.
+    All operations take a lock, so one instance can be shared by every session in a process.
+
+    A fill can race with a write: a session reads the database, another session writes and invalidates
+    the key, and the first one then puts what it read before the write. So every invalidation stamps its
+    key with the next generation, and a reader takes generation() before it reads the database and passes
+    it to put, which drops the value when its key was invalidated after that generation. The stamps of
+    the least recently invalidated keys are forgotten beyond capacity; such keys count as invalidated at
+    the newest forgotten stamp, which can only drop a fill, never keep a stale one.
+    '''
+
+    def __init__(self, capacity=256, ttl=30.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # key -> generation of its last invalidation, least recently invalidated first
+        self.invalidated = OrderedDict()
+        self.current = 0
+        self.forgotten = 0
+        self.dropped = 0
+
+    def generation(self):
+        '''
+        Returns the current generation, to be passed to put for a value read from here on.
+        '''
+        with self.lock:
+            return self.current
+
+    def get(self, key):
+        '''
+        Returns the cached value, or None on a miss or an expired entry.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation=None):
+        '''
+        Caches the value, unless the key was invalidated after the given generation.
+        '''
+        with self.lock:
+            if generation is not None and self.invalidated.get(key, self.forgotten) > generation:
+                self.dropped += 1
+                return
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.current += 1
+            self.invalidated[key] = self.current
+            self.invalidated.move_to_end(key)
+            while len(self.invalidated) > self.capacity:
+                self.forgotten = self.invalidated.popitem(last=False)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            # every key counts as invalidated now
+            self.current += 1
+            self.invalidated.clear()
+            self.forgotten = self.current
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "dropped_fills": self.dropped,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Caches behind search_caregiver_schedule: available caregivers keyed by date, and doses keyed by
+# vaccine name (plus the list of vaccine names under VACCINE_NAMES). Writers invalidate precisely
+# the dates and vaccines they change; the TTL bounds staleness from writes made by other processes.
+VACCINE_NAMES = "*"
+
+caregivers_by_date = LRUCache(int(os.getenv("ScheduleCacheSize", "256")), float(os.getenv("ScheduleCacheTTL", "30")))
+vaccine_stock = LRUCache(int(os.getenv("ScheduleCacheSize", "256")), float(os.getenv("ScheduleCacheTTL", "30")))
@@ -0,0 +1,133 @@
+'''
+Dose-exhaustion forecasting per vaccine.
+The rates come from appointments per vaccine and day over the longest window, counted by the
+database on every shard with a range seek on the appointment date, archives included, so the cost
+grows with the window's appointments rather than with the tables. forecast reads them for every
+vaccine at once; the warning in reserve reads those of the booked vaccine alone, with a seek on
+(Vname, Time).
+Vaccines.Doses already excludes the doses allocated to booked future appointments, so the
+projection is the remaining doses divided by the booking rate; the larger of the short and long
+window rates is used, so a recent surge is not averaged away.
+The booking rate is an approximation: appointments are counted by their appointment date, which
+is when the doses are given, whereas Doses drops when the appointment is booked. While bookings
+grow, and for series whose later doses are booked weeks ahead, the projection lags behind.
+'''
+
+from db.ConnectionManager import DBError
+from db.ShardRouter import ShardRouter
+from util.Cache import LRUCache
+from collections import defaultdict
+import os
+import math
+import datetime
+
+WINDOWS = (7, 28)
+# reserve warns once a vaccine is projected to run out within this many days
+WARNING_DAYS = float(os.getenv("ForecastWarningDays", "7"))
+
+# rates are recomputed at most every ForecastTTL seconds; doses are always current
+rates_cache = LRUCache(capacity=4, ttl=float(os.getenv("ForecastTTL", "300")))
+vaccine_rates_cache = LRUCache(capacity=64, ttl=float(os.getenv("ForecastTTL", "300")))
+
+
+def window_rates(booked, today, windows=WINDOWS):
+    '''
+    Returns {window: doses booked per day} from {date: doses booked} over the longest window.
+    '''
+    return {w: sum(doses for d, doses in booked.items() if d >= today - datetime.timedelta(days=w)) / w for w in windows}
+
+
+def booking_rates(today, windows=WINDOWS):
+    '''
+    Returns {vaccine: ({window: doses booked per day}, doses booked from today on)}, from the bookings
+    per vaccine and day over the longest window and the bookings from today on, on every shard.
+    '''
+    start = today - datetime.timedelta(days=max(windows))
+
+    def counts(cm):
+        daily = cm.execute("forecast.all_daily_bookings", (start, today)).fetchall()
+        daily += cm.execute("forecast.all_daily_bookings_archived", (start, today)).fetchall()
+        return daily, cm.execute("forecast.booked_ahead", today).fetchall()
+
+    booked = defaultdict(lambda: defaultdict(int))
+    ahead = defaultdict(int)
+    for daily, upcoming in ShardRouter().fan_out(counts):
+        for vname, d, doses in daily:
+            booked[vname][d] += doses
+        for vname, doses in upcoming:
+            ahead[vname] += doses
+    return {name: (window_rates(booked[name], today, windows), ahead[name]) for name in set(booked) | set(ahead)}
+
+
+def current_rates(today=None):
+    today = today or datetime.date.today()
+    rates = rates_cache.get(today)
+    if rates is None:
+        rates = booking_rates(today)
+        rates_cache.put(today, rates)
+    return rates
+
+
+def vaccine_rates(vaccine_name, today, windows=WINDOWS):
+    '''
+    Returns {window: doses booked per day} for one vaccine, from its bookings per day on every shard.
+    '''
+    start = today - datetime.timedelta(days=max(windows))
+
+    def daily(cm):
+        rows = cm.execute("forecast.daily_bookings", (vaccine_name, start, today)).fetchall()
+        return rows + cm.execute("forecast.daily_bookings_archived", (vaccine_name, start, today)).fetchall()
+
+    booked = defaultdict(int)
+    for rows in ShardRouter().fan_out(daily):
+        for d, doses in rows:
+            booked[d] += doses
+    return window_rates(booked, today, windows)
+
+
+def current_vaccine_rates(vaccine_name, today=None):
+    today = today or datetime.date.today()
+    rates = vaccine_rates_cache.get((today, vaccine_name))
+    if rates is None:
+        rates = vaccine_rates(vaccine_name, today)
+        vaccine_rates_cache.put((today, vaccine_name), rates)
+    return rates
+
+
+def days_left(doses, rates):
+    '''
+    Returns the projected number of days until the doses run out, or math.inf without recent bookings.
+    '''
+    rate = max(rates.values()) if rates else 0.0
+    if doses <= 0:
+        return 0.0
+    return doses / rate if rate > 0 else math.inf
+
+
+def forecast(stock, today=None):
+    '''
+    Returns (vaccine, doses, {window: rate}, booked ahead, days left) for every (vaccine, doses) pair in stock.
+    '''
+    rates = current_rates(today)
+    result = []
+    for name, doses in stock:
+        window_rates, ahead = rates.get(name, ({w: 0.0 for w in WINDOWS}, 0))
+        result.append((name, doses, window_rates, ahead, days_left(doses, window_rates)))
+    return result
+
+
+def exhaustion_warning(vaccine_name, doses):
+    '''
+    Returns a warning for reserve when the vaccine is projected to run out within WARNING_DAYS, otherwise None.
+    Forecasting is best effort here: when the booking counts cannot be read, no warning is given.
+    '''
+    try:
+        window_rates = current_vaccine_rates(vaccine_name)
+    except DBError:
+        return None
+    left = days_left(doses, window_rates)
+    if left > WARNING_DAYS:
+        return None
+    if doses <= 0:
+        return f"Warning: {vaccine_name} is now out of stock."
+    return f"Warning: {vaccine_name} is projected to run out in about {left:.1f} days ({doses} doses left)."
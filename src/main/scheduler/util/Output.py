@@ -0,0 +1,284 @@
+'''
+Output of command results, for people or for scripts.
+Commands report their data as records: a kind plus named fields, together with the text a person
+sees for it. In the human format that text is printed right away, exactly as before. In the json
+and tsv formats everything a command prints is collected instead (plain prints become messages),
+and the command's whole result is serialized and written in one piece once it has finished:
+
+    json  one object per command: {"command": ..., "records": [{"kind": ..., ...}], "messages": [...]}
+    tsv   "#<kind>" header lines naming the fields, one tab-separated row per record, "message" rows
+          for the messages, and an "#end" line after each command
+
+A thread may have a writer of its own, so that several sessions in one process keep their results apart.
+A transcript keeps what a command reported, records and printed lines in order, so that it can be
+reported again later exactly as it was (db/Idempotency.py does so for retried commands).
+'''
+
+import io
+import sys
+import json
+import datetime
+import threading
+import contextlib
+
+FORMATS = ("human", "json", "tsv")
+
+
+class Result:
+    def __init__(self, command):
+        self.command = command
+        self.records = []
+        self.messages = []
+
+
+class LineBuffer:
+    '''
+    Assembles written text into lines and hands each non-empty one, stripped, to keep().
+    print() writes its arguments in pieces, so a line is only kept once its newline arrives.
+    '''
+    def __init__(self, keep):
+        self.keep = keep
+        self.partial = ""
+
+    def write(self, text):
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            if line.strip():
+                self.keep(line.strip())
+
+    def close_line(self):
+        if self.partial.strip():
+            self.keep(self.partial.strip())
+        self.partial = ""
+
+
+class MessageCapture(io.TextIOBase):
+    '''
+    Collects printed lines as the messages of a result.
+    '''
+    def __init__(self, result):
+        self.result = result
+        self.lines = LineBuffer(result.messages.append)
+
+    def write(self, text):
+        self.lines.write(text)
+        return len(text)
+
+    def close_line(self):
+        self.lines.close_line()
+
+
+# the calling thread's own writer, if any, and the result its prints are collected into
+_local = threading.local()
+_stdout_lock = threading.Lock()
+
+
+class ThreadStdout:
+    '''
+    Stands in for sys.stdout while results are collected: prints go to the collecting thread's
+    result, and those of other threads to the real stdout.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _target(self):
+        return getattr(_local, "capture", None) or self.stream
+
+    def write(self, text):
+        transcript = getattr(_local, "transcript", None)
+        # the text of a record is kept with the record itself
+        if transcript is not None and not getattr(_local, "recording", False):
+            transcript.write(text)
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _route_stdout():
+    # contextlib.redirect_stdout would swap sys.stdout for every thread at once
+    with _stdout_lock:
+        if not isinstance(sys.stdout, ThreadStdout):
+            sys.stdout = ThreadStdout(sys.stdout)
+
+
+class Transcript:
+    '''
+    Everything a command reported, in order: ["record", kind, fields, text] and ["message", line] entries.
+    '''
+    def __init__(self, entries=None):
+        self.entries = entries if entries is not None else []
+        self.lines = LineBuffer(lambda line: self.entries.append(["message", line]))
+
+    def write(self, text):
+        self.lines.write(text)
+
+    def close_line(self):
+        self.lines.close_line()
+
+    def add(self, kind, fields, text):
+        self.entries.append(["record", kind, {k: _value(v) for k, v in fields.items()}, text])
+
+    def messages(self):
+        return [entry[1] for entry in self.entries if entry[0] == "message"]
+
+    def to_json(self):
+        return json.dumps(self.entries, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(json.loads(text))
+
+    def replay(self):
+        '''
+        Reports the entries again through the calling thread's writer.
+        '''
+        for entry in self.entries:
+            if entry[0] == "record":
+                record(entry[1], entry[3], **entry[2])
+            else:
+                print(entry[1])
+
+
+def _value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def _tsv_field(value):
+    value = _value(value)
+    if value is None:
+        return ""
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+class OutputWriter:
+    def __init__(self, fmt="human", stream=None):
+        if fmt not in FORMATS:
+            raise ValueError(f"Output format must be one of {', '.join(FORMATS)}")
+        self.format = fmt
+        # None writes to whatever sys.stdout is when a result is written
+        self.stream = stream
+        self.result = None
+
+    @property
+    def human(self):
+        return self.format == "human"
+
+    def run(self, command, operation, tokens):
+        '''
+        Runs command(operation, tokens) and writes its result; returns the command's return value.
+        '''
+        if self.human:
+            return command(operation, tokens)
+        self.result = Result(operation)
+        capture = MessageCapture(self.result)
+        _route_stdout()
+        _local.capture = capture
+        try:
+            return command(operation, tokens)
+        finally:
+            _local.capture = None
+            capture.close_line()
+            result, self.result = self.result, None
+            stream = self.stream or sys.stdout
+            stream.write(self.render(result))
+            stream.flush()
+
+    def record(self, kind, fields, text=None):
+        if self.result is None:
+            if text is not None:
+                print(text)
+        else:
+            self.result.records.append((kind, fields))
+
+    def render(self, result):
+        if self.format == "json":
+            return json.dumps({
+                "command": result.command,
+                "records": [dict(kind=kind, **{k: _value(v) for k, v in fields.items()}) for kind, fields in result.records],
+                "messages": result.messages,
+            }, separators=(",", ":")) + "\n"
+
+        lines = []
+        header = None
+        for kind, fields in result.records:
+            if (kind, tuple(fields)) != header:
+                header = (kind, tuple(fields))
+                lines.append("\t".join(["#" + kind] + list(fields)))
+            lines.append("\t".join([kind] + [_tsv_field(v) for v in fields.values()]))
+        lines.extend("message\t" + _tsv_field(message) for message in result.messages)
+        lines.append("#end\t" + result.command)
+        return "\n".join(lines) + "\n"
+
+
+# the process-wide writer; start() replaces it according to --format
+writer = OutputWriter()
+
+
+def configure(fmt, stream=None, thread=False):
+    '''
+    Replaces the process-wide writer, or with thread=True sets the calling thread's own writer.
+    '''
+    global writer
+    if thread:
+        _local.writer = OutputWriter(fmt, stream)
+        return _local.writer
+    writer = OutputWriter(fmt, stream)
+    return writer
+
+
+def current():
+    return getattr(_local, "writer", None) or writer
+
+
+def human():
+    return current().human
+
+
+def record(kind, text=None, **fields):
+    '''
+    Adds a record of the given kind to the running command's result. In the human format,
+    text is printed instead; records without text have no human rendering.
+    '''
+    transcript = getattr(_local, "transcript", None)
+    if transcript is None:
+        current().record(kind, fields, text)
+        return
+    transcript.add(kind, fields, text)
+    _local.recording = True
+    try:
+        current().record(kind, fields, text)
+    finally:
+        _local.recording = False
+
+
+@contextlib.contextmanager
+def transcript():
+    '''
+    Keeps a Transcript of what the calling thread reports within the block, which still reaches the writer.
+    '''
+    kept = Transcript()
+    _route_stdout()
+    _local.transcript = kept
+    try:
+        yield kept
+    finally:
+        _local.transcript = None
+        kept.close_line()
+
+
+def line(*args):
+    # the text print(*args) would write, for records whose human layout predates them
+    return " ".join(str(arg) for arg in args)
+
+
+def heading(text):
+    # section titles and similar layout only exist in the human format
+    if current().human:
+        print(text)
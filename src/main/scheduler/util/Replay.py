@@ -0,0 +1,181 @@
+'''
+Replays a command trace recorded by util/Trace.py and reports per-command latency.
+
+    python -m util.Replay <trace> [--code DIR [--code DIR]] [--speed 1|N|max] [--sqlite PATH]
+
+Every recorded session runs as its own Scheduler process, concurrently with the others, and
+commands are sent at their recorded offsets divided by the speed factor ("max" sends them as fast
+as the session accepts them). The replayed processes record their own traces, from which latency
+per command is taken. With two --code directories the same trace runs against each version and
+the report shows the difference. Redacted passwords are replaced by a fixed replay password,
+and accounts that are logged into but never created in the trace are created first.
+With --sqlite, each run starts from a fresh SQLite database built from that version's create.sql;
+otherwise the Azure SQL settings in the environment are used as they are. Comparing two versions
+requires --sqlite, since the second run would otherwise start from the database the first one changed.
+'''
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+from util.Trace import REDACTED
+
+REPLAY_PASSWORD = "replay"
+
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as f:
+        return sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r["t"])
+
+
+def unredact(command):
+    return " ".join(REPLAY_PASSWORD if token == REDACTED else token for token in command.split(" "))
+
+
+def seed_commands(records):
+    '''
+    Returns create commands for accounts that the trace logs into without creating them.
+    '''
+    created = set()
+    seeds = []
+    for record in records:
+        tokens = record["c"].split(" ")
+        if tokens[0] in ("create_patient", "create_caregiver") and len(tokens) > 1:
+            created.add((tokens[0].split("_")[1], tokens[1]))
+        elif tokens[0] in ("login_patient", "login_caregiver") and len(tokens) > 1:
+            account = (tokens[0].split("_")[1], tokens[1])
+            if account not in created:
+                created.add(account)
+                seeds.append(f"create_{account[0]} {account[1]} {REPLAY_PASSWORD}")
+    return seeds
+
+
+def run_session(code_dir, env, commands, offsets, speed, started):
+    process = subprocess.Popen([sys.executable, "Scheduler.py"], cwd=code_dir, env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+    try:
+        for command, offset in zip(commands, offsets):
+            if speed is not None:
+                delay = started + offset / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            process.stdin.write(command + "\n")
+            process.stdin.flush()
+        process.stdin.write("quit\n")
+        process.stdin.close()
+    except BrokenPipeError:
+        # the session ended early, e.g. through an unhandled error
+        pass
+    process.wait()
+
+
+def replay(records, code_dir, speed, sqlite_path=None):
+    '''
+    Replays the trace against one code version and returns the records it produced.
+    '''
+    out_dir = tempfile.mkdtemp(prefix="replay-")
+    env = dict(os.environ)
+    if sqlite_path is not None:
+        if os.path.exists(sqlite_path):
+            os.remove(sqlite_path)
+        with open(os.path.join(code_dir, "..", "resources", "create.sql"), encoding="utf-8") as f:
+            conn = sqlite3.connect(sqlite_path)
+            conn.executescript(f.read())
+            conn.close()
+        env.update(Backend="sqlite", SQLitePath=os.path.abspath(sqlite_path))
+
+    seeds = seed_commands(records)
+    if seeds:
+        setup_env = dict(env, TraceFile=os.devnull)
+        run_session(code_dir, setup_env, seeds, [0] * len(seeds), None, time.monotonic())
+
+    sessions = defaultdict(list)
+    for record in records:
+        if record["c"].split(" ")[0] != "quit":
+            sessions[record["s"]].append(record)
+
+    t0 = records[0]["t"] if records else 0
+    started = time.monotonic()
+    threads = []
+    for session, session_records in sessions.items():
+        session_env = dict(env, TraceFile=os.path.join(out_dir, f"{session}.jsonl"), TraceSession=session)
+        thread = threading.Thread(target=run_session, args=(
+            code_dir, session_env,
+            [unredact(r["c"]) for r in session_records],
+            [r["t"] - t0 for r in session_records],
+            speed, started))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    replayed = []
+    for name in os.listdir(out_dir):
+        replayed.extend(load_trace(os.path.join(out_dir, name)))
+    return replayed
+
+
+def latencies(records):
+    by_command = defaultdict(list)
+    for record in records:
+        operation = record["c"].split(" ")[0]
+        if operation and operation != "quit":
+            by_command[operation].append(record["ms"])
+    return by_command
+
+
+def summary(values):
+    values = sorted(values)
+    return {
+        "n": len(values),
+        "mean": sum(values) / len(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+    }
+
+
+def report(runs):
+    '''
+    Prints latency per command for each run and, for two runs, the change from the first to the second.
+    '''
+    stats = [{op: summary(v) for op, v in latencies(records).items()} for _, records in runs]
+    operations = sorted(set().union(*stats))
+    for i, (code_dir, _) in enumerate(runs):
+        print(f"run {i + 1}: {code_dir}")
+    header = f"{'command':<28}" + "".join(f"{'run %d (ms)' % (i + 1):>26}" for i in range(len(runs)))
+    if len(runs) == 2:
+        header += f"{'p50 diff':>12}"
+    print(header)
+    for op in operations:
+        line = f"{op:<28}"
+        for s in stats:
+            line += f"{'n=%d p50=%.1f p95=%.1f' % (s[op]['n'], s[op]['p50'], s[op]['p95']) if op in s else '-':>26}"
+        if len(runs) == 2 and op in stats[0] and op in stats[1] and stats[0][op]["p50"] > 0:
+            line += f"{(stats[1][op]['p50'] / stats[0][op]['p50'] - 1) * 100:>+11.1f}%"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a scheduler command trace.")
+    parser.add_argument("trace")
+    parser.add_argument("--code", action="append", help="Scheduler directory of a code version (up to two)")
+    parser.add_argument("--speed", default="1", help="1 for real time, N for N times faster, max for no waiting")
+    parser.add_argument("--sqlite", help="SQLite database file to rebuild for each run")
+    args = parser.parse_args()
+
+    code_dirs = args.code or [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    if len(code_dirs) > 2:
+        parser.error("at most two --code directories can be compared")
+    if len(code_dirs) == 2 and args.sqlite is None:
+        parser.error("comparing two --code directories requires --sqlite, so that both runs start from a fresh database")
+    speed = None if args.speed == "max" else float(args.speed)
+
+    records = load_trace(args.trace)
+    runs = [(code_dir, replay(records, code_dir, speed, args.sqlite)) for code_dir in code_dirs]
+    report(runs)
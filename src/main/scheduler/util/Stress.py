@@ -0,0 +1,385 @@
+'''
+Concurrency stress harness for the booking paths, run against fresh local SQLite databases.
+
+    python -m util.Stress [--sessions 200] [--threads 32] [--processes 8] [--session-threads 1] [--shards 1] [--seed 0]
+
+Hundreds of randomized sessions run at once: caregivers upload availability and cancel, patients
+reserve and cancel. Half of the sessions run on a thread pool, each thread driving its own
+Scheduler process through --format json; the other half run on a process pool, each worker
+executing sessions in-process through run_command, --session-threads of them at once on threads.
+Both pools work on the same databases at the same time. Afterwards the booking invariants are checked:
+
+    no caregiver is booked twice at overlapping times, or both booked and still available at a time,
+    and no caregiver's free intervals overlap
+    every vaccine's Doses equal its initial stock minus its active appointments, and its lots agree
+    appointment IDs are unique across all shards
+
+and the booking throughput is reported, overall and as the median over one-second intervals,
+together with the most common errors. The exit status is 1 when an invariant is violated.
+With AdmissionControl set, every session goes through admission control (db/Admission.py) and the
+commands it turns away are counted. --check-shedding also checks that admission control turns
+excess commands away quickly instead of letting them wait out AdmissionMaxWait.
+'''
+
+import io
+import os
+import sys
+import re
+import json
+import time
+import random
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+import tempfile
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+SCHEDULER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VACCINES = ("pfizer", "moderna")
+PASSWORD = "stress"
+
+
+def build_databases(directory, shards):
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, f"shard{i}.db") for i in range(shards)]
+    with open(os.path.join(SCHEDULER_DIR, "..", "resources", "create.sql"), encoding="utf-8") as f:
+        script = f.read()
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        conn.executescript(script)
+        conn.close()
+    return paths
+
+
+class SubprocessSession:
+    '''
+    Sends commands to a Scheduler process started with --format json and reads back one result per command.
+    '''
+    def __init__(self, env):
+        self.process = subprocess.Popen([sys.executable, "Scheduler.py", "--format", "json"], cwd=SCHEDULER_DIR, env=env,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+
+    def send(self, command):
+        self.process.stdin.write(command + "\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        return json.loads(line) if line else {"records": [], "messages": ["session ended"]}
+
+    def close(self):
+        try:
+            self.send("quit")
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+
+
+class InProcessSession:
+    '''
+    Runs commands through the Scheduler module loaded in this process. Login and output belong to
+    the calling thread, so a process can run one session per thread.
+    '''
+    def __init__(self):
+        import Scheduler
+        from util import Output
+        self.scheduler = Scheduler
+        self.buffer = io.StringIO()
+        self.writer = Output.configure("json", self.buffer, thread=True)
+
+    def send(self, command):
+        tokens = command.lower().split(" ")
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.writer.run(self.scheduler.run_safely, tokens[0], tokens)
+        return json.loads(self.buffer.getvalue())
+
+    def close(self):
+        self.scheduler.session.patient = None
+        self.scheduler.session.caregiver = None
+
+
+def date_token(day):
+    return time.strftime("%m-%d-%Y", time.localtime(time.time() + 86400 * (day + 1)))
+
+
+def run_session(spec, send):
+    '''
+    Runs one randomized session and returns its counters and the times of its successful bookings.
+    '''
+    rng = random.Random(spec["seed"])
+    stats = Counter()
+    booked_at = []
+    booked = []
+
+    def command(text):
+        stats["commands"] += 1
+        result = send(text)
+        # turned away by admission control (AdmissionControl)
+        stats["shed"] += any(record["kind"] == "busy" for record in result["records"])
+        errors = [message for message in result["messages"] if "Error" in message]
+        if errors:
+            stats["errors"] += 1
+            # counted per message, with names, dates and IDs masked so that alike errors add up
+            stats.update("error: " + re.sub(r"\S*\d\S*", "*", message) for message in errors)
+        return result
+
+    if spec["role"] == "caregiver":
+        command(f"login_caregiver {spec['name']} {PASSWORD}")
+        for _ in range(spec["operations"]):
+            if rng.random() < 0.8:
+                stats["uploads"] += 1
+                command(f"upload_availability {date_token(rng.randrange(spec['days']))}")
+            else:
+                appointments = [r for r in command("show_appointments")["records"] if r["kind"] == "appointment"]
+                if appointments:
+                    stats["cancels"] += 1
+                    result = command(f"cancel {rng.choice(appointments)['appoint_id']}")
+                    stats["cancelled"] += any("successfully cancelled" in m for m in result["messages"])
+    else:
+        command(f"create_patient {spec['name']} {PASSWORD}")
+        command(f"login_patient {spec['name']} {PASSWORD}")
+        for _ in range(spec["operations"]):
+            if booked and rng.random() < 0.25:
+                stats["cancels"] += 1
+                result = command(f"cancel {booked.pop(rng.randrange(len(booked)))}")
+                stats["cancelled"] += any("successfully cancelled" in m for m in result["messages"])
+            else:
+                stats["reserves"] += 1
+                text = f"reserve {date_token(rng.randrange(spec['days']))} {rng.choice(VACCINES)}"
+                # half of the reservations ask for a time, on the quarter hours of the default workday
+                if rng.random() < 0.5:
+                    text += f" --at {rng.randrange(9, 17):02d}:{rng.choice((0, 15, 30, 45)):02d}"
+                result = command(text)
+                for record in result["records"]:
+                    if record["kind"] == "appointment":
+                        stats["booked"] += 1
+                        booked.append(record["appoint_id"])
+                        booked_at.append(time.time())
+    command("logout")
+    return stats, booked_at
+
+
+def thread_session(spec, env):
+    session = SubprocessSession(env)
+    try:
+        return run_session(spec, session.send)
+    finally:
+        session.close()
+
+
+def init_worker(env):
+    os.environ.update(env)
+    sys.path.insert(0, SCHEDULER_DIR)
+
+
+def process_session(spec):
+    session = InProcessSession()
+    try:
+        return run_session(spec, session.send)
+    finally:
+        session.close()
+
+
+def process_sessions(specs):
+    # the sessions of one task share the worker process, one thread each
+    with ThreadPoolExecutor(len(specs)) as pool:
+        return list(pool.map(process_session, specs))
+
+
+def setup(env, caregivers, doses):
+    session = SubprocessSession(env)
+    try:
+        for i in range(caregivers):
+            session.send(f"create_caregiver caregiver{i} {PASSWORD}")
+        session.send(f"login_caregiver caregiver0 {PASSWORD}")
+        for name in VACCINES:
+            session.send(f"add_doses {name} {doses}")
+        session.send("logout")
+    finally:
+        session.close()
+
+
+def check_invariants(paths, doses):
+    '''
+    Returns a list of invariant violations, empty when the databases are consistent.
+    '''
+    violations = []
+    appoint_ids = Counter()
+    active = Counter()
+    for path in paths:
+        conn = sqlite3.connect(path)
+        for cname, day, start in conn.execute(
+                """SELECT a.Cname, a.Time, a.StartMinute FROM Appointments a JOIN Appointments b
+                   ON b.Cname = a.Cname AND b.Time = a.Time AND b.AppointID > a.AppointID
+                   AND b.StartMinute < a.EndMinute AND a.StartMinute < b.EndMinute"""):
+            violations.append(f"caregiver {cname} is booked twice at minute {start} on {day}")
+        for cname, day, start in conn.execute(
+                """SELECT a.Cname, a.Time, a.StartMinute FROM Appointments a JOIN Availabilities v
+                   ON v.Username = a.Cname AND v.Time = a.Time AND v.StartMinute < a.EndMinute AND a.StartMinute < v.EndMinute"""):
+            violations.append(f"caregiver {cname} is booked and still available at minute {start} on {day}")
+        for cname, day, start in conn.execute(
+                """SELECT a.Username, a.Time, a.StartMinute FROM Availabilities a JOIN Availabilities b
+                   ON b.Username = a.Username AND b.Time = a.Time AND b.StartMinute > a.StartMinute
+                   AND b.StartMinute < a.EndMinute"""):
+            violations.append(f"caregiver {cname} has overlapping free time at minute {start} on {day}")
+        appoint_ids.update(row[0] for row in conn.execute("SELECT AppointID FROM Appointments"))
+        active.update(dict(conn.execute("SELECT Vname, COUNT(*) FROM Appointments GROUP BY Vname")))
+        conn.close()
+    violations.extend(f"appointment ID {appoint_id} is used {count} times" for appoint_id, count in appoint_ids.items() if count > 1)
+
+    # vaccines and their lots live on the home shard
+    conn = sqlite3.connect(paths[0])
+    stock = dict(conn.execute("SELECT Name, Doses FROM Vaccines"))
+    lots = dict(conn.execute("SELECT Vname, SUM(Quantity) FROM VaccineLots GROUP BY Vname"))
+    negative = conn.execute("SELECT COUNT(*) FROM VaccineLots WHERE Quantity < 0").fetchone()[0]
+    conn.close()
+    for name in VACCINES:
+        if stock.get(name) != doses - active[name]:
+            violations.append(f"{name} has {stock.get(name)} doses, expected {doses} - {active[name]} active appointments")
+        if lots.get(name) != stock.get(name):
+            violations.append(f"{name} lots hold {lots.get(name)} doses but Vaccines says {stock.get(name)}")
+    if negative:
+        violations.append(f"{negative} lots have negative stock")
+    return violations
+
+
+def check_shedding(paths, max_wait=2.0, slots=2, burst=8, late=4):
+    '''
+    Holds every reserve slot, sends a burst of reserve commands to admission control at once and, once
+    the burst has waited for a while, a few late ones. Returns a list of violations: beyond the commands
+    next in line for a slot, the burst must be turned away within half of max_wait and the late ones
+    within a tenth of it.
+    '''
+    os.environ.update(Backend="sqlite", SQLitePath=",".join(paths))
+    sys.path.insert(0, SCHEDULER_DIR)
+    from db.Admission import Admission, Overloaded
+
+    admission = Admission({"reserve": slots}, max_wait=max_wait)
+    held = threading.Event()
+    done = threading.Event()
+    shed_after = {}
+
+    def hold():
+        with admission.admit("reserve"):
+            held.set()
+            done.wait()
+
+    def client(name, delay):
+        time.sleep(delay)
+        started = time.monotonic()
+        try:
+            with admission.admit("reserve"):
+                pass
+        except Overloaded:
+            shed_after[name] = time.monotonic() - started
+
+    holders = [threading.Thread(target=hold) for _ in range(slots)]
+    for thread in holders:
+        thread.start()
+    held.wait()
+    time.sleep(0.1)
+    clients = [threading.Thread(target=client, args=(f"burst{i}", 0.0)) for i in range(burst)]
+    clients += [threading.Thread(target=client, args=(f"late{i}", max_wait * 0.4)) for i in range(late)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    done.set()
+    for thread in holders:
+        thread.join()
+
+    violations = []
+    if len(shed_after) != burst + late:
+        violations.append(f"{burst + late - len(shed_after)} of {burst + late} excess reserve commands were admitted")
+    burst_waits = sorted(wait for name, wait in shed_after.items() if name.startswith("burst"))
+    slow = [wait for wait in burst_waits[:burst - slots] if wait > max_wait / 2]
+    if slow:
+        violations.append(f"{len(slow)} excess reserve commands waited up to {max(slow):.2f} s of {max_wait} s before being turned away")
+    late_waits = [wait for name, wait in shed_after.items() if name.startswith("late")]
+    if late_waits and max(late_waits) > max_wait / 10:
+        violations.append(f"reserve commands arriving behind a stalled queue waited up to {max(late_waits):.2f} s before being turned away")
+    print(f"shedding: burst turned away after {', '.join(f'{w:.2f}' for w in burst_waits)} s, "
+          f"late after {', '.join(f'{w:.2f}' for w in sorted(late_waits))} s (AdmissionMaxWait {max_wait} s)")
+    return violations
+
+
+def throughput(booked_at, started, finished):
+    if not booked_at:
+        return 0.0, 0.0
+    per_second = Counter(int(t - started) for t in booked_at)
+    rates = sorted(per_second.get(second, 0) for second in range(int(finished - started) + 1))
+    return len(booked_at) / (finished - started), rates[len(rates) // 2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stress the booking paths with concurrent sessions.")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=32, help="thread pool size; each thread drives one Scheduler process")
+    parser.add_argument("--processes", type=int, default=8, help="process pool size; each worker runs sessions in-process")
+    parser.add_argument("--session-threads", type=int, default=1,
+                        help="sessions each process worker runs at once, one per thread (with GroupCommitWindow, "
+                             "their bookings are committed in groups)")
+    parser.add_argument("--operations", type=int, default=10, help="commands per session after logging in")
+    parser.add_argument("--caregivers", type=int, default=20)
+    parser.add_argument("--days", type=int, default=5)
+    parser.add_argument("--doses", type=int, default=200, help="initial stock per vaccine")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", help="directory for the SQLite files (a temporary one by default)")
+    parser.add_argument("--check-shedding", action="store_true",
+                        help="afterwards check that admission control turns excess commands away quickly")
+    args = parser.parse_args()
+
+    paths = build_databases(args.dir or tempfile.mkdtemp(prefix="stress-"), args.shards)
+    env = dict(os.environ, Backend="sqlite", SQLitePath=",".join(paths))
+    env.pop("TraceFile", None)
+    setup(env, args.caregivers, args.doses)
+
+    specs = []
+    for i in range(args.sessions):
+        # one session in four is a caregiver's
+        role = "caregiver" if i % 4 == 0 else "patient"
+        name = f"caregiver{i // 4 % args.caregivers}" if role == "caregiver" else f"patient{i}"
+        specs.append({"role": role, "name": name, "seed": args.seed * 100003 + i,
+                      "operations": args.operations, "days": args.days})
+
+    started = time.time()
+    # workers are spawned rather than forked: a fork taken while the thread pool is busy can copy a held lock
+    with ThreadPoolExecutor(args.threads) as threads, \
+            ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker,
+                                initargs=({"Backend": "sqlite", "SQLitePath": env["SQLitePath"]},)) as processes:
+        in_process = specs[1::2]
+        thread_futures = [threads.submit(thread_session, spec, env) for spec in specs[::2]]
+        process_futures = [processes.submit(process_sessions, in_process[i:i + args.session_threads])
+                           for i in range(0, len(in_process), args.session_threads)]
+        results = [future.result() for future in thread_futures]
+        results += [result for future in process_futures for result in future.result()]
+    finished = time.time()
+
+    totals = Counter()
+    booked_at = []
+    for stats, times in results:
+        totals.update(stats)
+        booked_at.extend(times)
+    overall, sustained = throughput(booked_at, started, finished)
+    print(f"{args.sessions} sessions, {totals['commands']} commands in {finished - started:.1f} s "
+          f"({totals['commands'] / (finished - started):.1f} commands/s), {totals['errors']} with database errors, "
+          f"{totals['shed']} turned away by admission control")
+    print(f"reserve: {totals['booked']} of {totals['reserves']} booked; cancel: {totals['cancelled']} of {totals['cancels']}; "
+          f"upload_availability: {totals['uploads']}")
+    print(f"booking throughput: {overall:.1f}/s overall, {sustained}/s median per second")
+    for message, count in sorted(((k, v) for k, v in totals.items() if k.startswith("error: ")), key=lambda kv: -kv[1])[:5]:
+        print(f"{count:6d}  {message[len('error: '):]}")
+
+    violations = check_invariants(paths, args.doses)
+    if args.check_shedding:
+        violations += check_shedding(paths)
+    for violation in violations:
+        print("VIOLATION:", violation)
+    print("invariants hold" if not violations else f"{len(violations)} invariant violations")
+    sys.exit(1 if violations else 0)
@@ -0,0 +1,100 @@
+'''
+Command trace recording for the start() dispatch loop.
+Each command is written as one JSON line: {"t": start time, "s": session, "c": command,
+"o": outcome, "ms": duration}. Passwords are redacted before anything is written.
+util/Replay.py re-runs such traces.
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import contextlib
+from util.Output import LineBuffer
+
+REDACTED = "***"
+
+# commands whose third token is a password
+PASSWORD_COMMANDS = ("create_patient", "create_caregiver", "login_patient", "login_caregiver")
+
+
+def redact(tokens):
+    if tokens and tokens[0] in PASSWORD_COMMANDS and len(tokens) > 2:
+        return tokens[:2] + [REDACTED] + tokens[3:]
+    return tokens
+
+
+class OutcomeCapture(io.TextIOBase):
+    '''
+    Passes output through to the real stdout and remembers the last non-empty line,
+    which serves as the command's outcome in the trace.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.lines = LineBuffer(self._keep)
+        self.completed = ""
+
+    def _keep(self, line):
+        self.completed = line
+
+    @property
+    def last_line(self):
+        return self.lines.partial.strip() or self.completed
+
+    def write(self, text):
+        self.stream.write(text)
+        self.lines.write(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class TraceRecorder:
+    def __init__(self, path, session=None):
+        self.file = open(path, "a", buffering=1, encoding="utf-8")
+        self.session = session or uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+
+    def run(self, command, operation, tokens):
+        '''
+        Runs command(operation, tokens), records it and returns its result.
+        '''
+        capture = OutcomeCapture(sys.stdout)
+        started = time.time()
+        clock = time.perf_counter()
+        outcome = None
+        try:
+            with contextlib.redirect_stdout(capture):
+                result = command(operation, tokens)
+            outcome = capture.last_line
+            return result
+        except BaseException as e:
+            # an error escaping the command (or SystemExit) is recorded before it propagates
+            outcome = f"{type(e).__name__}: {capture.last_line}"
+            raise
+        finally:
+            self.record(tokens, started, outcome, (time.perf_counter() - clock) * 1000)
+
+    def record(self, tokens, started, outcome, elapsed_ms):
+        line = json.dumps({"t": round(started, 6), "s": self.session, "c": " ".join(redact(tokens)),
+                           "o": outcome, "ms": round(elapsed_ms, 3)}, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def from_env():
+    '''
+    Returns a recorder when the TraceFile environment variable is set, otherwise None.
+    TraceSession overrides the generated session ID (the replayer uses it to keep IDs stable).
+    '''
+    path = os.getenv("TraceFile")
+    if not path:
+        return None
+    return TraceRecorder(path, os.getenv("TraceSession"))